@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""
+Load benchmark for the ZeroVM name service.
+
+Simulates a networked job of many ZeroVM instances on localhost, each of
+them registers in the name service from its own UDP socket. Every peer
+binds a channel for each of its `--fanout` neighbours and connects to all
+of them. Measures time from the first registration to the moment the last
+peer got its reply.
+
+Usage:
+    PYTHONPATH=<path to zerocloud> python nameservice_load.py -p 5000
+"""
+
+import optparse
+import resource
+import struct
+import time
+
+from eventlet import GreenPool, sleep
+from eventlet.green import socket
+
+from zerocloud.nameservice import NameService
+from zerocloud.nameservice import SharedNameService
+
+
+def neighbours(id, peers, fanout):
+    result = []
+    for i in range(1, fanout / 2 + 1):
+        result.append((id - 1 + i) % peers + 1)
+        result.append((id - 1 - i) % peers + 1)
+    return sorted(set(result) - set([id]))
+
+
+def make_packet(id, id_base, peers, fanout):
+    near = [id_base + h for h in neighbours(id, peers, fanout)]
+    packet = struct.pack('!III', id_base + id, len(near), len(near))
+    for h in near:
+        packet += struct.pack('!IH', h, 1024 + id % 60000)
+    for h in near:
+        packet += struct.pack('!IH', h, 0)
+    return packet
+
+
+def run_peer(ns_port, packet, timeout, retry):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(('127.0.0.1', ns_port))
+    sock.settimeout(retry)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.send(packet)
+            try:
+                sock.recv(65535)
+                return time.time()
+            except socket.timeout:
+                continue
+        return None
+    finally:
+        sock.close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--peers', type='int', default=1000,
+                      help='number of simulated ZeroVM instances')
+    parser.add_option('-f', '--fanout', type='int', default=4,
+                      help='number of neighbours of each peer')
+    parser.add_option('-s', '--shared', action='store_true', default=False,
+                      help='use SharedNameService instead of NameService')
+    parser.add_option('-t', '--timeout', type='float', default=60.0,
+                      help='seconds to wait for all peers to resolve')
+    parser.add_option('-r', '--retry', type='float', default=1.0,
+                      help='seconds before peer re-sends its packet')
+    options, args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = options.peers + 64
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (min(needed, hard), hard))
+
+    pool = GreenPool(options.peers + 10)
+    id_base = 0
+    if options.shared:
+        service = SharedNameService(job_ttl=options.timeout)
+        service.start(pool)
+        job = service.register_job(options.peers)
+        id_base = job.id_base
+    else:
+        service = NameService(options.peers)
+        service.start(pool)
+    sleep(0.1)
+
+    packets = [make_packet(id, id_base, options.peers, options.fanout)
+               for id in range(1, options.peers + 1)]
+    start = time.time()
+    threads = [pool.spawn(run_peer, service.port, packet,
+                          options.timeout, options.retry)
+               for packet in packets]
+    results = [th.wait() for th in threads]
+    service.stop()
+
+    resolved = [t for t in results if t]
+    print 'peers: %d, fanout: %d, shared: %s' % (
+        options.peers, options.fanout, options.shared)
+    print 'resolved: %d/%d' % (len(resolved), options.peers)
+    if resolved:
+        print 'time to all resolved: %.3f s' % (max(resolved) - start)
+
+
+if __name__ == '__main__':
+    main()
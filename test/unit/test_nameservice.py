@@ -0,0 +1,334 @@
+import json
+import struct
+import time
+import unittest
+
+import mock
+from eventlet import sleep, GreenPool
+from eventlet.green import socket
+
+from swift.common.memcached import MemcacheConnectionError
+
+from zerocloud import nameservice
+from zerocloud.nameservice import NameTable
+from zerocloud.nameservice import SharedNameService
+from zerocloud.nameservice import StaticPortAllocator
+from zerocloud.nameservice import StaticPortMap
+from zerocloud.configparser import ZvmNode
+
+
+class FakeMemcache(object):
+
+    def __init__(self):
+        self.store = {}
+        self.down = False
+
+    def incr(self, key, delta=1, time=0):
+        if self.down:
+            raise MemcacheConnectionError()
+        self.store[key] = max(0, self.store.get(key, 0) + delta)
+        return self.store[key]
+
+    def decr(self, key, delta=1, time=0):
+        return self.incr(key, -delta, time)
+
+    def delete(self, key):
+        if self.down:
+            raise MemcacheConnectionError()
+        self.store.pop(key, None)
+
+
+def mock_client(ns_port, conf, id, timeout=5):
+    """
+    Registers one ZeroVM instance in the name service
+    and returns the resolved connect records
+
+    :param ns_port: name service UDP port
+    :param conf: [bind_list, connect_list] of peer ids
+    :param id: id of this peer
+
+    :returns list of (host, port) tuples or None on timeout
+    """
+    bind_data = ''
+    connect_data = ''
+    for h in conf[0]:
+        bind_data += struct.pack('!IH', h, 1000 + (h & 0xfff))
+    for h in conf[1]:
+        connect_data += struct.pack('!IH', h, 0)
+    request = struct.pack('!I', id) + \
+        struct.pack('!I', len(conf[0])) + \
+        struct.pack('!I', len(conf[1])) + \
+        bind_data + connect_data
+    ns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ns.settimeout(timeout)
+    ns.connect(('127.0.0.1', int(ns_port)))
+    ns.send(request)
+    try:
+        reply = ns.recv(65535)
+    except socket.timeout:
+        return None
+    finally:
+        ns.close()
+    offset = 3 * 4 + len(bind_data)
+    result = []
+    for i in range(len(conf[1])):
+        host, port = struct.unpack_from('!4sH', reply, offset)[0:2]
+        offset += 6
+        result.append((socket.inet_ntop(socket.AF_INET, host), port))
+    return result
+
+
+def make_packet(id, bind, connect):
+    packet = struct.pack('!III', id, len(bind), len(connect))
+    for h, port in bind:
+        packet += struct.pack('!IH', h, port)
+    for h in connect:
+        packet += struct.pack('!IH', h, 0)
+    return packet
+
+
+class TestNameTable(unittest.TestCase):
+
+    def test_resolve(self):
+        table = NameTable(3)
+        self.assertFalse(table.register(
+            make_packet(1, [(2, 1012), (3, 1013)], [2, 3]),
+            ('10.0.0.1', 5001)))
+        self.assertFalse(table.register(
+            make_packet(2, [(1, 1021)], [1, 3]), ('10.0.0.2', 5002)))
+        self.assertTrue(table.register(
+            make_packet(3, [(1, 1031), (2, 1032)], [1]),
+            ('10.0.0.1', 5003)))
+        replies = dict((addr, reply) for reply, addr in table.replies())
+        self.assertEqual(len(replies), 3)
+
+        def records(reply):
+            bind_count, connect_count = struct.unpack_from('!II', reply, 4)
+            offset = 12 + bind_count * 6
+            return [(socket.inet_ntop(socket.AF_INET, h), port)
+                    for h, port in [struct.unpack_from('!4sH', reply,
+                                                       offset + i * 6)
+                                    for i in range(connect_count)]]
+
+        self.assertEqual(records(replies[('10.0.0.1', 5001)]),
+                         [('10.0.0.2', 1021), ('127.0.0.1', 1031)])
+        self.assertEqual(records(replies[('10.0.0.2', 5002)]),
+                         [('10.0.0.1', 1012), ('10.0.0.1', 1032)])
+        self.assertEqual(records(replies[('10.0.0.1', 5003)]),
+                         [('127.0.0.1', 1013)])
+        reply = replies[('10.0.0.1', 5001)]
+        self.assertEqual(len(reply), len(
+            make_packet(1, [(2, 1012), (3, 1013)], [2, 3])))
+        self.assertIs(table.get_reply(1), table.get_reply(1))
+
+    def test_send_replies(self):
+        table = NameTable(2)
+        sock = mock.MagicMock()
+        packet1 = make_packet(1, [(2, 1012)], [2])
+        packet2 = make_packet(2, [(1, 1021)], [1])
+        self.assertFalse(
+            table.send_replies(sock, (packet1, ('10.0.0.1', 5001))))
+        self.assertEqual(sock.sendto.call_count, 0)
+        self.assertTrue(
+            table.send_replies(sock, (packet2, ('10.0.0.2', 5002))))
+        self.assertEqual(sock.sendto.call_count, 2)
+        sock.reset_mock()
+        # peer re-sends its packet, only this peer gets the reply
+        self.assertFalse(
+            table.send_replies(sock, (packet1, ('10.0.0.1', 5001))))
+        sock.sendto.assert_called_once_with(table.get_reply(1),
+                                            ('10.0.0.1', 5001))
+
+
+class TestSharedNameService(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = GreenPool()
+        self.logger = mock.MagicMock()
+        self.ns_server = SharedNameService(job_ttl=10, sweep_interval=0.1,
+                                           logger=self.logger)
+        self.ns_server.start(self.pool)
+        sleep(0.1)
+
+    def tearDown(self):
+        self.ns_server.stop()
+
+    def test_register_job(self):
+        job1 = self.ns_server.register_job(2)
+        job2 = self.ns_server.register_job(2)
+        self.assertNotEqual(job1.token, job2.token)
+        self.assertNotEqual(job1.id_base, 0)
+        self.assertEqual(job1.port, self.ns_server.port)
+        self.assertEqual(nameservice.get_job_token(job2.id_base + 2),
+                         job2.token)
+        self.assertEqual(len(self.ns_server.jobs), 2)
+        job1.stop()
+        self.assertEqual(self.ns_server.jobs.keys(), [job2.token])
+        self.assertIsNone(
+            self.ns_server.register_job(2, nameservice.NODE_ID_LIMIT))
+
+    def test_token_exhaustion(self):
+        for i in range(nameservice.JOB_TOKEN_LIMIT - 1):
+            self.assertIsNotNone(self.ns_server.register_job(2))
+        self.assertIsNone(self.ns_server.register_job(2))
+        self.ns_server.unregister_job(5)
+        self.assertEqual(self.ns_server.register_job(2).token, 5)
+
+    def test_concurrent_jobs(self):
+        job1 = self.ns_server.register_job(2)
+        job2 = self.ns_server.register_job(2)
+        threads = []
+        for job in (job1, job2):
+            a = job.id_base + 1
+            b = job.id_base + 2
+            threads.append(self.pool.spawn(
+                mock_client, job.port, [[b], [b]], a))
+            threads.append(self.pool.spawn(
+                mock_client, job.port, [[a], [a]], b))
+        results = [th.wait() for th in threads]
+        for i, job in enumerate((job1, job2)):
+            a = job.id_base + 1
+            b = job.id_base + 2
+            self.assertEqual(results[i * 2], [('127.0.0.1', 1001)])
+            self.assertEqual(results[i * 2 + 1], [('127.0.0.1', 1002)])
+        self.logger.timing_since.assert_called_with(
+            'name_service.resolve_time', mock.ANY)
+        self.assertEqual(self.logger.timing_since.call_count, 2)
+
+    def test_unknown_job(self):
+        result = mock_client(self.ns_server.port, [[2], [2]],
+                             (7 << nameservice.NODE_ID_BITS) + 1, timeout=0.3)
+        self.assertIsNone(result)
+        self.logger.increment.assert_called_with('name_service.unknown_job')
+
+    def test_port_taken(self):
+        ns_server = SharedNameService(port=self.ns_server.port)
+        self.assertRaises(socket.error, ns_server.start, self.pool)
+
+    def test_bad_message(self):
+        with mock.patch.object(self.ns_server, '_handle',
+                               side_effect=ValueError):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.sendto('junk', ('127.0.0.1', self.ns_server.port))
+            sock.close()
+            sleep(0.1)
+        self.logger.increment.assert_any_call('name_service.errors')
+        self.assertTrue(self.logger.exception.called)
+
+    def test_expire_jobs(self):
+        self.ns_server.job_ttl = 0.1
+        job = self.ns_server.register_job(2)
+        self.assertIn(job.token, self.ns_server.jobs)
+        sleep(0.5)
+        self.assertNotIn(job.token, self.ns_server.jobs)
+        self.logger.increment.assert_called_with('name_service.expired')
+
+
+class TestStaticPorts(unittest.TestCase):
+
+    def test_parse_port_range(self):
+        self.assertIsNone(nameservice.parse_port_range(None))
+        self.assertIsNone(nameservice.parse_port_range(' '))
+        self.assertEqual(nameservice.parse_port_range('30000-30999'),
+                         (30000, 30999))
+        self.assertRaises(ValueError, nameservice.parse_port_range, '3000')
+        self.assertRaises(ValueError, nameservice.parse_port_range,
+                          '3000-2000')
+        self.assertRaises(ValueError, nameservice.parse_port_range,
+                          '0-65536')
+
+    def test_allocate(self):
+        allocator = StaticPortAllocator((30000, 30001), ttl=10)
+        self.assertEqual(allocator.allocate('10.0.0.1'), 30000)
+        self.assertEqual(allocator.allocate('10.0.0.2'), 30000)
+        self.assertEqual(allocator.allocate('10.0.0.1'), 30001)
+        self.assertIsNone(allocator.allocate('10.0.0.1'))
+        allocator.release('10.0.0.1', 30000)
+        self.assertEqual(allocator.allocate('10.0.0.1'), 30000)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertEqual(allocator.allocate('10.0.0.1'), 30001)
+
+    def test_allocate_shared(self):
+        memcache = FakeMemcache()
+        # two proxy workers
+        first = StaticPortAllocator((30000, 30002), ttl=10)
+        second = StaticPortAllocator((30000, 30002), ttl=10)
+        self.assertEqual(first.allocate('10.0.0.1', memcache), 30000)
+        self.assertEqual(second.allocate('10.0.0.1', memcache), 30001)
+        self.assertEqual(first.allocate('10.0.0.1', memcache), 30002)
+        self.assertIsNone(second.allocate('10.0.0.1', memcache))
+        first.release('10.0.0.1', 30000, memcache)
+        self.assertEqual(second.allocate('10.0.0.1', memcache), 30000)
+        # each worker keeps its own ports without memcache
+        memcache.down = True
+        self.assertEqual(first.allocate('10.0.0.1', memcache), 30000)
+
+    def test_port_map(self):
+        allocator = StaticPortAllocator((30000, 30999))
+        sort = ZvmNode(1, 'sort')
+        sort.connect = ['tcp:2:,/dev/out/merge,0,0,0,0,1,1']
+        merge = ZvmNode(2, 'merge')
+        merge.bind = ['tcp:1:0,/dev/in/sort,0,0,1,1,0,0']
+        port_map = StaticPortMap(allocator)
+        templates = [port_map.template(sort), port_map.template(merge)]
+        sizes = [port_map.get_size(t) for t in templates]
+        self.assertEqual(port_map.ports, {(2, 1): None})
+        self.assertTrue(port_map.assign({1: '10.0.0.1', 2: '10.0.0.2'}))
+        configs = [''.join(port_map.iter_render(t)) for t in templates]
+        self.assertEqual([len(c) for c in configs], sizes)
+        configs = [json.loads(c) for c in configs]
+        self.assertEqual(configs[0]['connect'],
+                         ['tcp:10.0.0.2:30000,/dev/out/merge,0,0,0,0,1,1'])
+        self.assertEqual(configs[1]['bind'],
+                         ['tcp:0.0.0.0:30000,/dev/in/sort,0,0,1,1,0,0'])
+        self.assertEqual(nameservice.get_static_bind_ports(configs[1]),
+                         [30000])
+        self.assertEqual(nameservice.get_static_bind_ports(configs[0]), [])
+        port_map.stop()
+        self.assertEqual(allocator.used, {})
+
+    def test_port_map_ipc(self):
+        allocator = StaticPortAllocator((30000, 30999))
+        sort = ZvmNode(1, 'sort')
+        sort.connect = ['tcp:2:;tcp:3:,/dev/out/merge,0,0,0,0,1,1']
+        merge = ZvmNode(2, 'merge')
+        merge.bind = ['tcp:1:0,/dev/in/sort,0,0,1,1,0,0']
+        merge3 = ZvmNode(3, 'merge')
+        merge3.bind = ['tcp:1:0,/dev/in/sort,0,0,1,1,0,0']
+        port_map = StaticPortMap(allocator, ipc=True)
+        templates = [port_map.template(n) for n in (sort, merge, merge3)]
+        sizes = [port_map.get_size(t) for t in templates]
+        self.assertTrue(port_map.assign(
+            {1: '10.0.0.1', 2: '10.0.0.1', 3: '10.0.0.2'}))
+        configs = [port_map.render(t) for t in templates]
+        self.assertEqual([len(c) for c in configs], sizes)
+        configs = [json.loads(c) for c in configs]
+        ipc_path = '%s/%s-2-1' % (nameservice.STATIC_IPC_DIR,
+                                  port_map.ipc_key)
+        self.assertEqual(configs[0]['connect'],
+                         ['ipc:%s;tcp:10.0.0.2:30000,'
+                          '/dev/out/merge,0,0,0,0,1,1' % ipc_path])
+        self.assertEqual(nameservice.get_static_ipc_paths(configs[1]),
+                         [ipc_path])
+        self.assertEqual(nameservice.get_static_bind_ports(configs[1]), [])
+        self.assertEqual(nameservice.get_static_bind_ports(configs[2]),
+                         [30000])
+        # only one port is taken
+        self.assertEqual(allocator.used.keys(), ['10.0.0.2'])
+        port_map.stop()
+        self.assertEqual(allocator.used, {})
+
+    def test_port_map_exhausted(self):
+        allocator = StaticPortAllocator((30000, 30000))
+        node = ZvmNode(1, 'sort')
+        node.bind = ['tcp:2:0;tcp:3:0,/dev/in/merge,0,0,1,1,0,0']
+        port_map = StaticPortMap(allocator)
+        port_map.template(node)
+        self.assertFalse(port_map.assign({1: '10.0.0.1'}))
+        self.assertEqual(allocator.used, {})
+        # IPv6 hosts are not supported
+        self.assertFalse(port_map.assign({1: '::1'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,12 @@
 from contextlib import contextmanager
 from StringIO import StringIO
+import json
 import logging
 from posix import rmdir
 import unittest
 import os
 from time import time
-from eventlet import GreenPool
+from eventlet import GreenPool, sleep, spawn
 from hashlib import md5
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
@@ -25,10 +26,10 @@ from swift.common.utils import mkdirs, normalize_timestamp, get_logger
 from swift.obj.server import ObjectController
 from test_proxyquery import ZEROVM_DEFAULT_MOCK
 from zerocloud.common import ACCESS_READABLE, ACCESS_WRITABLE, ACCESS_CDR, \
-    parse_location, ACCESS_RANDOM
+    parse_location, ACCESS_RANDOM, sign_request
 from zerocloud import TAR_MIMES
 from zerocloud.configparser import ZvmNode
-from zerocloud.thread_pool import WaitPool, Zuid
+from zerocloud.thread_pool import DeviceSlots, MemoryBudget, WaitPool, Zuid
 
 
 def get_headers(self):
@@ -1126,6 +1127,88 @@ class TestObjectQuery(unittest.TestCase):
             finally:
                 self.app.zerovm_kill_timeout = orig_kill_timeout
 
+    def test_QUERY_spill(self):
+        self.app.zerovm_internal_key = 'secret'
+        job_id = self.uid_generator.get()
+        url = 'spill://map-1/reduce-1'
+        spill_dir = self.app.get_spill_dir('sda1', job_id)
+        mkdirs(spill_dir)
+        with open(os.path.join(spill_dir,
+                               objectquery._spill_file_name(url)), 'w') as fp:
+            fp.write('intermediate')
+        req = Request.blank('/sda1/0/a/c/o',
+                            headers={'x-zerovm-spill': url,
+                                     'x-zerocloud-id': job_id})
+        # not signed by proxy
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 403)
+        req.headers['x-zerovm-signature'] = sign_request('other', job_id, url)
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 403)
+        req.headers['x-zerovm-signature'] = sign_request('secret', job_id, url)
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, 'intermediate')
+        # signature is bound to the job
+        req.headers['x-zerocloud-id'] = self.uid_generator.get()
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 403)
+
+    def test_QUERY_cancel(self):
+        self.app.zerovm_internal_key = 'secret'
+        self.setup_zerovm_query(trim(r'''
+            from time import sleep
+            sleep(10)
+            '''))
+        req = self.zerovm_object_request()
+        job_id = req.headers['x-zerocloud-id']
+        nexefile = StringIO(self._nexescript)
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel(
+            'stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = conf.dumps()
+        sysmap = StringIO(conf)
+        with create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            req.headers['x-zerovm-timeout'] = 10
+            thrd = spawn(req.get_response, self.app)
+            for _i in range(50):
+                sleep(0.1)
+                if [f for f in os.listdir(self.app.zerovm_sessions_dir)
+                        if f.startswith(job_id)]:
+                    break
+            cancel = Request.blank('/sda1/0/a',
+                                   environ={'REQUEST_METHOD': 'POST'},
+                                   headers={'x-zerovm-cancel': job_id})
+            cancel.body = json.dumps(['sort'])
+            # not signed by proxy, session keeps running
+            resp = cancel.get_response(self.app)
+            self.assertEqual(resp.status_int, 403)
+            cancel.headers['x-zerovm-signature'] = sign_request(
+                'other', job_id, cancel.body)
+            resp = cancel.get_response(self.app)
+            self.assertEqual(resp.status_int, 403)
+            self.assertTrue([f for f in os.listdir(
+                self.app.zerovm_sessions_dir) if f.startswith(job_id)])
+            cancel.headers['x-zerovm-signature'] = sign_request(
+                'secret', job_id, cancel.body)
+            resp = cancel.get_response(self.app)
+            self.assertEqual(resp.status_int, 200)
+            result = json.loads(resp.body)
+            self.assertEqual(result['sessions'], 1)
+            self.assertTrue(0 < result['seconds'] <= 10)
+            resp = thrd.wait()
+            self.assertEqual(resp.status_int, 500)
+            self.assertIn('ERROR OBJ.QUERY retcode=Cancelled', resp.body)
+            cancel.body = 'sort'
+            cancel.headers['x-zerovm-signature'] = sign_request(
+                'secret', job_id, cancel.body)
+            resp = cancel.get_response(self.app)
+            self.assertEqual(resp.status_int, 400)
+
     def test_QUERY_simulteneous_running_zerovm_limits(self):
         self.setup_zerovm_query()
         nexefile = StringIO('return sleep(.2)')
@@ -1175,6 +1258,212 @@ class TestObjectQuery(unittest.TestCase):
             finally:
                 self.app.zerovm_thread_pools = orig_zerovm_threadpools
 
+    def test_QUERY_gang_reservation(self):
+        self.setup_zerovm_query()
+        nexefile = StringIO('return "ok"')
+        conf = ZvmNode(1, 'exit', parse_location('swift://a/c/exe'))
+        conf = conf.dumps()
+        sysmap = StringIO(conf)
+        with create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            orig_zerovm_threadpools = self.app.zerovm_thread_pools
+            try:
+                pool = WaitPool(1, 0)
+                self.app.zerovm_thread_pools['default'] = pool
+                key = pool.reserve('', 10)
+                self.assertNotEqual(key, None)
+                self.assertEqual(pool.reserve('', 10), None)
+                req = self.zerovm_free_request()
+                req.headers['x-zerovm-gang'] = 'yes'
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 503)
+                self.assertEqual(resp.body, 'Slot not available')
+                pool.release(key)
+                req = self.zerovm_free_request()
+                req.headers['x-zerovm-gang'] = 'yes'
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 200)
+                self.assertEqual(pool.reserved(), 0)
+                # uncommitted reservation expires
+                self.assertNotEqual(pool.reserve('', -1), None)
+                self.assertEqual(pool.reserved(), 0)
+            finally:
+                self.app.zerovm_thread_pools = orig_zerovm_threadpools
+
+    def test_QUERY_priority_pool(self):
+        self.setup_zerovm_query()
+        nexefile = StringIO('return "ok"')
+        conf = ZvmNode(1, 'exit', parse_location('swift://a/c/exe'))
+        conf = conf.dumps()
+        sysmap = StringIO(conf)
+        with create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            orig_zerovm_threadpools = self.app.zerovm_thread_pools
+            try:
+                self.app.zerovm_thread_pools = dict(orig_zerovm_threadpools)
+                pool = WaitPool(1, 0)
+                self.app.zerovm_thread_pools['interactive'] = pool
+                # no free slots for interactive jobs
+                pool.commit(pool.reserve('', 10))
+                for priority, status in [('interactive', 503),
+                                         ('batch', 200)]:
+                    req = self.zerovm_free_request()
+                    req.headers['x-zerovm-priority'] = priority
+                    req.body_file = Input(open(tar, 'rb'), length)
+                    req.content_length = length
+                    resp = req.get_response(self.app)
+                    self.assertEqual(resp.status_int, status)
+            finally:
+                self.app.zerovm_thread_pools = orig_zerovm_threadpools
+
+    def test_QUERY_deadline_shedding(self):
+        self.setup_zerovm_query()
+        nexefile = StringIO('return "ok"')
+        conf = ZvmNode(1, 'exit', parse_location('swift://a/c/exe'))
+        conf = conf.dumps()
+        sysmap = StringIO(conf)
+        with create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            orig_zerovm_threadpools = self.app.zerovm_thread_pools
+            try:
+                pool = WaitPool(1, 10)
+                self.app.zerovm_thread_pools['default'] = pool
+                pool.service_time = 100.0
+                thrd = pool.force_spawn(sleep, 0.1)
+                req = self.zerovm_free_request()
+                req.headers['x-zerovm-timeout'] = 5
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 503)
+                self.assertEqual(resp.body, 'Slot not available '
+                                            'before deadline')
+                self.assertEqual(resp.headers['Retry-After'], '95')
+                thrd.wait()
+            finally:
+                self.app.zerovm_thread_pools = orig_zerovm_threadpools
+
+    def test_QUERY_device_busy(self):
+        self.setup_zerovm_query()
+        nexefile = StringIO('return "ok"')
+        conf = ZvmNode(1, 'exit', parse_location('swift://a/c/exe'))
+        conf = conf.dumps()
+        sysmap = StringIO(conf)
+        with create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            try:
+                self.app.device_slots = DeviceSlots(1, 0)
+                req = self.zerovm_free_request()
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 200)
+                self.assertEqual(resp.headers['x-zerovm-device-load'],
+                                 '1 0 1')
+                self.assertEqual(self.app.device_slots.load('sda1'),
+                                 '0 0 1')
+                self.app.device_slots.acquire('sda1')
+                req = self.zerovm_free_request()
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 503)
+                self.assertEqual(resp.body, 'Device is busy')
+                self.assertEqual(resp.headers['x-zerovm-device-load'],
+                                 '1 0 1')
+            finally:
+                self.app.device_slots = None
+
+    def test_QUERY_not_enough_memory(self):
+        self.setup_zerovm_query()
+        nexefile = StringIO('return "ok"')
+        conf = ZvmNode(1, 'exit', parse_location('swift://a/c/exe'))
+        conf = conf.dumps()
+        sysmap = StringIO(conf)
+        memory = self.app.parser_config['manifest']['Memory']
+        with create_tar({'boot': nexefile, 'sysmap': sysmap}) as tar:
+            length = os.path.getsize(tar)
+            try:
+                self.app.memory_budget = MemoryBudget(memory + 1,
+                                                      proc=self.testdir)
+                req = self.zerovm_free_request()
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 200)
+                self.assertEqual(resp.headers['x-zerovm-memory-free'], '1')
+                # load after the session, for proxy to order the servers
+                self.assertIn('x-zerovm-pool-load', resp.headers)
+                self.assertEqual(self.app.memory_budget.committed, 0)
+                self.assertTrue(self.app.memory_budget.commit(2))
+                req = self.zerovm_free_request()
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = req.get_response(self.app)
+                self.assertEqual(resp.status_int, 503)
+                self.assertEqual(resp.body, 'Not enough memory')
+                self.assertEqual(resp.headers['x-zerovm-memory-free'],
+                                 str(memory - 1))
+            finally:
+                self.app.memory_budget = None
+
+    def test_update_thread_pools(self):
+        default = self.app.zerovm_thread_pools['default']
+        cluster = self.app.zerovm_thread_pools['cluster']
+        self.app.update_thread_pools('default = WaitPool(4,5); '
+                                     'cluster = FairPool(10,100); '
+                                     'interactive = WaitPool(2,2)')
+        # same class, changed in place
+        self.assertTrue(self.app.zerovm_thread_pools['default'] is default)
+        self.assertEqual(default.size(), 4)
+        self.assertFalse(self.app.zerovm_thread_pools['cluster'] is cluster)
+        self.assertEqual(
+            self.app.zerovm_thread_pools['interactive'].name, 'interactive')
+        for value in ['cluster = WaitPool(1,1)',
+                      'default = WaitPool(1,x)',
+                      'default = HostLoad(1)']:
+            self.assertRaises(ValueError,
+                              self.app.update_thread_pools, value)
+        # nothing changed
+        self.assertEqual(len(self.app.zerovm_thread_pools), 3)
+        self.assertEqual(default.size(), 4)
+
+    def test_thread_pools_file(self):
+        pools_file = os.path.join(self.testdir, 'threadpools')
+        self.app.zerovm_threadpools_file = pools_file
+        req = Request.blank('/zerovm/threadpools',
+                            environ={'REMOTE_ADDR': '10.0.0.1'})
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 403)
+        req = Request.blank('/zerovm/threadpools',
+                            environ={'REMOTE_ADDR': '127.0.0.1',
+                                     'REQUEST_METHOD': 'PUT'})
+        req.body = 'cluster = WaitPool(1,1)'
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 400)
+        self.assertFalse(os.path.exists(pools_file))
+        req.body = 'default = WaitPool(3,1)'
+        resp = req.get_response(self.app)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(open(pools_file).read(), 'default = WaitPool(3,1)')
+        result = json.loads(resp.body)
+        self.assertEqual(result['config'], 'default = WaitPool(3,1)')
+        self.assertEqual(result['pools'],
+                         {'default': {'class': 'WaitPool', 'size': 3,
+                                      'running': 0, 'queued': 0}})
+        # other worker changed the file
+        with open(pools_file, 'w') as f:
+            f.write('default = WaitPool(5,1); batch = WaitPool(1,1)')
+        os.utime(pools_file, (0, 0))
+        self.app._threadpools_next_check = 0
+        self.app.check_thread_pools_file()
+        self.assertEqual(self.app.zerovm_thread_pools['default'].size(), 5)
+        self.assertTrue('batch' in self.app.zerovm_thread_pools)
+
     def test_QUERY_max_input_size(self):
         self.setup_zerovm_query()
         orig_maxinput = self.app.parser_config['limits']['rbytes']
@@ -20,6 +20,8 @@ from time import time
 from swift.common.middleware import proxy_logging
 from swift.common.memcached import MemcacheConnectionError
 from swift.common.swob import Request, HTTPUnauthorized, HTTPForbidden
+from swift.common.swob import Response, HTTPRequestTimeout, \
+    HTTPInternalServerError
 from hashlib import md5
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
@@ -45,8 +47,16 @@ from test.unit import connect_tcp, readuntil2crlfs, fake_http_connect, trim, \
 from zerocloud.common import CLUSTER_CONFIG_FILENAME
 from zerocloud.common import NODE_CONFIG_FILENAME
 from zerocloud.common import SwiftPath
+from zerocloud.common import ACCESS_READABLE
+from zerocloud.common import ACCESS_WRITABLE
+from zerocloud.common import ZvmChannel
+from zerocloud.common import parse_location
 from zerocloud.configparser import ClusterConfigParser, \
     ClusterConfigParsingError
+from zerocloud.configparser import ZvmNode
+from zerocloud.nameservice import StaticPortAllocator
+from zerocloud.thread_pool import AccountQuotas
+from zerocloud.thread_pool import PoolLoadTable
 
 
 ZEROVM_DEFAULT_MOCK = 'test/unit/zerovm_mock.py'
@@ -404,7 +414,8 @@ def do_setup(the_object_server):
                                'content-disposition, foo',
             'disable_fallocate': 'true',
             'allow_versions': 'True',
-            'zerovm_maxoutput': 1024 * 1024 * 10}
+            'zerovm_maxoutput': 1024 * 1024 * 10,
+            'zerovm_internal_key': 'secret'}
     prolis = listen(('localhost', 0))
     acc1lis = listen(('localhost', 0))
     acc2lis = listen(('localhost', 0))
@@ -955,6 +966,141 @@ class TestProxyQuery(unittest.TestCase, Utils):
         self.assertEqual(res.body, 'hello, world')
         self.check_container_integrity(prosrv, '/v1/a/c', {})
 
+    def test_QUERY_pool_load(self):
+        self.setup_QUERY()
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        nexe = trim(r'''
+            return 'hello, world'
+            ''')
+        self.create_object(prolis, '/v1/a/c/hello.nexe', nexe)
+        conf = json.dumps([
+            {
+                "name": "hello",
+                "exec": {"path": "swift://a/c/hello.nexe"},
+                "file_list": [
+                    {"device": "stdout"}
+                ]
+            }
+        ])
+        orig_pool_loads = _pqm.pool_loads
+        _pqm.pool_loads = PoolLoadTable()
+        try:
+            req = self.zerovm_request()
+            req.body = conf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'hello, world')
+            # load is taken from the final response of the object server
+            self.assertEqual(len(_pqm.pool_loads._waits), 1)
+        finally:
+            _pqm.pool_loads = orig_pool_loads
+
+    def test_QUERY_remote_fallback(self):
+        self.setup_QUERY()
+        prosrv = _test_servers[0]
+        ring = _pqm.app.get_object_ring(0)
+        primary, other = ring.devs[:2]
+
+        class BusyPrimary(PoolLoadTable):
+
+            def predicted_wait(self, node):
+                if node['device'] == primary['device']:
+                    return 10.0
+                return 0.0
+
+        conf = json.dumps([
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c/o'},
+                    {'device': 'stdout'}
+                ]
+            }
+        ])
+        devices = []
+
+        def spy_connect(ip, port, device, part, method, path,
+                        *args, **kwargs):
+            devices.append((device, method, path))
+            return orig_connect(ip, port, device, part, method, path,
+                                *args, **kwargs)
+
+        orig_pool_loads = _pqm.pool_loads
+        orig_remote_wait = _pqm.zerovm_remote_wait
+        _pqm.pool_loads = BusyPrimary()
+        _pqm.zerovm_remote_wait = 1.0
+        orig_create = proxyquery.ClusterController.\
+            _create_request_for_remote_object
+        try:
+            with save_globals(), \
+                    mock.patch.object(
+                        ring, 'get_part_nodes', return_value=[primary]), \
+                    mock.patch.object(
+                        ring, 'get_more_nodes',
+                        side_effect=lambda part: iter([other])), \
+                    mock.patch.object(
+                        proxyquery.ClusterController,
+                        '_create_request_for_remote_object',
+                        autospec=True, side_effect=orig_create) as remote:
+                orig_connect = proxyquery.http_connect
+                proxyquery.http_connect = spy_connect
+                req = self.zerovm_request()
+                req.body = conf
+                res = req.get_response(prosrv)
+                self.executed_successfully(res)
+                self.assertEqual(res.body, self.get_sorted_numbers())
+            # node runs on the server that does not hold the object
+            self.assertIn((other['device'], 'POST', '/a'), devices)
+            self.assertNotIn(primary['device'],
+                             [dev for dev, _junk, _junk in devices])
+            # and the object is sent to it from the proxy
+            paths = [call[0][2].path.path for call in remote.call_args_list]
+            self.assertIn('/a/c/o', paths)
+
+            controller = _pqm.get_controller('v1', 'a', None, None)
+            req = self.zerovm_request()
+
+            def make_node(**kwargs):
+                node = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'),
+                               **kwargs)
+                node.path_info = '/a/c/o'
+                node.access = 'GET'
+                return node
+
+            with mock.patch.object(
+                    ring, 'get_part_nodes', return_value=[primary]):
+                node = make_node()
+                ring_, partition, policy_index = \
+                    controller._remote_fallback(node, req)
+                self.assertEqual(ring_, ring)
+                self.assertEqual(partition, ring.get_part('a', 'c', 'o'))
+                self.assertEqual(policy_index, 0)
+                self.assertEqual(node.path_info, '/a')
+                self.assertEqual(node.access, '')
+                # write, replicated, co-located and networked nodes
+                # stay where they are
+                write = make_node()
+                write.access = 'PUT'
+                replicated = make_node(replicate=3)
+                colocated = make_node(location=parse_location('swift://a/c'))
+                connected = make_node()
+                connected.connect = ['merge']
+                bound = make_node()
+                bound.bind = ['merge']
+                for node in (write, replicated, colocated, connected, bound):
+                    self.assertIsNone(controller._remote_fallback(node, req))
+                    self.assertEqual(node.path_info, '/a/c/o')
+                # primary that is not busy keeps the node
+                _pqm.pool_loads = PoolLoadTable()
+                node = make_node()
+                self.assertIsNone(controller._remote_fallback(node, req))
+                self.assertEqual(node.access, 'GET')
+        finally:
+            _pqm.pool_loads = orig_pool_loads
+            _pqm.zerovm_remote_wait = orig_remote_wait
+
     def test_hello_with_policy(self):
         self.setup_QUERY()
         prolis = _test_sockets[0]
@@ -993,6 +1139,175 @@ class TestProxyQuery(unittest.TestCase, Utils):
         finally:
             _pqm.standalone_policies = _orig_policies
 
+    def test_priority_class(self):
+        req = Request.blank('/open/1.0/a/c/o')
+        self.assertEqual(_pqm.get_priority_class('open/1.0', req),
+                         'interactive')
+        req = Request.blank('/api/1.0/a/c/o')
+        self.assertEqual(_pqm.get_priority_class('api/1.0', req),
+                         'interactive')
+        req = self.zerovm_request()
+        self.assertEqual(_pqm.get_priority_class('v1/1.0', req), 'batch')
+        req.headers['x-zerovm-priority'] = 'Interactive'
+        self.assertEqual(_pqm.get_priority_class('v1/1.0', req),
+                         'interactive')
+        req.headers['x-zerovm-priority'] = 'cluster'
+        self.assertEqual(_pqm.get_priority_class('v1/1.0', req), 'batch')
+
+    def test_wave_backup_candidates(self):
+        node = ZvmNode(1, 'sort-12', parse_location('swift://a/c/exe'))
+        node.channels = [
+            ZvmChannel('stdin', ACCESS_READABLE,
+                       parse_location('swift://a/c/in')),
+            ZvmChannel('stdout', ACCESS_WRITABLE)]
+        self.assertEqual(proxyquery._node_group(node.name), 'sort')
+        self.assertTrue(proxyquery._is_idempotent(node))
+        node.channels.append(ZvmChannel('stderr', ACCESS_WRITABLE,
+                                        parse_location('swift://a/c/err')))
+        self.assertFalse(proxyquery._is_idempotent(node))
+        self.assertEqual(proxyquery._median([3.0, 1.0, 2.0]), 2.0)
+
+    def test_rerun_candidates(self):
+        node = ZvmNode(1, 'map-1', parse_location('swift://a/c/exe'))
+        self.assertTrue(proxyquery._is_independent(node))
+        node.bind = ['reduce-1']
+        self.assertFalse(proxyquery._is_independent(node))
+        resp = HTTPRequestTimeout()
+        self.assertTrue(proxyquery._server_failed(resp))
+        resp = HTTPInternalServerError(headers={'x-nexe-status': 'killed'})
+        self.assertFalse(proxyquery._server_failed(resp))
+        src = Response(body='abc')
+        spool = StringIO('abc')
+        spool.read()
+        proxyquery._replay_spools([(src, spool)], 2)
+        self.assertEqual(list(src.app_iter), ['ab', 'c'])
+        self.assertEqual(src.nodes, [])
+
+    def test_hedged_loser_closed(self):
+        conns = []
+
+        class SlowConnection(object):
+            closed = False
+
+            def getexpect(self):
+                sleep(10)
+
+            def close(self):
+                self.closed = True
+
+        def slow_connect(*args, **kwargs):
+            conns.append(SlowConnection())
+            return conns[-1]
+
+        with save_globals():
+            proxyquery.http_connect = slow_connect
+            controller = _pqm.get_controller('v1', 'a', None, None)
+            node = {'id': 0, 'ip': '127.0.0.1', 'port': 6000,
+                    'replication_ip': '127.0.0.1', 'device': 'sda1'}
+            attempt = spawn(controller._try_exec_node, node, 0,
+                            Request.blank('/a'), mock.Mock(size=0), {})
+            sleep(0)
+            attempt.link(proxyquery._close_hedged_conn)
+            attempt.kill()
+            self.assertEqual(len(conns), 1)
+            self.assertTrue(conns[0].closed)
+
+    def test_abandon_run(self):
+        controller = _pqm.get_controller('v1', 'a', None, None)
+        node = {'id': 0, 'ip': '127.0.0.1', 'port': 6000,
+                'replication_ip': '127.0.0.1', 'device': 'sda1'}
+        conn = mock.Mock(node=node, resp=None,
+                         cnode=ZvmNode(1, 'sort-1',
+                                       parse_location('swift://a/c/exe')))
+        pile = proxyquery.GreenPileEx()
+        pile.spawn(sleep, 10)
+        running = list(pile.pool.coroutines_running)
+        req = self.zerovm_request()
+        orig_cancel_jobs = _pqm.zerovm_cancel_jobs
+        _pqm.zerovm_cancel_jobs = True
+        try:
+            with mock.patch.object(controller, '_send_cancel') as cancel:
+                controller._abandon_run(req, pile, [conn])
+                sleep(0)
+                cancel.assert_called_once_with(node, ['sort-1'], req)
+        finally:
+            _pqm.zerovm_cancel_jobs = orig_cancel_jobs
+        self.assertTrue(running[0].dead)
+        conn.close.assert_called_once_with()
+
+    def test_internal_headers_stripped(self):
+        self.setup_QUERY()
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        self.create_object(prolis, '/v1/a/c/spilled', 'object data')
+        job_id = 'victim-job'
+        url = 'spill://map-1/reduce-1'
+        for device in ('sda1', 'sdb1'):
+            spill_dir = os.path.join(_testdir, device,
+                                     objectquery.SPILL_DIR_NAME, job_id)
+            mkdirs(spill_dir)
+            with open(os.path.join(
+                    spill_dir, objectquery._spill_file_name(url)), 'w') as fp:
+                fp.write('intermediate')
+        req = Request.blank('/v1/a/c/spilled',
+                            headers={'X-Zerovm-Spill': url,
+                                     'X-Zerocloud-Id': job_id,
+                                     'X-Zerovm-Signature': '0:junk'})
+        res = req.get_response(prosrv)
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(res.body, 'object data')
+        # cancel reaches the object servers as a plain object POST
+        req = Request.blank('/v1/a/c/spilled',
+                            environ={'REQUEST_METHOD': 'POST'},
+                            headers={'X-Zerovm-Cancel': job_id,
+                                     'X-Object-Meta-Test': 'yes'})
+        req.body = json.dumps(['map-1'])
+        res = req.get_response(prosrv)
+        self.assertEqual(res.status_int, 202)
+        req = Request.blank('/v1/a/c/spilled',
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        res = req.get_response(prosrv)
+        self.assertEqual(res.headers['x-object-meta-test'], 'yes')
+
+    def test_gang_header_stripped(self):
+        self.setup_QUERY()
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        nexe = trim(r'''
+            return 'hello, world'
+            ''')
+        self.create_object(prolis, '/v1/a/c/hello.nexe', nexe)
+        conf = json.dumps([
+            {
+                "name": "hello",
+                "exec": {"path": "swift://a/c/hello.nexe"},
+                "file_list": [
+                    {"device": "stdout"}
+                ]
+            }
+        ])
+        exec_headers = []
+
+        def spy_connect(ip, port, device, part, method, path,
+                        headers=None, *args, **kwargs):
+            exec_headers.append(headers)
+            return orig_connect(ip, port, device, part, method, path,
+                                headers, *args, **kwargs)
+
+        with save_globals():
+            orig_connect = proxyquery.http_connect
+            proxyquery.http_connect = spy_connect
+            req = self.zerovm_request()
+            # client cannot make a single node hold a cluster slot
+            req.headers['x-zerovm-gang'] = 'yes'
+            req.body = conf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'hello, world')
+        self.assertEqual(len(exec_headers), 1)
+        self.assertNotIn('x-zerovm-gang',
+                         [h.lower() for h in exec_headers[0]])
+
     def test_QUERY_hello_stderr(self):
         self.setup_QUERY()
         prolis = _test_sockets[0]
@@ -1685,25 +2000,35 @@ class TestProxyQuery(unittest.TestCase, Utils):
             }
         ]
         conf = json.dumps(conf)
-        req = self.zerovm_request()
-        req.body = conf
-        req.headers['x-zerovm-deferred'] = 'auto'
-        res = req.get_response(prosrv)
-        self.assertEqual(res.status_int, 200)
-        self.assertIn('swift://a/.zvm/', res.body)
-        url = res.body.strip()
-        from zerocloud.common import SwiftPath
-        path = SwiftPath(url)
-        req = self.object_request('/v1/%s/%s/%s' % (path.account,
-                                                    path.container,
-                                                    path.obj))
-        sleep(0.1)
-        res = req.get_response(prosrv)
-        self.assertEqual(res.status_int, 404)
-        sleep(1)
-        res = req.get_response(prosrv)
-        self.assertEqual(res.status_int, 200)
-        self.assertEqual(res.body, 'slept')
+        orig_quotas = _pqm.account_quotas
+        _pqm.account_quotas = AccountQuotas(max_nodes=1)
+        release_nodes = mock.Mock(wraps=_pqm.account_quotas.release_nodes)
+        _pqm.account_quotas.release_nodes = release_nodes
+        try:
+            req = self.zerovm_request()
+            req.body = conf
+            req.headers['x-zerovm-deferred'] = 'auto'
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertIn('swift://a/.zvm/', res.body)
+            url = res.body.strip()
+            from zerocloud.common import SwiftPath
+            path = SwiftPath(url)
+            req = self.object_request('/v1/%s/%s/%s' % (path.account,
+                                                        path.container,
+                                                        path.obj))
+            sleep(0.1)
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 404)
+            # deferred node still holds the node quota of the account
+            self.assertEqual(release_nodes.call_count, 0)
+            sleep(1)
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'slept')
+            self.assertEqual(release_nodes.call_count, 1)
+        finally:
+            _pqm.account_quotas = orig_quotas
         req = self.object_request('/v1/%s/%s/%s.headers' % (path.account,
                                                             path.container,
                                                             path.obj))
@@ -2037,6 +2362,97 @@ class TestProxyQuery(unittest.TestCase, Utils):
         self.assert_(re.match('tcp://127.0.0.1:\d+, /dev/out/%s' %
                               conf[1]['connect'][0], res.body))
 
+    def test_QUERY_network_static_ports(self):
+        self.setup_QUERY()
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stderr', 'path': 'swift://a/c/o2'}
+                ],
+                'connect': ['merge']
+            },
+            {
+                'name': 'merge',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stderr', 'path': 'swift://a/c/o3'}
+                ],
+                'connect': ['sort']
+            }
+        ]
+        jconf = json.dumps(conf)
+        prosrv = _test_servers[0]
+        _obj1srv = _test_servers[5]
+        _obj2srv = _test_servers[6]
+        orig_static_ports = _pqm.static_ports
+        try:
+            _pqm.static_ports = StaticPortAllocator((30000, 30009))
+            # object servers do not reserve any ports
+            req = self.zerovm_request()
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 400)
+            self.assertIn('is not reserved for ZeroVM', res.body)
+            self.assertEqual(_pqm.static_ports.used, {})
+
+            _obj1srv.zerovm_static_ports = (30000, 30009)
+            _obj2srv.zerovm_static_ports = (30000, 30009)
+            req = self.zerovm_request()
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            # ports are released when job is finished
+            self.assertEqual(_pqm.static_ports.used, {})
+
+            # and when the data cannot be sent to the nodes
+            req = self.zerovm_request()
+            req.body = jconf
+            with mock.patch.object(proxyquery.ClusterController,
+                                   '_spawn_file_senders',
+                                   side_effect=Exception('boom')):
+                res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 499)
+            self.assertEqual(_pqm.static_ports.used, {})
+
+            # both nodes run on the same host
+            _pqm.zerovm_static_ipc = True
+            req = self.zerovm_request()
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            req = self.object_request('/v1/a/c/o2')
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assert_(re.match('ipc:/tmp/zvm-ipc/[0-9a-f]+-\\d+-\\d+, '
+                                  '/dev/out/%s' % conf[0]['connect'][0],
+                                  res.body))
+            _pqm.zerovm_static_ipc = False
+            req = self.zerovm_request()
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+        finally:
+            _pqm.static_ports = orig_static_ports
+            _pqm.zerovm_static_ipc = False
+            _obj1srv.zerovm_static_ports = None
+            _obj2srv.zerovm_static_ports = None
+
+        req = self.object_request('/v1/a/c/o2')
+        res = req.get_response(prosrv)
+        self.assertEqual(res.status_int, 200)
+        self.assertIn('finished', res.body)
+        self.assert_(re.match('tcp://127.0.0.1:300\d\d, /dev/out/%s' %
+                              conf[0]['connect'][0], res.body))
+
+        req = self.object_request('/v1/a/c/o3')
+        res = req.get_response(prosrv)
+        self.assertEqual(res.status_int, 200)
+        self.assertIn('finished', res.body)
+        self.assert_(re.match('tcp://127.0.0.1:300\d\d, /dev/out/%s' %
+                              conf[1]['connect'][0], res.body))
+
     def test_QUERY_networked_devices(self):
         self.setup_QUERY()
         nexe = trim(r'''
@@ -2444,6 +2860,90 @@ class TestProxyQuery(unittest.TestCase, Utils):
         self.assertEqual(res.body, self.get_sorted_numbers(
             0, 10) + self.get_sorted_numbers(10, 20))
 
+    def test_QUERY_read_obj_wildcard_waves(self):
+        self.setup_QUERY()
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c_in1/in*'},
+                    {'device': 'stdout'}
+                ]
+            }
+        ]
+        jconf = json.dumps(conf)
+        prosrv = _test_servers[0]
+        try:
+            # one node at a time
+            _pqm.zerovm_wave_size = 1
+            req = self.zerovm_request()
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, self.get_sorted_numbers(
+                0, 10) + self.get_sorted_numbers(10, 20))
+            self.assertEqual(res.headers['x-nexe-system'], 'sort-1,sort-2')
+        finally:
+            _pqm.zerovm_wave_size = 0
+
+    def test_QUERY_read_obj_wildcard_delegated(self):
+        self.setup_QUERY()
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c_in1/in*'},
+                    {'device': 'stdout'}
+                ]
+            }
+        ]
+        jconf = json.dumps(conf)
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        orig_quotas = _pqm.account_quotas
+        try:
+            # each node is run by a delegate, here the same proxy
+            _pqm.zerovm_delegates = [('127.0.0.1', prolis.getsockname()[1])]
+            _pqm.zerovm_delegate_nodes = 1
+            _pqm.zerovm_delegate_key = 'secret'
+            _pqm.account_quotas = AccountQuotas(rate=100)
+            take_job = mock.Mock(wraps=_pqm.account_quotas.take_job)
+            _pqm.account_quotas.take_job = take_job
+            req = self.zerovm_request()
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, self.get_sorted_numbers(
+                0, 10) + self.get_sorted_numbers(10, 20))
+            self.assertEqual(res.headers['x-nexe-system'], 'sort-1,sort-2')
+            # signed partitions are not charged again
+            self.assertEqual(take_job.call_count, 1)
+            # partition that was not signed by a proxy
+            req = self.zerovm_request()
+            req.headers['x-zerovm-partition'] = \
+                '0:2:%d:digest:junk' % (time() + 60)
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 403)
+            self.assertEqual(take_job.call_count, 2)
+            # listing of the delegate resolves other objects
+            expires = int(time() + 60)
+            signature = proxyquery._partition_signature(
+                'secret', 0, 1, expires, 'other', jconf)
+            req = self.zerovm_request()
+            req.headers['x-zerovm-partition'] = '0:1:%d:other:%s' % (
+                expires, signature)
+            req.body = jconf
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 409)
+        finally:
+            _pqm.zerovm_delegates = []
+            _pqm.zerovm_delegate_nodes = 0
+            _pqm.zerovm_delegate_key = None
+            _pqm.account_quotas = orig_quotas
+
     def test_QUERY_read_container_wildcard(self):
         self.setup_QUERY()
         prolis = _test_sockets[0]
@@ -3241,6 +3741,118 @@ class TestProxyQuery(unittest.TestCase, Utils):
             self.assertEqual(dev, '/dev/python')
             self.assertEqual(path, tar)
 
+    def test_config_parser_combiner_tree(self):
+        pqm = proxyquery.ProxyQueryMiddleware(
+            self.proxy_app, {},
+            object_ring=FakeRing(), container_ring=FakeRing())
+        conf = [
+            {
+                'name': 'map',
+                'exec': {'path': 'swift://a/c/map'},
+                'file_list': [{'device': 'stdout'}],
+                'count': 10,
+                'connect': ['reduce'],
+                'combine': {
+                    'to': 'reduce',
+                    'fanin': 3,
+                    'exec': {'path': 'swift://a/c/combine'}
+                }
+            },
+            {
+                'name': 'reduce',
+                'exec': {'path': 'swift://a/c/reduce'},
+                'file_list': [{'device': 'stdout'}]
+            }
+        ]
+        parser = ClusterConfigParser(pqm.zerovm_sysimage_devices,
+                                     pqm.zerovm_content_type,
+                                     pqm.parser_config,
+                                     pqm.list_account,
+                                     pqm.list_container)
+        cluster_config = parser.parse(conf, False)
+        # 10 mappers -> 4 combiners -> 2 combiners -> reducer
+        self.assertEqual(cluster_config.total_count, 17)
+        nodes = cluster_config.nodes
+        self.assertEqual(len(nodes['reduce'].bind), 2)
+        self.assertEqual(nodes['map-1'].connect,
+                         [('map-combine1-1', '/dev/out/reduce')])
+        self.assertEqual(nodes['map-combine2-2'].connect,
+                         [('reduce', '/dev/out/reduce')])
+        for i in range(1, 5):
+            self.assertIn(len(nodes['map-combine1-%d' % i].bind), [2, 3])
+            self.assertEqual(nodes['map-combine1-%d' % i].exe.url,
+                             'swift://a/c/combine')
+
+        conf[0]['combine']['fanin'] = 10
+        cluster_config = parser.parse(conf, False)
+        self.assertEqual(cluster_config.total_count, 11)
+        self.assertEqual(len(cluster_config.nodes['reduce'].bind), 10)
+
+        conf[0]['combine']['fanin'] = 1
+        self.assertRaises(ClusterConfigParsingError,
+                          parser.parse, conf, False)
+        conf[0]['combine'] = {'to': 'map',
+                              'exec': {'path': 'swift://a/c/combine'}}
+        self.assertRaises(ClusterConfigParsingError,
+                          parser.parse, conf, False)
+
+    def test_config_parser_shuffle(self):
+        pqm = proxyquery.ProxyQueryMiddleware(
+            self.proxy_app, {},
+            object_ring=FakeRing(), container_ring=FakeRing())
+        conf = [
+            {
+                'name': 'map',
+                'exec': {'path': 'swift://a/c/map'},
+                'file_list': [{'device': 'stdout'}],
+                'count': 3,
+                'shuffle': ['reduce']
+            },
+            {
+                'name': 'reduce',
+                'exec': {'path': 'swift://a/c/reduce'},
+                'file_list': [{'device': 'stdout'}],
+                'count': 2
+            }
+        ]
+        parser = ClusterConfigParser(pqm.zerovm_sysimage_devices,
+                                     pqm.zerovm_content_type,
+                                     pqm.parser_config,
+                                     pqm.list_account,
+                                     pqm.list_container)
+        cluster_config = parser.parse(conf, False)
+        nodes = cluster_config.nodes
+        chan = nodes['map-2'].get_channel(device='out/reduce-1')
+        self.assertEqual(chan.path.url, 'spill://map-2/reduce-1')
+        self.assertEqual(chan.access, ACCESS_WRITABLE)
+        chan = nodes['reduce-1'].get_channel(device='in/map-2')
+        self.assertEqual(chan.path.url, 'spill://map-2/reduce-1')
+        self.assertEqual(chan.access, ACCESS_READABLE)
+        self.assertEqual(
+            [ch.device for ch in nodes['reduce-2'].get_list_of_remote_objects()
+             if ch.path.url.startswith('spill:')],
+            ['in/map-1', 'in/map-2', 'in/map-3'])
+        stages = cluster_config.get_stages()
+        self.assertEqual([s.nodes.keys() for s in stages],
+                         [['map-1', 'map-2', 'map-3'],
+                          ['reduce-1', 'reduce-2']])
+        self.assertEqual([s.total_count for s in stages], [3, 2])
+        self.assertEqual(stages[1].get_max_node_id(), 5)
+
+        # live connections cannot cross stages
+        conf[1]['connect'] = ['map']
+        self.assertRaises(ClusterConfigParsingError,
+                          parser.parse, conf, False)
+        del conf[1]['connect']
+        conf[1]['shuffle'] = 'map'
+        self.assertRaises(ClusterConfigParsingError,
+                          parser.parse, conf, False)
+        del conf[1]['shuffle']
+        conf[1]['file_list'].append({'device': 'output',
+                                     'path': 'spill://map-1/reduce-1'})
+        self.assertRaises(ClusterConfigParsingError,
+                          parser.parse, conf, False)
+
     def test_opaque_config(self):
 
         pqm = proxyquery.ProxyQueryMiddleware(
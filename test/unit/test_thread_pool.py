@@ -0,0 +1,646 @@
+import os
+import signal
+import subprocess
+import time
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from eventlet import sleep, spawn
+
+from swift.common.memcached import MemcacheConnectionError
+
+from zerocloud.thread_pool import AccountQuotas
+from zerocloud.thread_pool import AdaptivePool
+from zerocloud.thread_pool import ConnectHedging
+from zerocloud.thread_pool import CostModel
+from zerocloud.thread_pool import CpuSets
+from zerocloud.thread_pool import DeviceSlots
+from zerocloud.thread_pool import FairPool
+from zerocloud.thread_pool import HostLoad
+from zerocloud.thread_pool import JobSessions
+from zerocloud.thread_pool import MemoryBudget
+from zerocloud.thread_pool import PoolLoadTable
+from zerocloud.thread_pool import WaitPool
+from zerocloud.thread_pool import parse_pools
+
+
+class TestReservations(unittest.TestCase):
+
+    def test_reserve_release(self):
+        pool = WaitPool(2, 0)
+        first = pool.reserve('1', 10)
+        second = pool.reserve('2', 10)
+        self.assertNotEqual(first, None)
+        self.assertNotEqual(second, None)
+        self.assertEqual(pool.reserve('3', 10), None)
+        self.assertFalse(pool.can_spawn('3'))
+        # job that holds a reservation can always spawn
+        self.assertTrue(pool.can_spawn('2'))
+        pool.release(first)
+        self.assertTrue(pool.can_spawn('3'))
+
+    def test_reservation_expires(self):
+        pool = WaitPool(1, 0)
+        key = pool.reserve('1', -1)
+        self.assertNotEqual(key, None)
+        self.assertEqual(pool.reserved(), 0)
+        key = pool.reserve('2', -1)
+        pool.commit(key)
+        self.assertEqual(pool.reserved(), 1)
+        pool.release(key)
+        self.assertEqual(pool.reserved(), 0)
+
+
+class TestFairPool(unittest.TestCase):
+
+    def test_weighted_order(self):
+        pool = FairPool(1, 12, 'b:2')
+        order = []
+
+        def work(account):
+            sleep(0.001)
+            order.append(account)
+
+        threads = [pool.spawn_for('a', '1', work, 'a') for _i in range(6)]
+        threads += [pool.spawn_for('b', '1', work, 'b') for _i in range(6)]
+        self.assertEqual(pool.queue_depth(), 11)
+        self.assertEqual(pool.queue_depth('a'), 5)
+        self.assertEqual(pool.queue_depth('b'), 6)
+        for thrd in threads:
+            thrd.wait()
+        # first session of "a" started before "b" came,
+        # then "b" gets two slots for each slot of "a"
+        self.assertEqual(''.join(order), 'ababbabbabaa')
+        self.assertEqual(pool.queue_depth(), 0)
+        self.assertEqual(pool.free_slots(), 13)
+
+    def test_queue_share(self):
+        pool = FairPool(1, 4)
+        for job_id in ['1', '2', '3']:
+            self.assertTrue(pool.can_spawn(job_id, 'a'))
+            pool.spawn_for('a', job_id, sleep, 0.01)
+        # rest of the queue is left for other accounts
+        self.assertFalse(pool.can_spawn('4', 'a'))
+        self.assertTrue(pool.can_spawn('5', 'b'))
+        pool.spawn_for('b', '5', sleep, 0.01)
+        self.assertFalse(pool.can_spawn('6', 'b'))
+        self.assertTrue(pool.can_spawn('7', 'c'))
+        pool.spawn_for('c', '7', sleep, 0.01)
+        # queue is full
+        self.assertFalse(pool.can_spawn('8', 'd'))
+
+    def test_set_weight(self):
+        pool = FairPool(1, 1, 'a:3')
+        self.assertEqual(pool.weight('a'), 3.0)
+        self.assertEqual(pool.weight('b'), 1.0)
+        pool.set_weight('a', '0.5')
+        self.assertEqual(pool.weight('a'), 0.5)
+        self.assertRaises(ValueError, pool.set_weight, 'a', '0')
+        self.assertRaises(ValueError, FairPool, 1, 1, 'a:x')
+
+
+class TestEstimatedWait(unittest.TestCase):
+
+    def test_estimated_wait(self):
+        pool = WaitPool(2, 10)
+        self.assertEqual(pool.estimated_wait(), 0.0)
+        threads = [pool.spawn(str(i), sleep, 0.01) for i in range(2)]
+        for thrd in threads:
+            thrd.wait()
+        self.assertTrue(pool.service_time > 0.0)
+        self.assertEqual(pool.estimated_wait(), 0.0)
+        pool.service_time = 3.0
+        threads = [pool.spawn(str(i), sleep, 0.01) for i in range(2)]
+        # both slots are busy, next session waits for one of them
+        self.assertEqual(pool.estimated_wait(), 1.5)
+        for thrd in threads:
+            thrd.wait()
+
+    def test_load(self):
+        pool = WaitPool(2, 10)
+        pool.service_time = 2.0
+        self.assertEqual(pool.load(), '0 0 2 0.000')
+        threads = [pool.spawn(str(i), sleep, 0.01) for i in range(2)]
+        self.assertEqual(pool.load(), '2 0 2 1.000')
+        for thrd in threads:
+            thrd.wait()
+
+    def test_fair_pool_estimated_wait(self):
+        pool = FairPool(1, 10)
+        pool.service_time = 2.0
+        threads = [pool.spawn_for('a', '1', sleep, 0.01) for _i in range(3)]
+        self.assertEqual(pool.queued(), 2)
+        self.assertEqual(pool.estimated_wait(), 6.0)
+        for thrd in threads:
+            thrd.wait()
+        self.assertEqual(pool.estimated_wait(), 0.0)
+
+
+class FakeHostLoad(object):
+
+    def __init__(self):
+        self.load = 0.0
+        self.iowait = 0.0
+
+    def sample(self):
+        return self.load, self.iowait
+
+
+class TestAdaptivePool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = AdaptivePool(2, 8, 100)
+        self.pool.host_load = FakeHostLoad()
+
+    def run_sessions(self, count, run_time=0.001):
+        threads = [self.pool.spawn(str(i), sleep, run_time)
+                   for i in range(count)]
+        for thrd in threads:
+            thrd.wait()
+
+    def test_decrease_on_load(self):
+        self.assertEqual(self.pool.size(), 8)
+        self.pool.host_load.load = 2.0
+        # one decrease per average session run time
+        self.run_sessions(4, 0.01)
+        self.assertEqual(self.pool.size(), 6)
+        for _i in range(10):
+            self.pool._next_decrease = 0
+            self.run_sessions(1)
+        self.assertEqual(self.pool.size(), 2)
+
+    def test_decrease_on_iowait(self):
+        self.pool.host_load.iowait = 0.5
+        self.run_sessions(1)
+        self.assertEqual(self.pool.size(), 6)
+
+    def test_increase_when_full(self):
+        self.pool._resize(2)
+        self.assertEqual(self.pool.size(), 2)
+        # pool is not full, size stays the same
+        self.run_sessions(1)
+        self.assertEqual(self.pool.size(), 2)
+        self.run_sessions(20)
+        self.assertTrue(self.pool.size() > 2)
+        self.run_sessions(200)
+        self.assertEqual(self.pool.size(), 8)
+
+    def test_decrease_on_latency(self):
+        self.run_sessions(1)
+        self.assertEqual(self.pool.size(), 8)
+        self.pool._long_service_time = 0.0001
+        self.run_sessions(1, 0.01)
+        self.assertEqual(self.pool.size(), 6)
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, AdaptivePool, 0, 8)
+        self.assertRaises(ValueError, AdaptivePool, 8, 2)
+
+
+class TestHostLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.proc)
+
+    def write_proc(self, loadavg, stat):
+        with open(os.path.join(self.proc, 'loadavg'), 'w') as f:
+            f.write(loadavg)
+        with open(os.path.join(self.proc, 'stat'), 'w') as f:
+            f.write(stat)
+
+    def test_sample(self):
+        host = HostLoad(interval=0, proc=self.proc)
+        host._cpus = 2
+        self.write_proc('3.00 1.00 0.50 2/300 1234\n',
+                        'cpu  100 0 100 700 100 0 0 0 0 0\n')
+        self.assertEqual(host.sample(), (1.5, 0.0))
+        self.write_proc('0.50 1.00 0.50 7/300 1234\n',
+                        'cpu  150 0 150 750 150 0 0 0 0 0\n')
+        # run queue is bigger than load average
+        self.assertEqual(host.sample(), (3.0, 0.25))
+
+    def test_no_proc(self):
+        host = HostLoad(interval=0, proc=self.proc)
+        self.assertEqual(host.sample(), (0.0, 0.0))
+
+
+class TestReconfigure(unittest.TestCase):
+
+    def test_parse_pools(self):
+        self.assertEqual(
+            parse_pools('default = WaitPool(10,3); '
+                        'fair = FairPool(2, 3, AUTH_a:2);'),
+            [('default', WaitPool, ['10', '3']),
+             ('fair', FairPool, ['2', '3', 'AUTH_a:2'])])
+        for value in ['default = os(1)', 'default = HostLoad(1)',
+                      'default']:
+            self.assertRaises(ValueError, parse_pools, value)
+
+    def test_wait_pool(self):
+        pool = WaitPool(1, 10)
+        threads = [spawn(pool.spawn, str(i), sleep, 0.01)
+                   for i in range(4)]
+        sleep(0)
+        self.assertEqual((pool.running(), pool.queued()), (1, 3))
+        pool.reconfigure(4, 10)
+        sleep(0)
+        self.assertEqual((pool.running(), pool.queued()), (4, 0))
+        pool.reconfigure(1, 10)
+        # running sessions are not affected
+        self.assertEqual(pool.running(), 4)
+        for thrd in threads:
+            thrd.wait().wait()
+        self.assertEqual(pool._pool.free(), 1)
+
+    def test_fair_pool(self):
+        pool = FairPool(1, 10)
+        threads = [pool.spawn_for('a', '1', sleep, 0.01) for _i in range(4)]
+        self.assertEqual((pool.running(), pool.queued()), (1, 3))
+        pool.reconfigure(3, 10, 'a:2')
+        self.assertEqual((pool.running(), pool.queued()), (3, 1))
+        self.assertEqual(pool.weight('a'), 2.0)
+        pool.reconfigure(1, 10)
+        self.assertEqual(pool.weight('a'), 1.0)
+        for thrd in threads:
+            thrd.wait()
+        self.assertEqual((pool.running(), pool.queued()), (0, 0))
+
+    def test_adaptive_pool(self):
+        pool = AdaptivePool(2, 8, 10)
+        pool.reconfigure(1, 4, 10)
+        self.assertEqual(pool.size(), 4)
+        pool.reconfigure(6, 10, 10)
+        self.assertEqual(pool.size(), 6)
+        self.assertRaises(ValueError, pool.reconfigure, 4, 2)
+
+
+class TestDeviceSlots(unittest.TestCase):
+
+    def test_slots(self):
+        slots = DeviceSlots(1, 1)
+        self.assertEqual(slots.load('sda1'), '0 0 1')
+        slots.acquire('sda1')
+        self.assertTrue(slots.can_acquire('sda1'))
+        waiting = spawn(slots.acquire, 'sda1')
+        sleep(0)
+        self.assertEqual(slots.load('sda1'), '1 1 1')
+        self.assertFalse(slots.can_acquire('sda1'))
+        # other devices are not affected
+        self.assertTrue(slots.can_acquire('sdb1'))
+        slots.release('sda1')
+        waiting.wait()
+        self.assertEqual(slots.load('sda1'), '1 0 1')
+        slots.release('sda1')
+        self.assertEqual(slots.load('sda1'), '0 0 1')
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.proc)
+
+    def write_meminfo(self, meminfo):
+        with open(os.path.join(self.proc, 'meminfo'), 'w') as f:
+            f.write(meminfo)
+
+    def test_host_memory(self):
+        budget = MemoryBudget(interval=0, proc=self.proc)
+        self.write_meminfo('MemTotal:  16 kB\n'
+                           'MemFree:    2 kB\n'
+                           'MemAvailable: 12 kB\n')
+        self.assertEqual(budget.free(), 12288)
+        self.assertTrue(budget.commit(8192))
+        # committed but not used yet
+        self.assertEqual(budget.free(), 8192)
+        self.assertFalse(budget.commit(8193))
+        self.write_meminfo('MemTotal:  16 kB\n'
+                           'MemFree:    1 kB\n'
+                           'Buffers:    1 kB\n'
+                           'Cached:     2 kB\n')
+        self.assertEqual(budget.free(), 4096)
+        budget.release(8192)
+        self.assertEqual(budget.committed, 0)
+
+    def test_limit(self):
+        budget = MemoryBudget(10, proc=self.proc)
+        self.assertEqual(budget.free(), 10)
+        self.assertTrue(budget.commit(6))
+        self.assertFalse(budget.commit(6))
+        self.assertEqual(budget.free(), 4)
+        self.assertEqual(MemoryBudget(proc=self.proc).free(), None)
+
+    def test_workers_share_limit(self):
+        budget = MemoryBudget(10, proc=self.proc, workers=3)
+        self.assertEqual(budget.free(), 3)
+        self.assertFalse(budget.commit(4))
+        self.write_meminfo('MemTotal:  16 kB\n'
+                           'MemAvailable: 12 kB\n')
+        budget = MemoryBudget(interval=0, proc=self.proc, workers=4)
+        self.assertEqual(budget.free(), 4096)
+
+
+class TestCpuSets(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.sysfs)
+
+    def add_node(self, node, cpulist):
+        node_dir = os.path.join(self.sysfs, 'devices', 'system', 'node',
+                                'node%d' % node)
+        os.makedirs(node_dir)
+        with open(os.path.join(node_dir, 'cpulist'), 'w') as f:
+            f.write(cpulist)
+
+    def test_numa_nodes(self):
+        self.add_node(0, '0-2,6\n')
+        self.add_node(1, '3-5\n')
+        cpu_sets = CpuSets(2, sysfs=self.sysfs)
+        self.assertEqual(cpu_sets.free(), 7)
+        first = cpu_sets.acquire()
+        self.assertEqual(first, (0, [0, 1]))
+        # node with more free cpus is used
+        second = cpu_sets.acquire()
+        self.assertEqual(second, (1, [3, 4]))
+        third = cpu_sets.acquire()
+        self.assertEqual(third, (0, [2, 6]))
+        # sessions do not span nodes
+        self.assertEqual(cpu_sets.free(1), 1)
+        self.assertEqual(cpu_sets.acquire(), None)
+        cpu_sets.release(first)
+        self.assertEqual(cpu_sets.free(0), 2)
+        self.assertEqual(cpu_sets.acquire(), (0, [0, 1]))
+
+    def test_shared_claims(self):
+        self.add_node(0, '0-3\n')
+        claims = os.path.join(self.sysfs, 'claims')
+        os.makedirs(claims)
+        first = CpuSets(2, sysfs=self.sysfs, path=claims)
+        second = CpuSets(2, sysfs=self.sysfs, path=claims)
+        cpuset = first.acquire()
+        self.assertEqual(cpuset, (0, [0, 1]))
+        # other worker gets the other cpus
+        self.assertEqual(second.acquire(), (0, [2, 3]))
+        self.assertEqual(first.acquire(), None)
+        first.release(cpuset)
+        self.assertEqual(second.free(0), 2)
+        second.release((0, [2, 3]))
+        # claim of a worker that has died
+        with open(os.path.join(claims, 'cpu0'), 'w') as f:
+            f.write('999999999')
+        self.assertEqual(first.free(), 4)
+        self.assertEqual(os.listdir(claims), [])
+
+    def test_no_numa(self):
+        cpu_sets = CpuSets(1, sysfs=self.sysfs)
+        self.assertTrue(cpu_sets.free(0) > 0)
+        self.assertEqual(cpu_sets.acquire(), (0, [0]))
+        self.assertRaises(ValueError, CpuSets, 0)
+
+
+class TestPoolLoadTable(unittest.TestCase):
+
+    def node(self, ip):
+        return {'ip': ip, 'port': 6000, 'device': 'sda1'}
+
+    def test_order(self):
+        table = PoolLoadTable()
+        nodes = [self.node('10.0.0.%d' % i) for i in range(5)]
+        table.update(nodes[0], '4 6 4 3.000')
+        table.update(nodes[1], '4 2 4 1.000')
+        table.update(nodes[3], '4 9 4 5.000')
+        table.update(nodes[4], 'invalid')
+        table.update(nodes[4], None)
+        ordered = [n['ip'][-1] for n in table.order(iter(nodes), 3)]
+        # unknown servers keep ring order, handoffs go after primaries
+        self.assertEqual(ordered, ['2', '1', '0', '4', '3'])
+        ordered = [n['ip'][-1] for n in table.order(nodes, 0)]
+        self.assertEqual(ordered, ['2', '4', '1', '0', '3'])
+
+    def test_memory_short(self):
+        table = PoolLoadTable(half_life=1.0, memory=100)
+        nodes = [self.node('10.0.0.%d' % i) for i in range(3)]
+        table.update(nodes[0], '4 0 4 0.000', '99')
+        table.update(nodes[1], '4 6 4 3.000', '100')
+        table.update(nodes[2], None, 'invalid')
+        self.assertTrue(table.memory_short(nodes[0]))
+        self.assertFalse(table.memory_short(nodes[1]))
+        self.assertFalse(table.memory_short(nodes[2]))
+        ordered = [n['ip'][-1] for n in table.order(nodes, 0)]
+        self.assertEqual(ordered, ['2', '1', '0'])
+        # old report is forgotten
+        free, reported = table._memory[('10.0.0.0', 6000)]
+        table._memory[('10.0.0.0', 6000)] = (free, reported - 2.0)
+        self.assertFalse(table.memory_short(nodes[0]))
+
+    def test_decay(self):
+        table = PoolLoadTable(half_life=1.0)
+        node = self.node('10.0.0.1')
+        self.assertEqual(table.predicted_wait(node), 0.0)
+        table.update(node, '4 6 4 3.000')
+        wait, reported = table._waits[('10.0.0.1', 6000)]
+        table._waits[('10.0.0.1', 6000)] = (wait, reported - 2.0)
+        self.assertAlmostEqual(table.predicted_wait(node), 0.75, places=2)
+
+
+class TestConnectHedging(unittest.TestCase):
+
+    def test_delay(self):
+        hedging = ConnectHedging(90, min_samples=10)
+        for i in range(9):
+            hedging.record(0.01 * (i + 1))
+        self.assertEqual(hedging.delay(), None)
+        hedging.record(1.0)
+        self.assertEqual(hedging.delay(), 0.09)
+        hedging.record(2.0)
+        self.assertEqual(hedging.delay(), 1.0)
+        self.assertRaises(ValueError, ConnectHedging, 0)
+
+    def test_budget(self):
+        hedging = ConnectHedging(ratio=0.5, burst=2)
+        self.assertFalse(hedging.spend())
+        hedging.record(0.1)
+        self.assertFalse(hedging.spend())
+        hedging.record(0.1)
+        self.assertTrue(hedging.spend())
+        self.assertFalse(hedging.spend())
+        for _i in range(10):
+            hedging.record(0.1)
+        self.assertTrue(hedging.spend())
+        self.assertTrue(hedging.spend())
+        self.assertFalse(hedging.spend())
+
+
+class TestCostModel(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.testdir)
+
+    def test_estimate(self):
+        model = CostModel(window=20, min_samples=10)
+        self.assertFalse(model.record('swift://a/c/exe', 'bad line'))
+        self.assertFalse(model.record('swift://a/c/exe', '1.0, 0 0 0'))
+        for i in range(9):
+            self.assertTrue(model.record(
+                'swift://a/c/exe',
+                '%d.0, 0.5 0.5 1 %d 1 10 0 0 0 0' % (i + 1, i * 100)))
+        self.assertEqual(model.estimate('swift://a/c/exe'), None)
+        model.record('swift://a/c/exe', '10.0, 1.0 1.0 1 900 1 10 2 100 0 0')
+        estimate = model.estimate('swift://a/c/exe')
+        self.assertEqual(estimate['time'], (5.0, 10.0))
+        self.assertEqual(estimate['cpu'], (1.0, 2.0))
+        self.assertEqual(estimate['rbytes'], (400.0, 1000.0))
+        self.assertEqual(estimate['wbytes'], (10.0, 10.0))
+        # window drops the oldest samples
+        for i in range(20):
+            model.record('swift://a/c/exe', '0.5, 0 0 0 0 0 0 0 0 0 0')
+        self.assertEqual(model.estimate('swift://a/c/exe')['time'],
+                         (0.5, 0.5))
+        self.assertEqual(model.estimate('swift://a/c/other'), None)
+
+    def test_record_timeout(self):
+        model = CostModel(window=20, min_samples=10)
+        self.assertFalse(model.record_timeout('exe', 5.0))
+        for i in range(10):
+            model.record('exe', '1.0, 0.5 0.5 1 100 1 10 0 0 0 0')
+        self.assertEqual(model.estimate('exe')['time'], (1.0, 1.0))
+        # sessions given up after 3 seconds raise the estimate
+        for i in range(2):
+            self.assertTrue(model.record_timeout('exe', 3.0))
+        estimate = model.estimate('exe')
+        self.assertEqual(estimate['time'][1], 3.0)
+        self.assertEqual(estimate['rbytes'], (100.0, 100.0))
+
+    def test_max_keys(self):
+        model = CostModel(min_samples=1, max_keys=2)
+        model.record('a', '1.0, 0 0 0 0 0 0 0 0 0 0')
+        model.record('b', '2.0, 0 0 0 0 0 0 0 0 0 0')
+        model.record('a', '1.0, 0 0 0 0 0 0 0 0 0 0')
+        model.record('c', '3.0, 0 0 0 0 0 0 0 0 0 0')
+        self.assertTrue(model.estimate('a'))
+        self.assertEqual(model.estimate('b'), None)
+        self.assertTrue(model.estimate('c'))
+
+    def test_save(self):
+        path = os.path.join(self.testdir, 'cost.json')
+        model = CostModel(min_samples=1, path=path, save_interval=0)
+        self.assertFalse(model.save_due())
+        model.record('a', '1.0, 0.1 0.2 1 100 1 200 0 0 0 0')
+        self.assertTrue(model.save_due())
+        model.save()
+        self.assertFalse(model.save_due())
+        self.assertEqual(os.listdir(self.testdir), ['cost.json'])
+        model = CostModel(min_samples=1, path=path)
+        self.assertEqual(model.estimate('a')['wbytes'], (200.0, 200.0))
+        with open(path, 'w') as fp:
+            fp.write('garbage')
+        model = CostModel(min_samples=1, path=path)
+        self.assertEqual(model.estimate('a'), None)
+
+
+class FakeMemcache(object):
+
+    def __init__(self):
+        self.store = {}
+        self.down = False
+
+    def incr(self, key, delta=1, time=0):
+        if self.down:
+            raise MemcacheConnectionError()
+        self.store[key] = max(0, int(self.store.get(key, 0)) + delta)
+        return self.store[key]
+
+    def set(self, key, value, serialize=True, time=0):
+        if self.down:
+            raise MemcacheConnectionError()
+        self.store[key] = value
+
+
+class TestAccountQuotas(unittest.TestCase):
+
+    def test_rate(self):
+        memcache = FakeMemcache()
+        quotas = AccountQuotas(rate=10, burst=2)
+        self.assertEqual(quotas.take_job('a', memcache), None)
+        self.assertEqual(quotas.take_job('a', memcache), None)
+        wait = quotas.take_job('a', memcache)
+        self.assertTrue(0 < wait <= 0.1)
+        # other accounts have their own buckets
+        self.assertEqual(quotas.take_job('b', memcache), None)
+        sleep(0.11)
+        self.assertEqual(quotas.take_job('a', memcache), None)
+        self.assertTrue(quotas.take_job('a', memcache) > 0)
+
+    def test_nodes(self):
+        memcache = FakeMemcache()
+        quotas = AccountQuotas(max_nodes=5)
+        self.assertEqual(quotas.take_job('a', memcache), None)
+        self.assertTrue(quotas.take_nodes('a', 3, memcache))
+        self.assertFalse(quotas.take_nodes('a', 3, memcache))
+        self.assertEqual(memcache.store['zvmnodes/a'], 3)
+        quotas.release_nodes('a', 3, 2.0, memcache)
+        self.assertEqual(quotas.job_time, 2.0)
+        self.assertTrue(quotas.take_nodes('a', 5, memcache))
+
+    def test_no_memcache(self):
+        memcache = FakeMemcache()
+        memcache.down = True
+        quotas = AccountQuotas(max_nodes=2)
+        self.assertTrue(quotas.take_nodes('a', 2, memcache))
+        self.assertFalse(quotas.take_nodes('a', 1))
+        quotas.release_nodes('a', 2, 1.0)
+        self.assertTrue(quotas.take_nodes('a', 1, memcache))
+
+
+class TestJobSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_cancel(self):
+        sessions = JobSessions(self.path)
+        procs = [subprocess.Popen(['sleep', '10']) for _i in range(3)]
+        deadline = time.time() + 10
+        sessions.add('job1', 'map-1', procs[0].pid, deadline)
+        sessions.add('job1', 'map-2', procs[1].pid, deadline)
+        sessions.add('job2', 'map-1', procs[2].pid, deadline)
+        count, seconds = sessions.cancel('job1', ['map-1'])
+        self.assertEqual(count, 1)
+        self.assertTrue(9 < seconds < 10.01)
+        self.assertEqual(procs[0].wait(), -signal.SIGKILL)
+        self.assertFalse(sessions.remove('job1', procs[0].pid))
+        self.assertTrue(sessions.is_cancelled('job1', 'map-1'))
+        self.assertFalse(sessions.is_cancelled('job1', 'map-2'))
+        self.assertFalse(sessions.is_cancelled('job2', 'map-1'))
+        for proc in procs[1:]:
+            self.assertEqual(proc.poll(), None)
+            proc.kill()
+            proc.wait()
+        self.assertTrue(sessions.remove('job1', procs[1].pid))
+        self.assertTrue(sessions.remove('job2', procs[2].pid))
+        self.assertEqual(sessions.cancel('job2', ['map-1']), (0, 0.0))
+        self.assertRaises(ValueError, sessions.cancel, '../job', ['map-1'])
+
+    def test_expire(self):
+        sessions = JobSessions(self.path, ttl=10)
+        sessions.cancel('job1', ['map-1'])
+        mark = os.path.join(self.path, 'job1.cancelled')
+        os.utime(mark, (time.time() - 20, time.time() - 20))
+        sessions.cancel('job2', ['map-1'])
+        self.assertFalse(os.path.exists(mark))
+        self.assertFalse(sessions.is_cancelled('job1', 'map-1'))
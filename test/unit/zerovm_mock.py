@@ -192,6 +192,13 @@ for fname, device, type, tag, rd, rd_byte, wr, wr_byte \
             socks = [fname]
         for name in socks:
             proto, host, port = name.split(':')
+            if '.' in host:
+                # static address, assigned by proxy
+                if int(rd) > 0:
+                    bind_list.append([device, 'tcp://%s:%s' % (host, port)])
+                else:
+                    con_list.append([device, 'tcp://%s:%s' % (host, port)])
+                continue
             host = int(host)
             if int(rd) > 0:
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -210,6 +217,13 @@ for fname, device, type, tag, rd, rd_byte, wr, wr_byte \
                 connect_data += struct.pack('!IH', host, 0)
                 connect_count += 1
                 con_list.append(device)
+    elif fname.startswith('ipc:'):
+        # co-resident node, UNIX socket assigned by proxy
+        net_device = True
+        if int(rd) > 0:
+            bind_list.append([device, fname])
+        else:
+            con_list.append([device, fname])
     elif fname.startswith('opaque:'):
         net_device = True
         con_list.append([fname, device])
@@ -1,4 +1,11 @@
+from hashlib import sha1
+import hmac
 import re
+import time
+from urllib import quote
+from urllib import unquote
+
+from swift.common.utils import streq_const_time
 
 ACCESS_READABLE = 0x1
 ACCESS_WRITABLE = 0x1 << 1
@@ -19,6 +26,16 @@ DEVICE_MAP = {
     'script': ACCESS_RANDOM | ACCESS_READABLE,
 }
 
+# priority classes of the jobs, in order of priority
+PRIORITY_CLASSES = ['interactive', 'batch']
+
+# headers of the requests that only proxy sends to object servers,
+# they are removed from client requests
+INTERNAL_HEADERS = ['x-zerocloud-id', 'x-zerovm-cancel', 'x-zerovm-gang',
+                    'x-zerovm-signature', 'x-zerovm-spill']
+# seconds a signed internal request stays valid
+SIGNATURE_EXPIRES = 60
+
 CLUSTER_CONFIG_FILENAME = 'boot/cluster.map'
 NODE_CONFIG_FILENAME = 'boot/system.map'
 ACCOUNT_HOME_PATH = ['.', '~']
@@ -78,6 +95,40 @@ def split_path(path, minsegs=1, maxsegs=None, rest_with_last=False):
     return segs
 
 
+def sign_request(key, *parts):
+    """
+    Signs an internal request of proxy to object server
+
+    :param key: secret shared by proxies and object servers
+    :param parts: strings the signature covers, ex. job id
+    :returns value of `X-Zerovm-Signature` header
+    """
+    expires = int(time.time() + SIGNATURE_EXPIRES)
+    return '%d:%s' % (expires, _signature(key, expires, parts))
+
+
+def check_signature(key, value, *parts):
+    """
+    :param value: value of `X-Zerovm-Signature` header, can be None
+    :returns True if the request was signed with `key` and the signature
+             has not expired
+    """
+    if not key or not value:
+        return False
+    try:
+        expires, signature = value.split(':', 1)
+        expires = int(expires)
+    except ValueError:
+        return False
+    return expires >= time.time() and \
+        streq_const_time(signature, _signature(key, expires, parts))
+
+
+def _signature(key, expires, parts):
+    return hmac.new(key, '\n'.join([str(expires)] + map(str, parts)),
+                    sha1).hexdigest()
+
+
 def has_control_chars(line):
     if line:
         if re.search(RE_ILLEGAL, line):
@@ -179,6 +230,21 @@ class CachePath(ObjPath):
         self.path = '/%s/%s/%s' % (account, container, obj)
 
 
+class SpillPath(ObjPath):
+
+    def __init__(self, url):
+        (_junk, path) = url.split('spill:/')
+        ObjPath.__init__(self, url, path)
+        (producer, consumer) = split_path(path, 2)
+        self.producer = unquote(producer)
+        self.consumer = unquote(consumer)
+
+    @classmethod
+    def init(cls, producer, consumer):
+        return cls('spill://%s/%s' % (quote(producer, safe=''),
+                                      quote(consumer, safe='')))
+
+
 class NetPath(ObjPath):
 
     def __init__(self, url):
@@ -197,6 +263,8 @@ def parse_location(url):
         return ZvmPath(url)
     elif url.startswith('cache://'):
         return CachePath(url)
+    elif url.startswith('spill://'):
+        return SpillPath(url)
     elif url.startswith('tcp://') or url.startswith('udp://'):
         return NetPath(url)
     return None
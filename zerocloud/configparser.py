@@ -9,6 +9,7 @@ from copy import deepcopy
 
 from zerocloud.common import parse_location, ZvmPath
 from zerocloud.common import SwiftPath
+from zerocloud.common import SpillPath
 from zerocloud.common import ObjPath
 
 from zerocloud.common import ZvmChannel
@@ -31,7 +32,8 @@ CHANNEL_TYPE_MAP = {
     'debug': 0,
     'image': 3,
     'sysimage': 3,
-    'script': 3
+    'script': 3,
+    'spill': 0
 }
 ENV_ITEM = 'name=%s, value=%s\n'
 STD_DEVICES = ['stdin', 'stdout', 'stderr']
@@ -387,10 +389,23 @@ class ClusterConfigParser(object):
         if not self.nodes:
             raise ClusterConfigParsingError('Config parser cannot resolve '
                                             'any job nodes')
+        shuffles = []
+        for node in cluster_config:
+            shuffle = node.get('shuffle')
+            if shuffle:
+                shuffles.extend(self._add_shuffle(node.get('name'), shuffle))
+        self._assign_stages(shuffles)
         for node in cluster_config:
             connection_list = node.get('connect')
             node_name = node.get('name')
             src_devices = connect_devices.get(node_name, None)
+            combine = node.get('combine')
+            if combine:
+                self._add_combiner_tree(node_name, combine, account_name)
+                if connection_list:
+                    # tree replaces direct connections to the root
+                    connection_list = [n for n in connection_list
+                                       if n != combine.get('to')]
             if not connection_list:
                 if src_devices:
                     connection_list = [connected_node for connected_node in
@@ -410,6 +425,130 @@ class ClusterConfigParser(object):
 
         return ClusterConfig(self.nodes, self.total_count)
 
+    def _get_group(self, node_name):
+        if self.nodes.get(node_name):
+            return [self.nodes.get(node_name)]
+        group = []
+        node = self.nodes.get(_create_node_name(node_name, 1))
+        while node:
+            group.append(node)
+            node = self.nodes.get(
+                _create_node_name(node_name, len(group) + 1))
+        return group
+
+    def _add_combiner_tree(self, node_name, combine, account_name=None):
+        """
+        Connects group of nodes to one root node through a tree of combiners
+
+        Each combiner reads from at most `fanin` nodes of the previous level
+        and writes to one node of the next level, therefore the root reads
+        from at most `fanin` nodes. All nodes in the tree write to the same
+        device as if they were connected to the root directly.
+
+        :param node_name: name of the source node group
+        :param combine: "combine" stanza of the source node:
+                        {"to": root node name,
+                         "fanin": max number of inputs of each combiner,
+                         "exec": combiner executable, as for any node}
+
+        :raises ClusterConfigParsingError: on invalid "combine" stanza
+        """
+        root_name = combine.get('to')
+        root = self.nodes.get(root_name or '')
+        if not root:
+            raise ClusterConfigParsingError(
+                'Combiner tree for %s must end in a single node, got: %s'
+                % (node_name, root_name))
+        fanin = combine.get('fanin', 2)
+        if not isinstance(fanin, int) or fanin < 2:
+            raise ClusterConfigParsingError(
+                'Invalid combiner fanin: %s' % str(fanin))
+        level = self._get_group(node_name)
+        if not level:
+            raise ClusterConfigParsingError(
+                'Non existing node in combine stanza: %s' % node_name)
+        zvm_node = ZvmNode.fromdict({'name': '%s-combine' % node_name,
+                                     'exec': combine.get('exec')})
+        if isinstance(zvm_node.exe, SwiftPath):
+            zvm_node.exe.expand_account(account_name)
+        zvm_node.stage = root.stage
+        src_device = '/dev/out/%s' % root_name
+        depth = 0
+        while len(level) > fanin:
+            depth += 1
+            zvm_node.name = '%s-combine%d' % (node_name, depth)
+            # spread inputs evenly between combiners of the level
+            count = (len(level) + fanin - 1) / fanin
+            next_level = []
+            for i in range(count):
+                combiner = self._get_or_create_node(zvm_node, index=(i + 1))
+                start = i * len(level) / count
+                end = (i + 1) * len(level) / count
+                for node in level[start:end]:
+                    self._add_connection(node, combiner.name,
+                                         src_device=src_device)
+                next_level.append(combiner)
+            level = next_level
+        for node in level:
+            self._add_connection(node, root_name, src_device=src_device)
+
+    def _add_shuffle(self, node_name, shuffle):
+        """
+        Connects group of nodes to consumer groups through spill files
+
+        Each producer writes a separate partition for every consumer into
+        `/dev/out/<consumer>`, the partition is stored on the producer's
+        object server and later read by the consumer from
+        `/dev/in/<producer>`. Consumers run in the next stage of the job,
+        after all producers finished.
+
+        :param node_name: name of the producer node group
+        :param shuffle: list of consumer node group names
+
+        :returns list of (producer, consumer) node pairs
+        :raises ClusterConfigParsingError: on invalid "shuffle" stanza
+        """
+        if not isinstance(shuffle, list):
+            shuffle = [shuffle]
+        producers = self._get_group(node_name)
+        pairs = []
+        for consumer_name in shuffle:
+            consumers = self._get_group(consumer_name)
+            if not consumers:
+                raise ClusterConfigParsingError(
+                    'Non-existing node in shuffle %s' % consumer_name)
+            for producer in producers:
+                for consumer in consumers:
+                    if consumer is producer:
+                        raise ClusterConfigParsingError(
+                            'Cannot shuffle to itself: %s' % consumer.name)
+                    path = SpillPath.init(producer.name, consumer.name)
+                    producer.add_new_channel('out/%s' % consumer.name,
+                                             ACCESS_WRITABLE, path)
+                    consumer.add_new_channel('in/%s' % producer.name,
+                                             ACCESS_READABLE, path)
+                    pairs.append((producer, consumer))
+        return pairs
+
+    def _assign_stages(self, shuffles):
+        """
+        Assigns execution stage to each node, consumer of a shuffle runs
+        in a later stage than all of its producers
+
+        :param shuffles: list of (producer, consumer) node pairs
+
+        :raises ClusterConfigParsingError: if shuffles form a cycle
+        """
+        for _i in range(len(self.nodes) + 1):
+            changed = False
+            for producer, consumer in shuffles:
+                if consumer.stage <= producer.stage:
+                    consumer.stage = producer.stage + 1
+                    changed = True
+            if not changed:
+                return
+        raise ClusterConfigParsingError('Shuffle channels form a cycle')
+
     def _add_to_group(self, node_count, zvm_node, chan):
         for i in range(1, node_count + 1):
             new_node = self.nodes.get(_create_node_name(zvm_node.name, i))
@@ -445,6 +584,7 @@ class ClusterConfigParser(object):
             if bind_node is node:
                 raise ClusterConfigParsingError(
                     'Cannot bind to itself: %s' % bind_name)
+            _check_same_stage(node, bind_node)
             bind_node.bind.append((node.name, dst_device))
             if not src_device:
                 node.connect.append((bind_name,
@@ -457,6 +597,7 @@ class ClusterConfigParser(object):
             bind_node = self.nodes.get(bind_name + '-1')
             while bind_node:
                 if bind_node is not node:
+                    _check_same_stage(node, bind_node)
                     bind_node.bind.append((node.name, dst_device))
                     if not src_device:
                         node.connect.append(('%s-%d' % (bind_name, i),
@@ -614,6 +755,8 @@ class ClusterConfigParser(object):
             if ch_type is None:
                 if self.is_sysimage_device(device):
                     ch_type = CHANNEL_TYPE_MAP.get('sysimage')
+                elif isinstance(parse_location(ch['path']), SpillPath):
+                    ch_type = CHANNEL_TYPE_MAP.get('spill')
                 else:
                     continue
             access = ch['access']
@@ -799,6 +942,13 @@ def _add_connected_device(devices, channel, zvm_node):
         '/dev/' + channel.device, channel.path.device)
 
 
+def _check_same_stage(node, bind_node):
+    if node.stage != bind_node.stage:
+        raise ClusterConfigParsingError(
+            'Cannot connect %s and %s, they run in different stages'
+            % (node.name, bind_node.name))
+
+
 def _create_node_name(node_name, i):
     return '%s-%d' % (node_name, i)
 
@@ -833,6 +983,10 @@ def _create_channel(channel, node, default_content_type=None):
     if not device:
         raise ClusterConfigParsingError(
             'Must specify device for file in %s' % node.name)
+    if isinstance(path, SpillPath):
+        raise ClusterConfigParsingError(
+            'Spill path cannot be used for device %s in %s, '
+            'use shuffle stanza' % (device, node.name))
     access = DEVICE_MAP.get(device, 0)
     mode = channel.get('mode', None)
     meta = channel.get('meta', {})
@@ -873,6 +1027,7 @@ class ZvmNode(object):
         self.exe_name = exe_name
         self.data_in = False
         self.location = location or None
+        self.stage = 0
 
     @classmethod
     def fromdict(cls, node_config):
@@ -990,7 +1145,10 @@ class ZvmNode(object):
             # we assume exe is small and used by many jobs
             channels.append(ZvmChannel('boot', None, path=self.exe))
         for ch in self.channels:
-            if (isinstance(ch.path, SwiftPath)
+            if (isinstance(ch.path, SpillPath)
+                    and ch.access & ACCESS_READABLE):
+                channels.append(ch)
+            elif (isinstance(ch.path, SwiftPath)
                     and (ch.access & (ACCESS_READABLE | ACCESS_CDR))
                     # node is NOT co-located with this object
                     # path_info is None
@@ -1011,6 +1169,46 @@ class NodeEncoder(json.JSONEncoder):
 
 class ClusterConfig(object):
 
-    def __init__(self, nodes, total_count):
+    def __init__(self, nodes, total_count, node_count=None):
         self.nodes = nodes
         self.total_count = total_count
+        # replica ids are spaced by the node count of the whole job
+        self.node_count = node_count or len(nodes)
+
+    def get_max_node_id(self):
+        """
+        Gets the highest node id the job will use, including replicas
+
+        :returns int node id
+        """
+        if not self.nodes:
+            return 0
+        return self.node_count * max(n.replicate
+                                     for n in self.nodes.itervalues())
+
+    def rebase_node_ids(self, id_base):
+        """
+        Shifts ids of all nodes, must be called before connect strings
+        and replicas are created
+
+        :param id_base: value to add to each node id
+        """
+        for node in self.nodes.itervalues():
+            node.id += id_base
+
+    def get_stages(self):
+        """
+        Splits the job into stages connected by shuffle channels
+
+        :returns list of ClusterConfig objects, one per stage, in order
+                 of execution
+        """
+        stages = []
+        for node in self.nodes.itervalues():
+            while len(stages) <= node.stage:
+                stages.append(OrderedDict())
+            stages[node.stage][node.name] = node
+        return [ClusterConfig(nodes,
+                              sum(n.replicate for n in nodes.itervalues()),
+                              self.node_count)
+                for nodes in stages if nodes]
@@ -0,0 +1,681 @@
+import json
+import math
+import re
+import struct
+import time
+import uuid
+
+import greenlet
+from eventlet import GreenPool, sleep
+from eventlet.green import socket
+from swift.common.memcached import MemcacheConnectionError
+
+# INTEGER (4 bytes)
+INT_FMT = '!I'
+# INTEGER (4 bytes) + HOST (2 bytes)
+INPUT_RECORD_FMT = '!IH'
+# 4 bytes of string + HOST (2 bytes)
+OUTPUT_RECORD_FMT = '!4sH'
+INT_SIZE = struct.calcsize(INT_FMT)
+INPUT_RECORD_SIZE = struct.calcsize(INPUT_RECORD_FMT)
+OUTPUT_RECORD_SIZE = struct.calcsize(OUTPUT_RECORD_FMT)
+# peer id, bind count, connect count
+HEADER_FMT = '!III'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+LOOPBACK_ADDR = socket.inet_pton(socket.AF_INET, '127.0.0.1')
+# datagrams to send before yielding to other greenthreads
+SEND_BATCH = 64
+# thousands of peers register at once, kernel default buffer may drop some
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Peer ids of jobs served by the shared name service carry the job token
+# in the upper bits: TTTNNNNN (hex), where
+# - T is a job token, 12 bits
+# - N is a node id inside the job, 20 bits
+JOB_TOKEN_BITS = 12
+NODE_ID_BITS = 20
+
+JOB_TOKEN_LIMIT = 1 << JOB_TOKEN_BITS
+NODE_ID_LIMIT = 1 << NODE_ID_BITS
+
+
+def get_peer_id(message):
+    return struct.unpack_from(INT_FMT, message, 0)[0]
+
+
+def get_job_token(peer_id):
+    return peer_id >> NODE_ID_BITS
+
+
+class NameTable(object):
+    """Peer registrations of one networked job.
+
+    Each ZeroVM instance sends one packet with its own id, the list of ports
+    it has bound for incoming connections and the list of peers it wants to
+    connect to. When every peer of the job has registered, each of them gets
+    its packet back with the connect records resolved to IP+port.
+
+    Bind records are indexed by (bind peer, connecting peer), so resolving
+    one reply costs O(connect records of that peer). Replies are built once
+    and cached, peers that re-send their packet after the job was resolved
+    get only their own reply back.
+    """
+
+    def __init__(self, peers):
+        """
+        :param int peers:
+            Number of ZeroVM instances that will register in this table.
+        """
+        self.peers = peers
+        # (bind peer id, connecting peer id) -> port
+        self.ports = {}
+        # peer id -> (connect count, offset of connect records, packet)
+        self.conn_map = {}
+        # peer id -> (ip, port) of the peer
+        self.peer_map = {}
+        # peer id -> packed ip of the peer
+        self.packed_map = {}
+        # peer id -> resolved reply
+        self.reply_cache = {}
+        self.created = time.time()
+        self.resolved = None
+
+    def is_complete(self):
+        return len(self.peer_map) >= self.peers
+
+    def register(self, message, peer_address):
+        """
+        Stores peer registration packet
+
+        :param message: peer packet, as received from ZeroVM
+        :param peer_address: (ip, port) tuple the packet was sent from
+
+        :returns True if all peers of the job are registered
+        """
+        peer_id, bind_count, connect_count = \
+            struct.unpack_from(HEADER_FMT, message, 0)
+        offset = HEADER_SIZE
+        for i in range(bind_count):
+            connecting_host, port = struct.unpack_from(
+                INPUT_RECORD_FMT, message, offset)[0:2]
+            offset += INPUT_RECORD_SIZE
+            self.ports[(peer_id, connecting_host)] = port
+        self.conn_map[peer_id] = (connect_count, offset, message)
+        self.peer_map[peer_id] = (peer_address[0], peer_address[1])
+        self.packed_map[peer_id] = socket.inet_pton(socket.AF_INET,
+                                                    peer_address[0])
+        self.reply_cache.pop(peer_id, None)
+        return self.is_complete()
+
+    def get_reply(self, peer_id):
+        """
+        Resolves connect records of one registered peer
+
+        :param peer_id: id of the peer
+
+        :returns reply packet
+        """
+        reply = self.reply_cache.get(peer_id)
+        if reply:
+            return reply
+        (connect_count, offset, message) = self.conn_map[peer_id]
+        own_addr = self.packed_map[peer_id]
+        records = []
+        for i in range(connect_count):
+            connecting_host = struct.unpack_from(
+                INT_FMT, message, offset + i * INPUT_RECORD_SIZE)[0]
+            connect_to = self.packed_map[connecting_host]
+            if connect_to == own_addr:
+                # both on the same host
+                connect_to = LOOPBACK_ADDR
+            records.append(
+                struct.pack(OUTPUT_RECORD_FMT, connect_to,
+                            self.ports[(connecting_host, peer_id)]))
+        # output records have the same size as input ones, therefore
+        # reply is never larger than the packet the peer has sent
+        end = offset + connect_count * INPUT_RECORD_SIZE
+        reply = ''.join([message[:offset]] + records + [message[end:]])
+        self.reply_cache[peer_id] = reply
+        return reply
+
+    def replies(self):
+        """
+        Resolves connect records for all registered peers
+
+        :returns iterator of (reply, peer_address) tuples
+        """
+        for peer_id in self.peer_map.iterkeys():
+            yield self.get_reply(peer_id), self.peer_map[peer_id]
+
+    def send_replies(self, sock, message):
+        """
+        Registers peer packet and sends replies when the job is resolved
+
+        First resolution sends replies to all peers, yielding to other
+        greenthreads every `SEND_BATCH` datagrams. Later packets of the
+        same peers are answered with their own cached reply only.
+
+        :param sock: UDP socket to send replies from
+        :param message: (packet, peer_address) tuple from `recvfrom()`
+
+        :returns True if this packet has completed the table
+        """
+        packet, peer_address = message
+        was_complete = self.is_complete()
+        if not self.register(packet, peer_address):
+            return False
+        if was_complete:
+            peer_id = get_peer_id(packet)
+            sock.sendto(self.get_reply(peer_id), self.peer_map[peer_id])
+            return False
+        for i, (reply, address) in enumerate(self.replies()):
+            sock.sendto(reply, address)
+            if (i + 1) % SEND_BATCH == 0:
+                sleep()
+        return True
+
+
+class NameService(object):
+    """DNS-like server using a binary protocol.
+
+    This is usable only with ZeroMQ-based networking for ZeroVM, and not
+    zbroker.
+
+    DNS resolves names to IPs; this name service resolves IDs to IP+port.
+    """
+
+    # kept here for backward compatibility
+    INT_FMT = INT_FMT
+    INPUT_RECORD_FMT = INPUT_RECORD_FMT
+    OUTPUT_RECORD_FMT = OUTPUT_RECORD_FMT
+    INT_SIZE = INT_SIZE
+    INPUT_RECORD_SIZE = INPUT_RECORD_SIZE
+    OUTPUT_RECORD_SIZE = OUTPUT_RECORD_SIZE
+
+    def __init__(self, peers):
+        """
+        :param int peers:
+            Number of ZeroVM instances that will contact this name server.
+        """
+        self.port = None
+        self.hostaddr = None
+        self.peers = peers
+        self.sock = None
+        self.thread = None
+        self.table = NameTable(peers)
+        self.int_pool = GreenPool()
+
+    def start(self, pool):
+        """
+        :param pool:
+            `GreenPool` instance
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             RECV_BUFFER_SIZE)
+        # bind to any port, any address
+        self.sock.bind(('', 0))
+        self.thread = pool.spawn(self._run)
+        (self.hostaddr, self.port) = self.sock.getsockname()
+
+    def _run(self):
+        while 1:
+            try:
+                self.table.send_replies(self.sock,
+                                        self.sock.recvfrom(65535))
+            except greenlet.GreenletExit:
+                return
+            except Exception:
+                self._increment('name_service.errors')
+                if self.logger:
+                    self.logger.exception('ERROR in shared name service')
+
+    def stop(self):
+        self.thread.kill()
+        self.sock.close()
+
+
+class SharedNameServiceJob(object):
+    """Handle for a job registered in :class:`SharedNameService`.
+
+    Has the same `port` and `stop()` interface as :class:`NameService`,
+    so the proxy can use both in the same way.
+    """
+
+    def __init__(self, service, token, peers, ttl):
+        self.service = service
+        self.token = token
+        self.id_base = token << NODE_ID_BITS
+        self.table = NameTable(peers)
+        self.expires = self.table.created + ttl
+
+    @property
+    def port(self):
+        return self.service.port
+
+    @property
+    def hostaddr(self):
+        return self.service.hostaddr
+
+    def stop(self):
+        self.service.unregister_job(self.token)
+
+
+class SharedNameService(object):
+    """Name service shared by all networked jobs of one proxy worker.
+
+    Uses one UDP socket for all jobs. Every job gets a token that is stored
+    in the upper bits of the ids of its nodes, therefore the token can be
+    read from the peer id in the packet that ZeroVM sends. Job tables are
+    dropped when the job is finished or when they expire.
+    """
+
+    def __init__(self, job_ttl=60, port=0, sweep_interval=1.0, logger=None):
+        """
+        :param float job_ttl:
+            Seconds to keep a job table after the job was registered.
+        :param int port:
+            UDP port to bind to, 0 means any free port.
+        :param float sweep_interval:
+            Seconds between the checks for expired job tables.
+        :param logger:
+            Swift logger used to report metrics, can be None.
+        """
+        self.job_ttl = float(job_ttl)
+        self.bind_port = int(port)
+        self.sweep_interval = float(sweep_interval)
+        self.logger = logger
+        self.port = None
+        self.hostaddr = None
+        self.sock = None
+        self.thread = None
+        self.jobs = {}
+        self._last_token = 0
+        self._next_sweep = 0
+
+    def start(self, pool):
+        """
+        :param pool:
+            `GreenPool` instance
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # no SO_REUSEADDR: a datagram reaches only one of the sockets
+        # bound to a port, so second worker on a fixed port must fail
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             RECV_BUFFER_SIZE)
+        try:
+            self.sock.bind(('', self.bind_port))
+        except socket.error:
+            self.sock.close()
+            raise
+        self.sock.settimeout(self.sweep_interval)
+        self.thread = pool.spawn(self._run)
+        (self.hostaddr, self.port) = self.sock.getsockname()
+
+    def register_job(self, peers, max_node_id=None):
+        """
+        Registers a new job in the name service
+
+        :param peers: number of ZeroVM instances in the job
+        :param max_node_id: highest node id used by the job,
+                            defaults to `peers`
+
+        :returns SharedNameServiceJob or None if job cannot be registered
+        """
+        if (max_node_id or peers) >= NODE_ID_LIMIT:
+            return None
+        if len(self.jobs) >= JOB_TOKEN_LIMIT - 1:
+            self._expire_jobs()
+            if len(self.jobs) >= JOB_TOKEN_LIMIT - 1:
+                return None
+        token = self._last_token
+        while True:
+            # token 0 is never used, ids of jobs without
+            # shared name service start from 1
+            token = token % (JOB_TOKEN_LIMIT - 1) + 1
+            if token not in self.jobs:
+                break
+        self._last_token = token
+        job = SharedNameServiceJob(self, token, peers, self.job_ttl)
+        self.jobs[token] = job
+        return job
+
+    def unregister_job(self, token):
+        self.jobs.pop(token, None)
+
+    def _increment(self, metric):
+        if self.logger:
+            self.logger.increment(metric)
+
+    def _expire_jobs(self):
+        now = time.time()
+        self._next_sweep = now + self.sweep_interval
+        for token, job in self.jobs.items():
+            if job.expires < now:
+                del self.jobs[token]
+                self._increment('name_service.expired')
+
+    def _handle(self, message, peer_address):
+        job = self.jobs.get(get_job_token(get_peer_id(message)))
+        if not job:
+            self._increment('name_service.unknown_job')
+            return
+        self._increment('name_service.registrations')
+        if job.table.send_replies(self.sock, (message, peer_address)):
+            job.table.resolved = time.time()
+            if self.logger:
+                self.logger.timing_since('name_service.resolve_time',
+                                         job.table.created)
+
+    def _run(self):
+        while 1:
+            try:
+                try:
+                    message, peer_address = self.sock.recvfrom(65535)
+                except socket.timeout:
+                    self._expire_jobs()
+                    continue
+                self._handle(message, peer_address)
+                if time.time() >= self._next_sweep:
+                    self._expire_jobs()
+            except greenlet.GreenletExit:
+                return
+            except Exception:
+                self._increment('name_service.errors')
+                if self.logger:
+                    self.logger.exception('ERROR in shared name service')
+
+    def stop(self):
+        self.thread.kill()
+        self.sock.close()
+        self.jobs = {}
+
+
+# Static port mode: instead of the name service rendezvous, proxy assigns
+# host:port of every network channel before the job starts.
+# Node configs are sent with placeholders of the channel addresses, which
+# are replaced when the object servers for all nodes are known:
+# {b<bind node id>/<connect node id>} - bind channel,
+#   becomes tcp:0.0.0.0:port
+# {c<bind node id>/<connect node id>} - connect channel,
+#   becomes tcp:ip:port
+# Both become ipc:<path> when the nodes run on the same object server.
+STATIC_TOKEN_RE = re.compile(r'\{([bc])(\d+)/(\d+)\}')
+STATIC_BIND_ADDR = '0.0.0.0'
+# longest tcp replacement of a placeholder
+STATIC_ADDR_SIZE = len('tcp:255.255.255.255:65535')
+# UNIX sockets of co-resident nodes are created here
+STATIC_IPC_DIR = '/tmp/zvm-ipc'
+# longest ipc replacement of a placeholder, node ids are 32 bit
+STATIC_IPC_SIZE = len('ipc:%s/%s-%d-%d' % (STATIC_IPC_DIR, 'f' * 8,
+                                           2 ** 32, 2 ** 32))
+
+
+def parse_port_range(value):
+    """
+    Parses port range from the config string
+
+    :param value: string like '30000-30999'
+
+    :returns (first, last) tuple or None if the value is empty
+    :raises ValueError if the range is malformed
+    """
+    if not value or not value.strip():
+        return None
+    first, last = [int(p) for p in value.strip().split('-', 1)]
+    if not 0 < first <= last < 65536:
+        raise ValueError('Invalid port range: %s' % value)
+    return first, last
+
+
+def get_static_bind_ports(config):
+    """
+    Gets ports of the static bind channels from the node config
+
+    :param config: node config dict, as sent by proxy
+
+    :returns list of ports
+    """
+    ports = []
+    for channel in config.get('bind', []):
+        for url in channel.split(',', 1)[0].split(';'):
+            parts = url.split(':')
+            if (len(parts) == 3 and parts[0] == 'tcp'
+                    and parts[1] == STATIC_BIND_ADDR):
+                ports.append(int(parts[2]))
+    return ports
+
+
+def get_static_ipc_paths(config):
+    """
+    Gets paths of the UNIX sockets of the static bind channels
+
+    :param config: node config dict, as sent by proxy
+
+    :returns list of paths
+    """
+    paths = []
+    for channel in config.get('bind', []):
+        for url in channel.split(',', 1)[0].split(';'):
+            if url.startswith('ipc:'):
+                paths.append(url[len('ipc:'):])
+    return paths
+
+
+class StaticPortAllocator(object):
+    """Ports reserved for static networking on each object server.
+
+    Every object server reserves the same range of ports for ZeroVM
+    networking, proxy worker hands them out to jobs. Ports that were not
+    released in `ttl` seconds are considered free again.
+
+    The range is shared by all the workers of all the proxies, each
+    allocated port is also claimed in memcache, so no other worker hands
+    it out. Proxy worker keeps only its own ports when memcache is not
+    available.
+    """
+
+    def __init__(self, port_range, ttl=60):
+        """
+        :param port_range: (first, last) tuple
+        :param float ttl: seconds until allocated port is reclaimed
+        """
+        self.first, self.last = port_range
+        self.ttl = float(ttl)
+        # host -> {port: expiration time}
+        self.used = {}
+        # host -> next port to try
+        self.next_port = {}
+
+    def _key(self, host, port):
+        return 'zvmport/%s/%d' % (host, port)
+
+    def _claim(self, host, port, memcache):
+        """
+        :returns True if no other worker has the port
+        """
+        if not memcache:
+            return True
+        key = self._key(host, port)
+        try:
+            if memcache.incr(key, time=int(math.ceil(self.ttl))) == 1:
+                return True
+            memcache.decr(key)
+        except MemcacheConnectionError:
+            return True
+        return False
+
+    def allocate(self, host, memcache=None):
+        """
+        Allocates one port on the host
+
+        :param host: object server ip
+        :param memcache: `swift.common.memcached.MemcacheRing`, can be None
+
+        :returns port or None if all ports of the host are in use
+        """
+        now = time.time()
+        used = self.used.setdefault(host, {})
+        size = self.last - self.first + 1
+        if len(used) >= size:
+            for port, expires in used.items():
+                if expires < now:
+                    del used[port]
+            if len(used) >= size:
+                return None
+        port = self.next_port.get(host, self.first)
+        for _junk in xrange(size):
+            if port not in used and self._claim(host, port, memcache):
+                used[port] = now + self.ttl
+                self.next_port[host] = \
+                    port + 1 if port < self.last else self.first
+                return port
+            port = port + 1 if port < self.last else self.first
+        return None
+
+    def release(self, host, port, memcache=None):
+        used = self.used.get(host)
+        if used:
+            used.pop(port, None)
+            if not used:
+                del self.used[host]
+        if memcache:
+            try:
+                memcache.delete(self._key(host, port))
+            except MemcacheConnectionError:
+                pass
+
+
+class StaticPortMap(object):
+    """Static host:port assignment of one networked job.
+
+    Has the same `stop()` interface as :class:`NameService`.
+    If `ipc` is enabled, channels between nodes that run on the same
+    object server use UNIX sockets instead of TCP loopback and take
+    no ports.
+    """
+
+    def __init__(self, allocator, ipc=False, memcache=None):
+        """
+        :param allocator: :class:`StaticPortAllocator` instance
+        :param ipc: use UNIX sockets for co-resident nodes
+        :param memcache: memcache client the ports are claimed in,
+                         can be None
+        """
+        self.allocator = allocator
+        self.ipc = ipc
+        self.memcache = memcache
+        self.addr_size = STATIC_ADDR_SIZE
+        if ipc:
+            self.addr_size = max(STATIC_ADDR_SIZE, STATIC_IPC_SIZE)
+        # random part of the socket paths, unique for the job
+        self.ipc_key = uuid.uuid4().hex[:8]
+        # (bind node id, connect node id) -> port
+        self.ports = {}
+        # (bind node id, connect node id) pairs of co-resident nodes
+        self.ipc_pairs = set()
+        # node id -> object server ip
+        self.hosts = {}
+
+    def _template_channels(self, channels, node_id, kind):
+        result = []
+        for channel in channels:
+            urls, rest = channel.split(',', 1)
+            tmp = []
+            for url in urls.split(';'):
+                if url.startswith('tcp:'):
+                    peer_id = int(url.split(':')[1])
+                    if kind == 'b':
+                        pair = (node_id, peer_id)
+                    else:
+                        pair = (peer_id, node_id)
+                    self.ports[pair] = None
+                    url = '{%s%d/%d}' % ((kind,) + pair)
+                tmp.append(url)
+            result.append(','.join([';'.join(tmp), rest]))
+        return result
+
+    def template(self, node):
+        """
+        Creates node config with placeholders instead of channel addresses
+
+        :param node: ZvmNode with connect strings already built
+
+        :returns config string
+        """
+        config = json.loads(node.dumps())
+        config['bind'] = self._template_channels(
+            config.get('bind', []), node.id, 'b')
+        config['connect'] = self._template_channels(
+            config.get('connect', []), node.id, 'c')
+        return json.dumps(config)
+
+    def get_size(self, template):
+        """
+        Returns size of the rendered config, it's known in advance
+        """
+        size = len(template)
+        for match in STATIC_TOKEN_RE.finditer(template):
+            size += max(0, self.addr_size - len(match.group(0)))
+        return size
+
+    def assign(self, hosts):
+        """
+        Assigns ports to all network channels of the job
+
+        :param hosts: dict of node id -> object server ip
+
+        :returns True if all the ports were assigned
+        """
+        self.hosts = hosts
+        for bind_id, connect_id in self.ports.keys():
+            host = hosts.get(bind_id)
+            if self.ipc and host and host == hosts.get(connect_id):
+                self.ipc_pairs.add((bind_id, connect_id))
+                continue
+            port = None
+            if host and '.' in host:
+                port = self.allocator.allocate(host, self.memcache)
+            if not port:
+                self.stop()
+                return False
+            self.ports[(bind_id, connect_id)] = port
+        return True
+
+    def _render_token(self, match):
+        kind, bind_id, connect_id = match.groups()
+        pair = (int(bind_id), int(connect_id))
+        if pair in self.ipc_pairs:
+            return 'ipc:%s/%s-%d-%d' % ((STATIC_IPC_DIR, self.ipc_key) + pair)
+        if kind == 'b':
+            return 'tcp:%s:%d' % (STATIC_BIND_ADDR, self.ports[pair])
+        return 'tcp:%s:%d' % (self.hosts[pair[0]], self.ports[pair])
+
+    def render(self, template):
+        """
+        Replaces placeholders in the config, pads the result with spaces
+        to the size reported by `get_size()`
+
+        :param template: config string returned by `template()`
+
+        :returns config string
+        """
+        config = STATIC_TOKEN_RE.sub(self._render_token, template)
+        return config + ' ' * (self.get_size(template) - len(config))
+
+    def iter_render(self, template):
+        """
+        Renders config lazily, when the ports are already assigned
+
+        :returns iterator that yields one config string
+        """
+        yield self.render(template)
+
+    def stop(self):
+        for (bind_id, connect_id), port in self.ports.iteritems():
+            if port:
+                self.allocator.release(self.hosts[bind_id], port,
+                                       self.memcache)
+        self.ports = dict.fromkeys(self.ports)
+        self.ipc_pairs = set()
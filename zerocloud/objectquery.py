@@ -1,14 +1,17 @@
 from StringIO import StringIO
+import math
 import re
 import shutil
 import time
 import traceback
 import tarfile
 from contextlib import contextmanager
+from multiprocessing import cpu_count
 from hashlib import md5, sha1
 import hmac
 from tempfile import mkstemp
 from tempfile import mkdtemp
+from urllib import quote
 
 from eventlet.green import select
 from eventlet.green import subprocess
@@ -37,12 +40,14 @@ from swift.common.swob import HTTPInternalServerError
 from swift.common.swob import HeaderKeyDict
 from swift.common.swob import HTTPInsufficientStorage
 from swift.common.swob import HTTPMethodNotAllowed
+from swift.common.swob import HTTPForbidden
 from swift.common.swob import HTTPException
 from swift.common.utils import normalize_timestamp
 from swift.common.utils import get_logger
 from swift.common.utils import mkdirs
 from swift.common.utils import disable_fallocate
 from swift.common.utils import config_true_value
+from swift.common.utils import config_auto_int_value
 from swift.common.utils import hash_path
 from swift.common.utils import storage_directory
 from swift.common.utils import get_log_line
@@ -65,18 +70,25 @@ from zerocloud import MD5HASH_LENGTH
 from zerocloud.common import parse_location
 from zerocloud.common import ACCESS_NETWORK
 from zerocloud.common import ACCESS_RANDOM
+from zerocloud.common import PRIORITY_CLASSES
 from zerocloud import REPORT_VALIDATOR
 from zerocloud import REPORT_RETCODE
 from zerocloud import REPORT_ETAG
 from zerocloud import REPORT_CDR
 from zerocloud import REPORT_STATUS
 from zerocloud.common import SwiftPath
+from zerocloud.common import SpillPath
+from zerocloud.common import check_signature
 from zerocloud.common import ImagePath
 from zerocloud import REPORT_LENGTH
 from zerocloud import REPORT_DAEMON
 from zerocloud import load_server_conf
 from zerocloud import TIMEOUT_GRACE
 from zerocloud.configparser import ClusterConfigParser
+from zerocloud.nameservice import get_static_bind_ports
+from zerocloud.nameservice import get_static_ipc_paths
+from zerocloud.nameservice import STATIC_IPC_DIR
+from zerocloud.nameservice import parse_port_range
 from zerocloud.proxyquery import gunzip_iter
 from zerocloud.tarstream import UntarStream
 from zerocloud.tarstream import TarStream
@@ -92,13 +104,18 @@ except ImportError:
     import json
 
 CONT_DATADIR = 'containers'
+SPILL_DIR_NAME = 'zerovm-spill'
+# admin endpoint for thread pool configuration, local requests only
+THREADPOOLS_PATH = '/zerovm/threadpools'
+LOCAL_ADDRESSES = ['127.0.0.1', '::1']
 # mapping between return code and its message
 RETCODE_MAP = [
     'OK',              # [0]
     'Error',           # [1]
     'Timed out',       # [2]
     'Killed',          # [3]
-    'Output too long'  # [4]
+    'Output too long',  # [4]
+    'Cancelled'        # [5]
 ]
 
 
@@ -340,27 +357,74 @@ class ObjectQueryMiddleware(object):
         zerovm_sysimage_devices = get_zerovm_sysimage_devices(conf)
         # thread pools for advanced scheduling in proxy middleware
         self.zerovm_thread_pools = {}
-        threadpool_list = [i.strip()
-                           for i in
-                           conf.get('zerovm_threadpools',
-                                    self.DEFAULT_POOL_CONFIG).split(';')
-                           if i.strip()]
+        self.update_thread_pools(conf.get('zerovm_threadpools',
+                                          self.DEFAULT_POOL_CONFIG))
+        # file with thread pool configuration shared by all the workers,
+        # overrides zerovm_threadpools and is re-read when changed
+        self.zerovm_threadpools_file = conf.get('zerovm_threadpools_file')
+        # seconds between the checks of zerovm_threadpools_file
+        self.zerovm_threadpools_interval = float(
+            conf.get('zerovm_threadpools_interval', 5))
+        self._threadpools_mtime = None
+        self._threadpools_next_check = 0
+        self.check_thread_pools_file()
+
+        # ports reserved for ZeroVM networking on this node, proxy
+        # assigns them to jobs instead of using name server,
+        # must be the same as in proxy config
         try:
-            for pool in threadpool_list:
-                name, args = [i.strip() for i in pool.split('=')
-                              if i.strip()]
-                func, args = [i.strip(')') for i in args.split('(')
-                              if i.strip(')')]
-                args = [i.strip() for i in args.split(',')
-                        if i.strip()]
-                self.zerovm_thread_pools[name] = getattr(zpool, func)(*args)
+            self.zerovm_static_ports = parse_port_range(
+                conf.get('zerovm_static_ports'))
         except ValueError:
-            raise ValueError('Cannot parse "zerovm_threadpools" '
-                             'configuration variable')
-        if len(self.zerovm_thread_pools) < 1 or \
-                not self.zerovm_thread_pools.get('default', None):
-            raise ValueError('Invalid "zerovm_threadpools" '
+            raise ValueError('Cannot parse "zerovm_static_ports" '
                              'configuration variable')
+        if self.zerovm_static_ports and not os.path.exists(STATIC_IPC_DIR):
+            mkdirs(STATIC_IPC_DIR)
+        # seconds a slot is reserved for a node of networked job
+        # while proxy reserves slots for other nodes of the job
+        self.zerovm_reserve_lease = float(conf.get('zerovm_reserve_lease',
+                                                   10))
+        # maximum number of sessions that use one device at once,
+        # others are queued, 0 - no limit
+        self.zerovm_device_maxpool = int(conf.get('zerovm_device_maxpool', 0))
+        # maximum number of sessions in queue of one device
+        self.zerovm_device_maxqueue = int(conf.get('zerovm_device_maxqueue',
+                                                   3))
+        self.device_slots = None
+        if self.zerovm_device_maxpool > 0:
+            self.device_slots = zpool.DeviceSlots(self.zerovm_device_maxpool,
+                                                  self.zerovm_device_maxqueue)
+        # memory that sessions can commit, in bytes, `auto` - total memory
+        # of the host, 0 - no check
+        memory_limit = conf.get('zerovm_memory_limit', '0').strip()
+        # each worker commits its share of the limit, same default as in
+        # swift.common.wsgi
+        workers = config_auto_int_value(conf.get('workers'), cpu_count())
+        self.memory_budget = None
+        if memory_limit.lower() == 'auto':
+            self.memory_budget = zpool.MemoryBudget(workers=workers)
+        elif int(memory_limit) > 0:
+            self.memory_budget = zpool.MemoryBudget(memory_limit,
+                                                    workers=workers)
+        # number of cpus each session is pinned to, 0 - no pinning
+        zerovm_cpu_affinity = int(conf.get('zerovm_cpu_affinity', 0))
+        self.cpu_sets = None
+        if zerovm_cpu_affinity > 0:
+            # hardcoded dir for cpus claimed by sessions, shared by all the
+            # workers
+            cpus_dir = '/tmp/zvm-cpus'
+            if not os.path.exists(cpus_dir):
+                mkdirs(cpus_dir)
+            self.cpu_sets = zpool.CpuSets(zerovm_cpu_affinity,
+                                          path=cpus_dir)
+        # allocate memory of the session on the NUMA node of its cpus
+        self.zerovm_numa_membind = config_true_value(
+            conf.get('zerovm_numa_membind', 'no'))
+        # spill files of staged jobs older than this are removed, in seconds
+        self.zerovm_spill_ttl = int(conf.get('zerovm_spill_ttl', 3600))
+        # secret shared with proxies, spill and cancel requests must be
+        # signed with it, they are refused if not set, default - not set
+        self.zerovm_internal_key = conf.get('zerovm_internal_key')
 
         # hardcoded absolute limits for zerovm executable stdout
         # and stderr size
@@ -372,6 +436,11 @@ class ObjectQueryMiddleware(object):
         self.zerovm_sockets_dir = '/tmp/zvm-daemons'
         if not os.path.exists(self.zerovm_sockets_dir):
             mkdirs(self.zerovm_sockets_dir)
+        # hardcoded dir for running sessions, shared by all the workers
+        self.zerovm_sessions_dir = '/tmp/zvm-sessions'
+        if not os.path.exists(self.zerovm_sessions_dir):
+            mkdirs(self.zerovm_sessions_dir)
+        self.job_sessions = zpool.JobSessions(self.zerovm_sessions_dir)
 
         # for unit-tests
         self.fault_injection = conf.get('fault_injection', ' ')
@@ -437,7 +506,8 @@ class ObjectQueryMiddleware(object):
         finally:
             sock.close()
 
-    def execute_zerovm(self, zerovm_inputmnfst_fn, timeout, zerovm_args=None):
+    def execute_zerovm(self, zerovm_inputmnfst_fn, timeout, zerovm_args=None,
+                       nexe_headers=None, job_id=None):
         """
         Executes zerovm in a subprocess
 
@@ -445,16 +515,64 @@ class ObjectQueryMiddleware(object):
                                      can be a relative path
         :param zerovm_args: additional arguments passed to zerovm command line,
                             should be a list of str
+        :param nexe_headers: if set, the session is pinned to free cpus,
+                             if there are any, and they are reported in
+                             `x-nexe-cpus` header
+        :param job_id: if set, the session can be cancelled by
+                       `zerovm_cancel`, node name is taken from
+                       `x-nexe-system` header
 
         """
+        name = None
+        if job_id:
+            name = (nexe_headers or {}).get('x-nexe-system')
+            if self.job_sessions.is_cancelled(job_id, name):
+                # cancelled while it was queued
+                return 5, '', ''
         cmdline = []
+        cpuset = None
+        if self.cpu_sets and nexe_headers is not None:
+            cpuset = self.cpu_sets.acquire()
+            if cpuset:
+                node, cpus = cpuset
+                cpu_list = ','.join(str(cpu) for cpu in cpus)
+                if self.zerovm_numa_membind:
+                    cmdline += ['numactl', '--physcpubind=%s' % cpu_list,
+                                '--membind=%d' % node]
+                else:
+                    cmdline += ['taskset', '-c', cpu_list]
+                nexe_headers['x-nexe-cpus'] = \
+                    '%d:%s' % (node, ' '.join(str(cpu) for cpu in cpus))
+            else:
+                self.logger.increment('cpus.busy')
         cmdline += self.zerovm_exename
         if zerovm_args:
             cmdline += zerovm_args
         cmdline += [zerovm_inputmnfst_fn]
+        try:
+            return self._run_zerovm(cmdline, timeout, job_id, name)
+        finally:
+            if cpuset:
+                self.cpu_sets.release(cpuset)
+
+    def _run_zerovm(self, cmdline, timeout, job_id=None, name=None):
         proc = subprocess.Popen(cmdline,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
+        if not job_id:
+            return self._wait_zerovm(proc, timeout)
+        self.job_sessions.add(job_id, name, proc.pid, time.time() + timeout)
+        try:
+            retcode, stdout_data, stderr_data = \
+                self._wait_zerovm(proc, timeout)
+        finally:
+            running = self.job_sessions.remove(job_id, proc.pid)
+        if not running:
+            # killed by `zerovm_cancel`
+            retcode = 5
+        return retcode, stdout_data, stderr_data
+
+    def _wait_zerovm(self, proc, timeout):
 
         def get_final_status(stdout_data, stderr_data, return_code=None):
             (data1, data2) = proc.communicate()
@@ -597,7 +715,8 @@ class ObjectQueryMiddleware(object):
 
     def _create_zerovm_thread(self, zerovm_inputmnfst, zerovm_inputmnfst_fd,
                               zerovm_inputmnfst_fn, zerovm_valid,
-                              thrdpool, job_id, timeout):
+                              thrdpool, job_id, timeout, account=None,
+                              nexe_headers=None):
         while zerovm_inputmnfst:
             written = self.os_interface.write(zerovm_inputmnfst_fd,
                                               zerovm_inputmnfst)
@@ -605,8 +724,9 @@ class ObjectQueryMiddleware(object):
         zerovm_args = None
         if zerovm_valid:
             zerovm_args = ['-s']
-        thrd = thrdpool.spawn(job_id, self.execute_zerovm,
-                              zerovm_inputmnfst_fn, timeout, zerovm_args)
+        thrd = thrdpool.spawn_for(account, job_id, self.execute_zerovm,
+                                  zerovm_inputmnfst_fn, timeout, zerovm_args,
+                                  nexe_headers, job_id)
         return thrd
 
     def _create_exec_error(self, nexe_headers, zerovm_retcode,
@@ -622,6 +742,105 @@ class ObjectQueryMiddleware(object):
         _channel_cleanup(response_channels)
         return resp
 
+    def get_spill_dir(self, device, job_id):
+        if not re.match(r'^[\w-]+$', job_id or ''):
+            raise HTTPBadRequest(body='Invalid job id')
+        return os.path.join(self._diskfile_mgr.devices, device,
+                            SPILL_DIR_NAME, job_id)
+
+    def _store_spills(self, device, job_id, spill_channels):
+        """Move spill files written by ZeroVM session into the spill
+        directory of the job, and remove spill files of expired jobs.
+        """
+        spill_dir = self.get_spill_dir(device, job_id)
+        if not os.path.exists(spill_dir):
+            mkdirs(spill_dir)
+        for ch in spill_channels:
+            os.rename(ch['lpath'],
+                      os.path.join(spill_dir, _spill_file_name(ch['path'])))
+        spill_root = os.path.dirname(spill_dir)
+        expired = time.time() - self.zerovm_spill_ttl
+        for name in os.listdir(spill_root):
+            path = os.path.join(spill_root, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def zerovm_spill(self, req):
+        """Serve spill file stored by the previous stage of a job.
+
+        :param req:
+            :class:`swift.common.swob.Request` with `X-Zerovm-Spill` header
+            set to the spill url, `X-Zerocloud-Id` header set to the
+            job id and `X-Zerovm-Signature` header set by proxy
+        :returns:
+            :class:`swift.common.swob.Response`
+        """
+        if not check_signature(self.zerovm_internal_key,
+                               req.headers.get('x-zerovm-signature'),
+                               req.headers.get('x-zerocloud-id'),
+                               req.headers['x-zerovm-spill']):
+            raise HTTPForbidden(request=req, body='Spill request not signed')
+        device = req.path.split('/', 2)[1]
+        spill_path = parse_location(req.headers['x-zerovm-spill'])
+        if not isinstance(spill_path, SpillPath) or not device \
+                or device.startswith('.'):
+            raise HTTPBadRequest(body='Invalid spill request')
+        spill_file = os.path.join(
+            self.get_spill_dir(device, req.headers.get('x-zerocloud-id')),
+            _spill_file_name(spill_path.url))
+        try:
+            fp = open(spill_file, 'rb')
+        except IOError:
+            raise HTTPNotFound(request=req)
+        size = os.fstat(fp.fileno()).st_size
+
+        def file_iter(chunk_size):
+            try:
+                for chunk in iter(lambda: fp.read(chunk_size), ''):
+                    yield chunk
+            finally:
+                fp.close()
+
+        return Response(request=req,
+                        app_iter=file_iter(self.disk_chunk_size),
+                        content_length=size,
+                        content_type='application/octet-stream')
+
+    def zerovm_cancel(self, req):
+        """Kill running ZeroVM sessions of some nodes of a job, their
+        pool slots are freed right away. Sessions of these nodes that are
+        still queued are not started.
+
+        :param req:
+            :class:`swift.common.swob.Request` with `X-Zerovm-Cancel` header
+            set to the job id, json list of node names in the body and
+            `X-Zerovm-Signature` header set by proxy
+        :returns:
+            :class:`swift.common.swob.Response` with json object: number of
+            killed `sessions` and `seconds` they had left until timeout
+        """
+        if not check_signature(self.zerovm_internal_key,
+                               req.headers.get('x-zerovm-signature'),
+                               req.headers['x-zerovm-cancel'], req.body):
+            raise HTTPForbidden(request=req, body='Cancel request not signed')
+        try:
+            names = json.loads(req.body)
+            if not isinstance(names, list):
+                raise ValueError('List of node names expected')
+            sessions, seconds = self.job_sessions.cancel(
+                req.headers['x-zerovm-cancel'], names)
+        except (ValueError, TypeError):
+            raise HTTPBadRequest(request=req, body='Invalid cancel request')
+        if sessions:
+            self.logger.update_stats('cancel.sessions', sessions)
+            self.logger.update_stats('cancel.seconds', int(round(seconds)))
+        return Response(request=req, content_type='application/json',
+                        body=json.dumps({'sessions': sessions,
+                                         'seconds': round(seconds, 3)}))
+
     def get_writable_tmpdir(self, device):
         writable_tmpdir = os.path.join(self._diskfile_mgr.devices,
                                        device,
@@ -630,6 +849,115 @@ class ObjectQueryMiddleware(object):
             mkdirs(writable_tmpdir)
         return writable_tmpdir
 
+    def update_thread_pools(self, value):
+        """
+        Applies thread pool configuration. Pools of the same name and class
+        are changed in place, other pools are replaced, jobs that already
+        run in the replaced or removed pools are not affected.
+
+        :param value: configuration in `zerovm_threadpools` format
+
+        :raises ValueError if configuration is invalid
+        """
+        new_pools = {}
+        try:
+            for name, pool_class, args in zpool.parse_pools(value):
+                new_pools[name] = (pool_class(*args), args)
+        except (ValueError, TypeError):
+            raise ValueError('Cannot parse "zerovm_threadpools" '
+                             'configuration variable')
+        if not new_pools.get('default'):
+            raise ValueError('Invalid "zerovm_threadpools" '
+                             'configuration variable')
+        pools = {}
+        for name, (pool, args) in new_pools.iteritems():
+            old_pool = self.zerovm_thread_pools.get(name)
+            if type(old_pool) is type(pool):
+                old_pool.reconfigure(*args)
+                pool = old_pool
+            else:
+                pool.name = name
+                pool.logger = self.logger
+            pools[name] = pool
+        self.zerovm_thread_pools = pools
+        self.zerovm_threadpools_config = value
+
+    def check_thread_pools_file(self):
+        """
+        Re-reads `zerovm_threadpools_file` if it has changed
+        """
+        if not self.zerovm_threadpools_file:
+            return
+        now = time.time()
+        if now < self._threadpools_next_check:
+            return
+        self._threadpools_next_check = now + self.zerovm_threadpools_interval
+        try:
+            mtime = os.stat(self.zerovm_threadpools_file).st_mtime
+            if mtime == self._threadpools_mtime:
+                return
+            with open(self.zerovm_threadpools_file) as f:
+                value = f.read()
+        except (IOError, OSError):
+            # no file, configuration stays as it is
+            return
+        self._threadpools_mtime = mtime
+        try:
+            self.update_thread_pools(value)
+        except ValueError:
+            self.logger.exception('ERROR Cannot apply thread pools from %s'
+                                  % self.zerovm_threadpools_file)
+            return
+        self.logger.info('Thread pools updated: %s' % value.strip())
+
+    def zerovm_threadpools(self, req):
+        """
+        Shows thread pools on GET, changes their configuration on PUT.
+        New configuration is written to `zerovm_threadpools_file`,
+        other workers pick it up from there.
+        """
+        if req.remote_addr not in LOCAL_ADDRESSES:
+            return HTTPForbidden(request=req)
+        self.check_thread_pools_file()
+        if req.method == 'PUT':
+            if not self.zerovm_threadpools_file:
+                return HTTPBadRequest(request=req,
+                                      body='zerovm_threadpools_file '
+                                           'is not set')
+            value = req.body
+            try:
+                self.update_thread_pools(value)
+            except ValueError as exc:
+                return HTTPBadRequest(request=req, body=str(exc))
+            # rename is atomic, workers never read a partial file
+            dir_name = os.path.dirname(
+                os.path.abspath(self.zerovm_threadpools_file))
+            fd, tmp_name = mkstemp(dir=dir_name)
+            try:
+                try:
+                    while value:
+                        value = value[os.write(fd, value):]
+                finally:
+                    os.close(fd)
+                os.rename(tmp_name, self.zerovm_threadpools_file)
+            except (IOError, OSError):
+                os.unlink(tmp_name)
+                raise
+            self._threadpools_mtime = \
+                os.stat(self.zerovm_threadpools_file).st_mtime
+        elif req.method != 'GET':
+            return HTTPMethodNotAllowed(request=req)
+        pools = {}
+        for name, pool in self.zerovm_thread_pools.iteritems():
+            pools[name] = {'class': type(pool).__name__,
+                           'size': pool.size(),
+                           'running': pool.running(),
+                           'queued': pool.queued()}
+        return Response(request=req, content_type='application/json',
+                        body=json.dumps({
+                            'config': self.zerovm_threadpools_config,
+                            'pools': pools}))
+
     def zerovm_query(self, req):
         """Handle zerovm execution requests for the Swift Object Server.
 
@@ -778,13 +1106,84 @@ class ObjectQueryMiddleware(object):
                           access_type),
                     headers=nexe_headers)
 
+        self.check_thread_pools_file()
         pool = req.headers.get('x-zerovm-pool', 'default').lower()
+        priority = req.headers.get('x-zerovm-priority', '').lower()
+        if pool == 'default' and priority in PRIORITY_CLASSES \
+                and priority in self.zerovm_thread_pools:
+            # priority class has its own slots
+            pool = priority
         thrdpool = self.zerovm_thread_pools.get(pool, None)
         if not thrdpool:
             raise HTTPBadRequest(body='Cannot find pool %s' % pool,
                                  request=req, content_type='text/plain',
                                  headers=nexe_headers)
-        if not thrdpool.can_spawn(job_id):
+        # jobs are queued per account that submitted them
+        pool_account = req.headers.get('x-account-name', account)
+        if 'x-zerovm-weight' in req.headers:
+            try:
+                thrdpool.set_weight(pool_account,
+                                    req.headers['x-zerovm-weight'])
+            except ValueError:
+                raise HTTPBadRequest(body='Invalid x-zerovm-weight',
+                                     request=req, content_type='text/plain',
+                                     headers=nexe_headers)
+        timeout = int(req.headers.get(
+            'x-zerovm-timeout',
+            self.parser.parser_config['manifest']['Timeout']))
+        # proxy orders the servers by their load
+        nexe_headers['x-zerovm-pool-load'] = thrdpool.load()
+        wait = thrdpool.estimated_wait()
+        if wait > timeout:
+            # proxy will give up on this request before it can start,
+            # let it try another replica right now
+            self.logger.increment('pool.%s.shed' % pool)
+            headers = dict(nexe_headers)
+            headers['Retry-After'] = str(int(math.ceil(wait - timeout)))
+            raise HTTPServiceUnavailable(body='Slot not available '
+                                              'before deadline',
+                                         request=req,
+                                         content_type='text/plain',
+                                         headers=headers)
+        if self.device_slots:
+            # local object and temporary files are on the same device
+            if not self.device_slots.can_acquire(device):
+                self.logger.increment('device.%s.busy' % device)
+                headers = dict(nexe_headers)
+                headers['x-zerovm-device-load'] = \
+                    self.device_slots.load(device)
+                raise HTTPServiceUnavailable(body='Device is busy',
+                                             request=req,
+                                             content_type='text/plain',
+                                             headers=headers)
+        if self.memory_budget:
+            memory = self.parser.parser_config['manifest']['Memory']
+            if not self.memory_budget.commit(memory):
+                self.logger.increment('memory.short')
+                headers = dict(nexe_headers)
+                headers['x-zerovm-memory-free'] = \
+                    str(self.memory_budget.free())
+                raise HTTPServiceUnavailable(body='Not enough memory',
+                                             request=req,
+                                             content_type='text/plain',
+                                             headers=headers)
+            req.environ['zerovm.memory'] = (self.memory_budget, memory)
+            memory_free = self.memory_budget.free()
+            if memory_free is not None:
+                nexe_headers['x-zerovm-memory-free'] = str(memory_free)
+        reservation = None
+        if 'x-zerovm-gang' in req.headers:
+            # node of a networked job, the slot is held until proxy
+            # has reserved slots for all the nodes and starts sending data
+            reservation = thrdpool.reserve(job_id, self.zerovm_reserve_lease,
+                                           pool_account)
+            if reservation is None:
+                raise HTTPServiceUnavailable(body='Slot not available',
+                                             request=req,
+                                             content_type='text/plain',
+                                             headers=nexe_headers)
+            req.environ['zerovm.reservation'] = (thrdpool, reservation)
+        elif not thrdpool.can_spawn(job_id, pool_account):
             # if can_spawn() returned True it actually means
             # that spawn() will always succeed
             # unless something really bad happened
@@ -810,6 +1209,10 @@ class ObjectQueryMiddleware(object):
             untar_stream = UntarStream(read_iter)
             perf = "%.3f" % (time.time() - start)
             for chunk in read_iter:
+                if reservation:
+                    # whole gang is reserved, keep the slot until spawn
+                    thrdpool.commit(reservation)
+                    reservation = None
                 perf = "%s %.3f" % (perf, time.time() - start)
                 if req.body_file.position > rbytes:
                     raise HTTPRequestEntityTooLarge(
@@ -831,7 +1234,8 @@ class ObjectQueryMiddleware(object):
                             file_iter = gunzip_iter(
                                 untar_stream.untar_file_iter(),
                                 self.network_chunk_size)
-                        channels[fname] = os.path.join(zerovm_tmp, fname)
+                        channels[fname] = os.path.join(zerovm_tmp,
+                                                       quote(fname, safe=''))
                         with open(channels[fname], 'ab') as fp:
                             untar_stream.to_write = info.size
                             untar_stream.offset_data = info.offset_data
@@ -879,6 +1283,20 @@ class ObjectQueryMiddleware(object):
                                      body='No system map found in request')
 
             nexe_headers['x-nexe-system'] = config.get('name', '')
+            for port in get_static_bind_ports(config):
+                if not (self.zerovm_static_ports and
+                        self.zerovm_static_ports[0] <= port
+                        <= self.zerovm_static_ports[1]):
+                    raise HTTPBadRequest(
+                        request=req,
+                        body='Port %d is not reserved for ZeroVM' % port)
+            for path in get_static_ipc_paths(config):
+                if (not self.zerovm_static_ports
+                        or os.path.dirname(path) != STATIC_IPC_DIR
+                        or '..' in path):
+                    raise HTTPBadRequest(
+                        request=req,
+                        body='Socket %s is not allowed for ZeroVM' % path)
             # print json.dumps(config, indent=2)
             zerovm_nexe = None
             exe_path = parse_location(config['exe'])
@@ -907,6 +1325,7 @@ class ObjectQueryMiddleware(object):
                     and len(config.get('replicas', [])) < (replicate - 1):
                 is_master = False
             response_channels = []
+            spill_channels = []
             for ch in config['channels']:
                 chan_path = parse_location(ch['path'])
                 if ch['device'] in channels:
@@ -958,7 +1377,8 @@ class ObjectQueryMiddleware(object):
                 elif ch['access'] & (ACCESS_READABLE | ACCESS_CDR):
                     if not ch.get('lpath'):
                         if not chan_path or isinstance(chan_path, ImagePath) \
-                                or isinstance(chan_path, SwiftPath):
+                                or isinstance(chan_path, SwiftPath) \
+                                or isinstance(chan_path, SpillPath):
                             raise HTTPBadRequest(
                                 request=req,
                                 body='Could not resolve channel path "%s" for '
@@ -970,7 +1390,10 @@ class ObjectQueryMiddleware(object):
                     os.close(output_fd)
                     ch['lpath'] = output_fn
                     channels[ch['device']] = output_fn
-                    if is_master:
+                    if isinstance(chan_path, SpillPath):
+                        # stays on this server for the next stage
+                        spill_channels.append(ch)
+                    elif is_master:
                         if not chan_path:
                             response_channels.append(ch)
                         elif ch is not local_object.channel:
@@ -978,14 +1401,21 @@ class ObjectQueryMiddleware(object):
                 elif ch['access'] & ACCESS_NETWORK:
                     ch['lpath'] = chan_path.path
             config['colocated'] = colocated
-            timeout = int(req.headers.get(
-                'x-zerovm-timeout',
-                self.parser.parser_config['manifest']['Timeout']))
             with tmpdir.mkstemp() as (zerovm_inputmnfst_fd,
                                       zerovm_inputmnfst_fn):
                 (output_fd, nvram_file) = mkstemp()
                 os.close(output_fd)
                 start = time.time()
+                if self.device_slots:
+                    self.device_slots.acquire(device)
+                    req.environ['zerovm.device'] = (self.device_slots,
+                                                    device)
+                    self.logger.timing_since('device.%s.wait' % device,
+                                             start)
+                    nexe_headers['x-zerovm-device-load'] = \
+                        self.device_slots.load(device)
+                # reserved slot is taken by the session itself
+                _release_reservation(req)
                 if daemon_sock:
                     zerovm_inputmnfst = \
                         self.parser.prepare_for_forked(config, nvram_file,
@@ -996,8 +1426,10 @@ class ObjectQueryMiddleware(object):
                     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
                     try:
                         sock.connect(daemon_sock)
-                        thrd = thrdpool.spawn(job_id, self.send_to_socket,
-                                              sock, zerovm_inputmnfst, timeout)
+                        thrd = thrdpool.spawn_for(pool_account, job_id,
+                                                  self.send_to_socket,
+                                                  sock, zerovm_inputmnfst,
+                                                  timeout)
                     except IOError:
                         self._cleanup_daemon(daemon_sock)
                         sysimage_path = \
@@ -1029,7 +1461,8 @@ class ObjectQueryMiddleware(object):
                             zerovm_inputmnfst_fn,
                             zerovm_valid, thrdpool,
                             job_id,
-                            timeout)
+                            timeout,
+                            pool_account)
                         if thrd is None:
                             # something strange happened, let's log it
                             self.logger.warning('Slot not available after '
@@ -1055,7 +1488,8 @@ class ObjectQueryMiddleware(object):
                             resp = self._create_exec_error(nexe_headers,
                                                            zerovm_retcode,
                                                            zerovm_stdout,
-                                                           response_channels)
+                                                           response_channels +
+                                                           spill_channels)
                             return resp
                         else:
                             try:
@@ -1074,10 +1508,11 @@ class ObjectQueryMiddleware(object):
                                                 zerovm_inputmnfst)
                         try:
                             sock.connect(daemon_sock)
-                            thrd = thrdpool.spawn(job_id,
-                                                  self.send_to_socket,
-                                                  sock,
-                                                  zerovm_inputmnfst, timeout)
+                            thrd = thrdpool.spawn_for(pool_account, job_id,
+                                                      self.send_to_socket,
+                                                      sock,
+                                                      zerovm_inputmnfst,
+                                                      timeout)
                         except IOError:
                             raise HTTPInternalServerError(
                                 body='Cannot connect to daemon '
@@ -1097,7 +1532,9 @@ class ObjectQueryMiddleware(object):
                                                       zerovm_inputmnfst_fn,
                                                       zerovm_valid, thrdpool,
                                                       job_id,
-                                                      timeout)
+                                                      timeout,
+                                                      pool_account,
+                                                      nexe_headers)
                 if thrd is None:
                     # something strange happened, let's log it
                     self.logger.warning('Slot not available after '
@@ -1107,6 +1544,7 @@ class ObjectQueryMiddleware(object):
                                                  content_type='text/plain',
                                                  headers=nexe_headers)
                 (zerovm_retcode, zerovm_stdout, zerovm_stderr) = thrd.wait()
+                nexe_headers['x-zerovm-pool-load'] = thrdpool.load()
                 perf = "%.3f" % (time.time() - start)
                 if self.zerovm_perf:
                     self.logger.info("PERF SPAWN: %s" % perf)
@@ -1131,17 +1569,21 @@ class ObjectQueryMiddleware(object):
                         resp = self._create_exec_error(nexe_headers,
                                                        zerovm_retcode,
                                                        zerovm_stdout,
-                                                       response_channels)
+                                                       response_channels +
+                                                       spill_channels)
                         return resp
                 if zerovm_retcode > 1 or len(report) < REPORT_LENGTH:
                     resp = self._create_exec_error(nexe_headers,
                                                    zerovm_retcode,
                                                    zerovm_stdout,
-                                                   response_channels)
+                                                   response_channels +
+                                                   spill_channels)
                     return resp
 
                 self.logger.info('Zerovm CDR: %s'
                                  % nexe_headers['x-nexe-cdr-line'])
+                if spill_channels:
+                    self._store_spills(device, job_id, spill_channels)
 
                 response = Response(request=req)
                 if zerovm_retcode > 0:
@@ -1271,10 +1713,18 @@ class ObjectQueryMiddleware(object):
             res = HTTPPreconditionFailed(body='Invalid UTF8')
         else:
             try:
-                if 'x-zerovm-execute' in req.headers and req.method == 'POST':
+                if req.path_info == THREADPOOLS_PATH:
+                    res = self.zerovm_threadpools(req)
+                elif 'x-zerovm-execute' in req.headers \
+                        and req.method == 'POST':
                     res = self.zerovm_query(req)
                     self.logger.debug("zerovm_query: %(status)s",
                                       dict(status=res.status))
+                elif 'x-zerovm-spill' in req.headers and req.method == 'GET':
+                    res = self.zerovm_spill(req)
+                elif 'x-zerovm-cancel' in req.headers \
+                        and req.method == 'POST':
+                    res = self.zerovm_cancel(req)
                 elif req.method in ['PUT', 'POST'] \
                         and ('x-zerovm-validate' in req.headers
                              or req.headers.get('content-type', '')
@@ -1323,6 +1773,10 @@ class ObjectQueryMiddleware(object):
                                       ' %(path)s ',
                                       {'method': req.method, 'path': req.path})
                 res = HTTPInternalServerError(body=traceback.format_exc())
+            finally:
+                _release_reservation(req)
+                _release_device(req)
+                _release_memory(req)
         trans_time = time.time() - start_time
         if 'x-nexe-cdr-line' in res.headers:
             res.headers['x-nexe-cdr-line'] = '%.3f, %s' \
@@ -1568,6 +2022,29 @@ def _parse_zerovm_report(nexe_headers, report):
         nexe_headers['x-zerovm-daemon'] = daemon_status
 
 
+def _release_device(req):
+    device_slots, device = req.environ.pop('zerovm.device', (None, None))
+    if device_slots:
+        device_slots.release(device)
+
+
+def _release_memory(req):
+    memory_budget, memory = req.environ.pop('zerovm.memory', (None, 0))
+    if memory_budget:
+        memory_budget.release(memory)
+
+
+def _release_reservation(req):
+    thrdpool, reservation = req.environ.pop('zerovm.reservation',
+                                            (None, None))
+    if thrdpool:
+        thrdpool.release(reservation)
+
+
+def _spill_file_name(url):
+    return quote(url[len('spill://'):], safe='')
+
+
 def _channel_cleanup(response_channels):
     for ch in response_channels:
         try:
@@ -1,23 +1,30 @@
+from collections import deque
+from collections import OrderedDict
 from copy import deepcopy
-import ctypes
 from itertools import chain
 import logging
+import math
 import re
-import struct
 import traceback
 import time
 import datetime
+import hmac
+from tempfile import TemporaryFile
 from urllib import unquote
 import uuid
 from hashlib import md5
+from hashlib import sha1
 from random import randrange, choice
-import greenlet
 from eventlet import GreenPile
 from eventlet import GreenPool
 from eventlet import Queue
+from eventlet import spawn
 from eventlet import spawn_n
+from eventlet.greenthread import getcurrent
+from eventlet.queue import Empty
 from eventlet.green import socket
 from eventlet.timeout import Timeout
+from greenlet import GreenletExit
 import zlib
 
 from swift.common.storage_policy import POLICIES
@@ -30,6 +37,7 @@ from swift.common.http import is_success
 from swift.common.http import HTTP_INSUFFICIENT_STORAGE
 from swift.common.http import is_client_error
 from swift.common.http import HTTP_NOT_FOUND
+from swift.common.http import HTTP_REQUEST_TIMEOUT
 from swift.common.http import HTTP_REQUESTED_RANGE_NOT_SATISFIABLE
 from swift.proxy.controllers.base import update_headers
 from swift.proxy.controllers.base import delay_denial
@@ -44,10 +52,12 @@ from swift.common.utils import ContextPool
 from swift.common.utils import cache_from_env
 from swift.common.utils import normalize_timestamp
 from swift.common.utils import GreenthreadSafeIterator
+from swift.common.utils import streq_const_time
 from swift.proxy.server import ObjectController
 from swift.proxy.server import ContainerController
 from swift.proxy.server import AccountController
 from swift.common.bufferedhttp import http_connect
+from swift.common.bufferedhttp import http_connect_raw
 from swift.common.exceptions import ConnectionTimeout
 from swift.common.exceptions import ChunkReadTimeout
 from swift.common.constraints import check_utf8
@@ -59,6 +69,8 @@ from swift.common.constraints import MAX_META_COUNT
 from swift.common.constraints import MAX_META_OVERALL_SIZE
 from swift.common.swob import Request
 from swift.common.swob import Response
+from swift.common.swob import HTTPForbidden
+from swift.common.swob import HTTPConflict
 from swift.common.swob import HTTPNotFound
 from swift.common.swob import HTTPPreconditionFailed
 from swift.common.swob import HTTPRequestTimeout
@@ -72,8 +84,11 @@ from swift.common.swob import HTTPNotImplemented
 from swift.common.swob import HeaderKeyDict
 from swift.common.swob import HTTPException
 from zerocloud import load_server_conf
+from zerocloud.common import ACCESS_WRITABLE
 from zerocloud.common import CLUSTER_CONFIG_FILENAME
+from zerocloud.common import INTERNAL_HEADERS
 from zerocloud.common import NODE_CONFIG_FILENAME
+from zerocloud.common import PRIORITY_CLASSES
 from zerocloud import TAR_MIMES
 from zerocloud import POST_TEXT_OBJECT_SYSTEM_MAP
 from zerocloud import POST_TEXT_ACCOUNT_SYSTEM_MAP
@@ -83,10 +98,18 @@ from zerocloud import STREAM_CACHE_SIZE
 from zerocloud.common import parse_location
 from zerocloud import can_run_as_daemon
 from zerocloud.common import SwiftPath
+from zerocloud.common import SpillPath
+from zerocloud.common import sign_request
 from zerocloud.common import ImagePath
 from zerocloud import TIMEOUT_GRACE
+from zerocloud.configparser import ClusterConfig
 from zerocloud.configparser import ClusterConfigParser
 from zerocloud.configparser import ClusterConfigParsingError
+from zerocloud.nameservice import NameService
+from zerocloud.nameservice import SharedNameService
+from zerocloud.nameservice import StaticPortAllocator
+from zerocloud.nameservice import StaticPortMap
+from zerocloud.nameservice import parse_port_range
 from zerocloud.tarstream import StringBuffer
 from zerocloud.tarstream import UntarStream
 from zerocloud.tarstream import TarStream
@@ -96,6 +119,10 @@ from zerocloud.tarstream import NUL
 from zerocloud.tarstream import ExtractedFile
 from zerocloud.tarstream import Path
 from zerocloud.tarstream import ReadError
+from zerocloud.thread_pool import AccountQuotas
+from zerocloud.thread_pool import ConnectHedging
+from zerocloud.thread_pool import CostModel
+from zerocloud.thread_pool import PoolLoadTable
 from zerocloud.thread_pool import Zuid
 #from macholib.mach_o import unknown_command
 
@@ -109,6 +136,16 @@ except ImportError:
     import json
 
 STRIP_PAX_HEADERS = ['mtime']
+# nodes of a group that must finish before backup runs are started
+SPECULATION_MIN_RUNS = 3
+# seconds a delegated partition request stays valid
+PARTITION_EXPIRES = 60
+# client headers that are not passed to the delegates
+DELEGATE_HEADER_EXCLUSIONS = ['content-length', 'content-type', 'etag',
+                              'expect', 'host', 'transfer-encoding',
+                              'x-zerocloud-id', 'x-zerovm-partition',
+                              'x-zerovm-priority', 'x-zerovm-source',
+                              'x-zerovm-timeout']
 
 
 # Monkey patching Request to support content_type property properly
@@ -290,111 +327,6 @@ class FinalBody(object):
         self.app_iters.append(app_iter)
 
 
-class NameService(object):
-    """DNS-like server using a binary protocol.
-
-    This is usable only with ZeroMQ-based networking for ZeroVM, and not
-    zbroker.
-
-    DNS resolves names to IPs; this name service resolves IDs to IP+port.
-    """
-
-    # INTEGER (4 bytes)
-    INT_FMT = '!I'
-    # INTEGER (4 bytes) + HOST (2 bytes)
-    INPUT_RECORD_FMT = '!IH'
-    # 4 bytes of string + HOST (2 bytes)
-    OUTPUT_RECORD_FMT = '!4sH'
-    INT_SIZE = struct.calcsize(INT_FMT)
-    INPUT_RECORD_SIZE = struct.calcsize(INPUT_RECORD_FMT)
-    OUTPUT_RECORD_SIZE = struct.calcsize(OUTPUT_RECORD_FMT)
-
-    def __init__(self, peers):
-        """
-        :param int peers:
-            Number of ZeroVM instances that will contact this name server.
-        """
-        self.port = None
-        self.hostaddr = None
-        self.peers = peers
-        self.sock = None
-        self.thread = None
-        self.bind_map = {}
-        self.conn_map = {}
-        self.peer_map = {}
-        self.int_pool = GreenPool()
-
-    def start(self, pool):
-        """
-        :param pool:
-            `GreenPool` instance
-        """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # bind to any port, any address
-        self.sock.bind(('', 0))
-        self.thread = pool.spawn(self._run)
-        (self.hostaddr, self.port) = self.sock.getsockname()
-
-    def _run(self):
-        while 1:
-            try:
-                message, peer_address = self.sock.recvfrom(65535)
-                offset = 0
-                peer_id = struct.unpack_from(NameService.INT_FMT, message,
-                                             offset)[0]
-                offset += NameService.INT_SIZE
-                bind_count = struct.unpack_from(NameService.INT_FMT, message,
-                                                offset)[0]
-                offset += NameService.INT_SIZE
-                connect_count = struct.unpack_from(NameService.INT_FMT,
-                                                   message, offset)[0]
-                offset += NameService.INT_SIZE
-                for i in range(bind_count):
-                    connecting_host, port = struct.unpack_from(
-                        NameService.INPUT_RECORD_FMT, message, offset)[0:2]
-                    offset += NameService.INPUT_RECORD_SIZE
-                    self.bind_map.setdefault(peer_id, {})[connecting_host] = \
-                        port
-                self.conn_map[peer_id] = (connect_count,
-                                          offset,
-                                          ctypes.create_string_buffer(
-                                              message[:]))
-                # peer_address[0] == ip
-                self.peer_map.setdefault(peer_id, {})[0] = peer_address[0]
-                # peer_address[1] == port
-                self.peer_map.setdefault(peer_id, {})[1] = peer_address[1]
-
-                if len(self.peer_map) == self.peers:
-                    for peer_id in self.peer_map.iterkeys():
-                        (connect_count, offset, reply) = self.conn_map[peer_id]
-                        for i in range(connect_count):
-                            connecting_host = struct.unpack_from(
-                                NameService.INT_FMT, reply, offset)[0]
-                            port = self.bind_map[connecting_host][peer_id]
-                            connect_to = self.peer_map[connecting_host][0]
-                            if connect_to == self.peer_map[peer_id][0]:
-                                # both on the same host
-                                connect_to = '127.0.0.1'
-                            struct.pack_into(NameService.OUTPUT_RECORD_FMT,
-                                             reply, offset,
-                                             socket.inet_pton(socket.AF_INET,
-                                                              connect_to),
-                                             port)
-                            offset += NameService.OUTPUT_RECORD_SIZE
-                        self.sock.sendto(reply, (self.peer_map[peer_id][0],
-                                                 self.peer_map[peer_id][1]))
-            except greenlet.GreenletExit:
-                return
-            except Exception:
-                print traceback.format_exc()
-                pass
-
-    def stop(self):
-        self.thread.kill()
-        self.sock.close()
-
-
 class ProxyQueryMiddleware(object):
     def list_account(self, account, mask=None, marker=None, request=None):
         new_req = request.copy_get()
@@ -576,6 +508,120 @@ class ProxyQueryMiddleware(object):
         # name server thread pool size
         self.zerovm_ns_maxpool = int(conf.get('zerovm_ns_maxpool', 1000))
         self.zerovm_ns_thrdpool = GreenPool(self.zerovm_ns_maxpool)
+        # use one name server per proxy worker for all networked jobs,
+        # instead of starting a new name server for each job,
+        # default - False
+        self.zerovm_ns_shared = conf.get(
+            'zerovm_ns_shared', 'f').lower() in TRUE_VALUES
+        # shared name server UDP port, 0 - any free port
+        self.zerovm_ns_port = int(conf.get('zerovm_ns_port', 0))
+        # seconds to keep job tables in shared name server,
+        # default - zerovm_timeout plus grace time of a node
+        self.zerovm_ns_job_ttl = float(conf.get(
+            'zerovm_ns_job_ttl', self.zerovm_timeout + TIMEOUT_GRACE * 2))
+        self.shared_name_service = None
+        # ports reserved for ZeroVM networking on each object server,
+        # if set networked jobs use them instead of name server,
+        # default - not set
+        port_range = parse_port_range(conf.get('zerovm_static_ports'))
+        self.static_ports = None
+        if port_range:
+            self.static_ports = StaticPortAllocator(
+                port_range, ttl=self.zerovm_ns_job_ttl)
+        # connect nodes on the same object server through UNIX sockets,
+        # used only with static ports, default - False
+        self.zerovm_static_ipc = conf.get(
+            'zerovm_static_ipc', 'f').lower() in TRUE_VALUES
+        # max number of nodes of a job without networking that run at once,
+        # other nodes are sent when running ones finish, 0 - send all nodes
+        # at once, default - 0
+        self.zerovm_wave_size = int(conf.get('zerovm_wave_size', 0))
+        # object servers that reported less load are tried first, reported
+        # load is forgotten with this half-life in seconds, 0 - use ring
+        # order, default - 10
+        load_half_life = float(conf.get('zerovm_load_half_life', 10))
+        # memory one session commits on object servers, in bytes, servers
+        # that reported less free memory are tried last,
+        # default - 4 GiB, same as on object servers
+        self.zerovm_maxnexemem = int(conf.get('zerovm_maxnexemem',
+                                              4 * 1024 * 1048576))
+        self.pool_loads = None
+        if load_half_life > 0:
+            self.pool_loads = PoolLoadTable(load_half_life,
+                                            self.zerovm_maxnexemem)
+        # nodes that read an object run on other servers, and the object is
+        # sent to them, if all the servers that hold the object are expected
+        # to wait for a slot longer than this, in seconds, 0 - never,
+        # default - 0
+        self.zerovm_remote_wait = float(conf.get('zerovm_remote_wait', 0))
+        # wave jobs: a node that runs longer than this many times the median
+        # run time of its group is started once more on another server,
+        # 0 - never, default - 0
+        self.zerovm_speculation = float(conf.get('zerovm_speculation', 0))
+        # nodes without networking that have failed because their object
+        # server did not answer are run again on another server, uploaded
+        # job input up to this size is spooled for that, in bytes,
+        # 0 - never run again, default - 0
+        self.zerovm_rerun_spool = int(conf.get('zerovm_rerun_spool', 0))
+        # secret shared with object servers, used to sign spill and cancel
+        # requests, jobs with shuffle stages and cancelling need it,
+        # default - not set
+        self.zerovm_internal_key = conf.get('zerovm_internal_key')
+        # kill ZeroVM sessions on object servers when the job cannot
+        # finish anymore: client has disconnected, node has timed out or
+        # a node of a networked job has failed, default - False
+        self.zerovm_cancel_jobs = conf.get(
+            'zerovm_cancel_jobs', 'f').lower() in TRUE_VALUES
+        # run time and I/O of this many recent sessions of each executable
+        # are kept, 0 - do not keep, default - 0
+        cost_window = int(conf.get('zerovm_cost_window', 0))
+        self.cost_model = None
+        if cost_window > 0:
+            # samples are saved to this file and loaded from it on start,
+            # default - not saved
+            self.cost_model = CostModel(
+                cost_window, path=conf.get('zerovm_cost_file') or None,
+                save_interval=float(conf.get('zerovm_cost_save_interval',
+                                             60)))
+        # proxy waits for a node at most this many times the 95th
+        # percentile of the run time of its executable, plus the wait
+        # its server has reported, but never longer than node_timeout,
+        # 0 - always wait node_timeout, default - 0
+        self.zerovm_cost_timeout = float(conf.get('zerovm_cost_timeout', 0))
+        # jobs per second each account can start, 0 - no limit,
+        # default - 0
+        account_rate = float(conf.get('zerovm_account_rate', 0))
+        # nodes each account can run at once, 0 - no limit, default - 0
+        account_nodes = int(conf.get('zerovm_account_nodes', 0))
+        self.account_quotas = None
+        if account_rate > 0 or account_nodes > 0:
+            # jobs an idle account can start at once, default - 10
+            self.account_quotas = AccountQuotas(
+                account_rate, int(conf.get('zerovm_account_burst', 10)),
+                account_nodes)
+        # proxy servers, as `ip:port`, that run partitions of large jobs
+        # delegated by this proxy, default - not set
+        self.zerovm_delegates = []
+        for delegate in conf.get('zerovm_delegates', '').split():
+            host, port = delegate.rsplit(':', 1)
+            self.zerovm_delegates.append((host, int(port)))
+        # jobs without networking that have more nodes than this are split
+        # into partitions of this many nodes, each run by a delegate,
+        # 0 - never, default - 0
+        self.zerovm_delegate_nodes = int(conf.get('zerovm_delegate_nodes', 0))
+        # secret shared by the proxies to sign partition requests,
+        # delegation is disabled if not set, default - not set
+        self.zerovm_delegate_key = conf.get('zerovm_delegate_key')
+        # exec request of an interactive node is sent to one more server,
+        # if the first one has not answered in this percentile of the recent
+        # answer times, 0 - never, default - 0
+        hedge_percentile = float(conf.get('zerovm_hedge_percentile', 0))
+        self.hedging = None
+        if hedge_percentile > 0:
+            # share of exec requests that can be hedged, default - 0.05
+            self.hedging = ConnectHedging(
+                hedge_percentile,
+                float(conf.get('zerovm_hedge_ratio', 0.05)))
         # use newest files when running zerovm executables, default - False
         self.zerovm_uses_newest = conf.get(
             'zerovm_uses_newest', 'f').lower() in TRUE_VALUES
@@ -654,9 +700,36 @@ class ProxyQueryMiddleware(object):
         self.zerovm_daemons = self.parse_daemon_config(daemon_list)
         self.uid_generator = Zuid()
 
+    def get_shared_name_service(self):
+        """
+        Returns shared name server of this proxy worker,
+        starts it on first use
+
+        :returns SharedNameService instance
+        """
+        if not self.shared_name_service:
+            ns_server = SharedNameService(job_ttl=self.zerovm_ns_job_ttl,
+                                          port=self.zerovm_ns_port,
+                                          logger=self.app.logger)
+            try:
+                ns_server.start(self.zerovm_ns_thrdpool)
+            except socket.error:
+                # other worker has bound the port
+                self.app.logger.exception(
+                    'ERROR Cannot bind shared name service to port %d, '
+                    'non-zero zerovm_ns_port needs workers = 1'
+                    % self.zerovm_ns_port)
+                raise
+            self.shared_name_service = ns_server
+        return self.shared_name_service
+
     @wsgify
     def __call__(self, req):
         # self.logger.info("Call is invoked")
+        # only proxy can send these to object servers
+        for header in INTERNAL_HEADERS:
+            if header in req.headers:
+                del req.headers[header]
         try:
             version, account, container, obj = split_path(req.path, 1, 4, True)
         except ValueError:
@@ -700,6 +773,8 @@ class ProxyQueryMiddleware(object):
             # it will be used by QoS code to assign slots/priority
             req.headers['x-zerocloud-id'] = self.uid_generator.get()
             req.headers['x-zerovm-timeout'] = self.zerovm_timeout
+            req.headers['x-zerovm-priority'] = \
+                self.get_priority_class(exec_header_ver, req)
             #self.logger.info("controller found at 686")
             try:
                 res = handler(req)
@@ -716,6 +791,22 @@ class ProxyQueryMiddleware(object):
             return res
         return self.app
 
+    def get_priority_class(self, version, req):
+        """Priority class of the request, object servers can run
+        the jobs of each class in a separate thread pool.
+
+        :param version: zerocloud command and version, ex. `open/1.0`
+        :param req: client `swift.common.swob.Request`
+        :returns: one of `PRIORITY_CLASSES`
+        """
+        priority = req.headers.get('x-zerovm-priority', '').lower()
+        if priority in PRIORITY_CLASSES:
+            return priority
+        if version.split('/')[0] in ZEROVM_COMMANDS:
+            # REST calls are waited for by the user
+            return 'interactive'
+        return 'batch'
+
     def get_controller(self, version, account, container, obj):
         # self.logger.info("version{}".format(version))
         if version == 'open/1.0':
@@ -766,6 +857,10 @@ class ClusterController(ObjectController):
         self.cgi_env = None
         self.exe_resp = None
         self.cluster_config = ''
+        # object server of each node that has run, by node name
+        self.spill_locations = {}
+        # ((ip, port), node name) of the cancelled sessions
+        self.cancelled_nodes = set()
         # self.logger.info("Cluster controller Init at 762")
 
     def create_cgi_env(self, req):
@@ -814,6 +909,80 @@ class ClusterController(ObjectController):
                     break
         return addr
 
+    def _get_pool_weight(self, req):
+        """Weight of the account in fair-share pools of object servers,
+        set by the operator as `X-Account-Sysmeta-Zerovm-Weight`.
+
+        :param req: client `swift.common.swob.Request`
+        :returns: weight as a string, None if not set
+        """
+        info = get_info(self.app, req.environ.copy(), self.account_name)
+        if not info:
+            return None
+        return info.get('sysmeta', {}).get('zerovm-weight')
+
+    def _order_by_load(self, nodes, primaries):
+        """Order candidate servers by the load they reported.
+
+        :param nodes: iterator of object server node dicts
+        :param primaries: number of first nodes that hold the data
+        :returns: iterable of node dicts
+        """
+        if not self.middleware.pool_loads:
+            return nodes
+        return self.middleware.pool_loads.order(nodes, primaries)
+
+    def _remote_fallback(self, node, req):
+        """Move the node off the servers that hold its input object, if
+        all of them are expected to wait for a slot longer than
+        `zerovm_remote_wait` seconds, or so long that the node is not
+        expected to finish before `zerovm_timeout`, from the recent run
+        times of its executable. The node runs on the least loaded
+        of the other servers of the object partition, and the object is
+        sent to it like any other remote object.
+
+        :param node: :class:`zerocloud.configparser.ZvmNode` instance
+        :param req: client `swift.common.swob.Request`
+        :returns: (ring, partition, policy index) of the object if the node
+                  was moved, None otherwise
+        """
+        remote_wait = self.middleware.zerovm_remote_wait or None
+        if self.middleware.cost_model:
+            estimate = self.middleware.cost_model.estimate(_exe_key(node))
+            # node that runs longer than the timeout anyway is not moved
+            if estimate and \
+                    estimate['time'][1] < self.middleware.zerovm_timeout:
+                remote_wait = min(remote_wait or float('inf'),
+                                  self.middleware.zerovm_timeout
+                                  - estimate['time'][1])
+        if remote_wait is None or not self.middleware.pool_loads:
+            return None
+        # output must be written where the object lives, networked and
+        # co-located nodes must stay where the other nodes expect them
+        if node.access != 'GET' or node.replicate > 1 or node.location \
+                or node.connect or node.bind:
+            return None
+        account, container, obj = split_path(node.path_info, 1, 3, True)
+        if not obj:
+            return None
+        container_info = self.container_info(account, container, req)
+        policy_index = container_info['storage_policy']
+        ring = self.app.get_object_ring(policy_index)
+        partition = ring.get_part(account, container, obj)
+        wait = min(self.middleware.pool_loads.predicted_wait(n)
+                   for n in ring.get_part_nodes(partition))
+        if wait <= remote_wait:
+            return None
+        self.app.logger.info('Running %s away from %s, expected wait %.3f'
+                             % (node.name, node.path_info, wait))
+        node.path_info = '/%s' % self.account_name
+        node.access = ''
+        return ring, partition, policy_index
+
+    def _update_pool_load(self, node, load, memory_free=None):
+        if self.middleware.pool_loads:
+            self.middleware.pool_loads.update(node, load, memory_free)
+
     def _make_exec_requests(self, pile, exec_requests):
         """Make execution request connections and start the execution.
 
@@ -872,11 +1041,9 @@ class ClusterController(ObjectController):
                 # for running the job.
 
                 node_iter = GreenthreadSafeIterator(
-                    self.iter_nodes_local_first(ring,
-                                                partition))
-
-                for item in node_iter:
-                    self.logger.info("878: node_info{}".format(item))
+                    self._order_by_load(
+                        self.iter_nodes_local_first(ring, partition),
+                        len(ring.get_part_nodes(partition))))
                 # If the storage-policy-index was not set, we set it.
                 # Why does swift need this to be set?
                 # Because the object servers don't know about policies.
@@ -894,21 +1061,44 @@ class ClusterController(ObjectController):
                 # Same as above: ``node_iter`` is the all of the candidate
                 # container servers for running the job.
                 node_iter = GreenthreadSafeIterator(
-                    self.app.iter_nodes(ring, partition))
+                    self._order_by_load(
+                        self.app.iter_nodes(ring, partition),
+                        len(ring.get_part_nodes(partition))))
                 # NOTE: Containers have no storage policies. See the `obj`
                 # block above.
+            elif exec_request.remote_source:
+                # Input object is sent from the proxy, see
+                # `_remote_fallback`, run on any server but the busy ones
+                # that hold the object.
+                ring, partition, policy_index = exec_request.remote_source
+                primaries = ring.get_part_nodes(partition)
+                node_iter = GreenthreadSafeIterator(
+                    self._order_by_load(
+                        (n for n in self.app.iter_nodes(ring, partition)
+                         if n not in primaries),
+                        0))
+                exec_request.headers['X-Backend-Storage-Policy-Index'] = \
+                    str(policy_index)
             else:
                 # The request is just targetting an account; run it anywhere.
                 object_ring, policy_index = self.get_standalone_policy()
                 # Similar to the `obj` case above, but just select a random
                 # server to execute the job.
                 partition = select_random_partition(object_ring)
+                # all the servers are equal, no data on any of them
                 node_iter = GreenthreadSafeIterator(
-                    self.iter_nodes_local_first(
-                        object_ring,
-                        partition))
+                    self._order_by_load(
+                        self.iter_nodes_local_first(object_ring, partition),
+                        0))
                 exec_request.headers['X-Backend-Storage-Policy-Index'] = \
                     str(policy_index)
+            if exec_request.avoid:
+                # backup run of a straggler or new run of a node whose
+                # server has failed, see `_start_backups` and
+                # `_rerun_failed_nodes`
+                node_iter = GreenthreadSafeIterator(
+                    n for n in node_iter
+                    if not _same_server(n, exec_request.avoid))
             # Create N sets of headers
             # Usually 1, but can be more for replicates
             # FIXME(larsbutler): `_backend_requests` is a private method of the
@@ -976,7 +1166,11 @@ class ClusterController(ObjectController):
             # spawn executions in parallel
             self.logger.info("line 976: spawing pile")
             pile.spawn(self._connect_exec_node, *args)
-        result.extend([connection for connection in pile if connection])
+        try:
+            result.extend([connection for connection in pile if connection])
+        except GreenletExit:
+            self._abandon_run(None, pile, result)
+            raise
         return result
 
     def _spawn_file_senders(self, conns, pool, req):
@@ -1036,6 +1230,14 @@ class ClusterController(ObjectController):
             if resp.request and load_from == resp.request.path_info:
                 source_resp = resp
                 break
+        if not source_resp and isinstance(channel.path, SpillPath):
+            # partition written by the previous stage of the job
+            source_resp = self._open_spill(channel.path, req)
+            if source_resp.status_int >= 300:
+                update_headers(source_resp, nexe_headers)
+                return source_resp
+            source_resp.nodes = []
+            data_sources.append(source_resp)
         # response doesn't already exist
         if not source_resp:
             # copy as GET request
@@ -1098,6 +1300,285 @@ class ClusterController(ObjectController):
             source_resp.nodes.append({'node': repl_node,
                                       'dev': channel.device})
 
+    def _can_run_in_waves(self, req, cluster_config, data_resp, defer):
+        wave_size = self.middleware.zerovm_wave_size
+        if not wave_size or len(cluster_config.nodes) <= wave_size:
+            return False
+        if self.exe_resp or self.image_resp or data_resp \
+                or 'chain.input' in req.environ:
+            # these streams can be sent only once, to all nodes together
+            return False
+        if defer and req.headers.get('x-zerovm-deferred',
+                                     'never').lower() != 'never':
+            return False
+        for node in cluster_config.nodes.itervalues():
+            if node.connect or node.bind or node.location:
+                return False
+        return True
+
+    def _execute_waves(self, req, cluster_config):
+        """Run nodes of a job without networking in waves, at most
+        `zerovm_wave_size` nodes are running at any time.
+
+        Next node is sent when a running one finishes. When a node cannot
+        find a free slot (503), the window is halved and the node is sent
+        again later, each successful node widens the window by one.
+        Immediate outputs are spooled into one temporary file, so proxy
+        memory does not depend on the node count.
+
+        If `zerovm_speculation` is set, a node that does not store its
+        output and runs longer than that many times the median run time of
+        its group is started once more on another server, when there is
+        room in the window. First successful run is used, the other one is
+        killed, and its sessions are cancelled, see `zerovm_cancel_jobs`.
+
+        :param req: client `swift.common.swob.Request`
+        :param cluster_config: :class:`ClusterConfig` of the job
+        :returns: `swift.common.swob.Response` merged from all nodes
+        """
+        max_size = self.middleware.zerovm_wave_size
+        speculation = self.middleware.zerovm_speculation
+        window = max_size
+        pending = deque(cluster_config.nodes.itervalues())
+        done = Queue()
+        running = 0
+        # node name -> greenthreads running the node
+        attempts = {}
+        # node name -> start time of the first run
+        started = {}
+        # node group -> run times of finished nodes
+        run_times = {}
+        responses = []
+        spool = TemporaryFile()
+        while pending or running:
+            while pending and running < window:
+                node = pending.popleft()
+                attempts[node.name] = [
+                    spawn(self._execute_wave_node, req, node,
+                          cluster_config.node_count, done)]
+                started[node.name] = time.time()
+                running += 1
+            timeout = None
+            if speculation and not pending and running < window:
+                timeout = self._start_backups(req, cluster_config, done,
+                                              attempts, started, run_times,
+                                              window)
+                running = sum(len(a) for a in attempts.itervalues())
+            try:
+                node, resp, attempt = done.get(timeout=timeout)
+            except Empty:
+                continue
+            if attempt not in attempts.get(node.name, []):
+                # cancelled run that has finished at the same time
+                continue
+            running -= 1
+            others = [gt for gt in attempts.pop(node.name)
+                      if gt is not attempt]
+            if others and not is_success(resp.status_int):
+                # the other run can still succeed
+                attempts[node.name] = others
+                continue
+            for gt in others:
+                # the run cancels its sessions, see `_abandon_run`
+                gt.kill()
+                running -= 1
+            if resp.status_int == 503 and window > 1:
+                # cluster has less free slots than we thought
+                window = max(1, window / 2)
+                pending.appendleft(node)
+                self.app.logger.increment('wave.shrink')
+                continue
+            if is_success(resp.status_int):
+                window = min(max_size, window + 1)
+                run_times.setdefault(_node_group(node.name), []).append(
+                    time.time() - started[node.name])
+            start = spool.tell()
+            for chunk in resp.app_iter or [resp.body]:
+                spool.write(chunk)
+            resp.content_length = spool.tell() - start
+            responses.append(resp)
+        return _merge_responses(req, responses, spool,
+                                self.middleware.network_chunk_size)
+
+    def _start_backups(self, req, cluster_config, done, attempts, started,
+                       run_times, window):
+        """Start backup runs of the straggler nodes of a wave job, while
+        there are less than `window` runs.
+
+        See `_execute_waves` for the parameters.
+
+        :returns: seconds until the next node becomes a straggler,
+                  None if no running node can become one
+        """
+        speculation = self.middleware.zerovm_speculation
+        now = time.time()
+        timeout = None
+        for name, runs in attempts.items():
+            node = cluster_config.nodes[name]
+            times = run_times.get(_node_group(name), [])
+            if len(runs) > 1 or len(times) < SPECULATION_MIN_RUNS \
+                    or not _is_idempotent(node):
+                continue
+            threshold = started[name] + speculation * _median(times)
+            if threshold > now:
+                if timeout is None or threshold - now < timeout:
+                    timeout = threshold - now
+                continue
+            server = self.spill_locations.get(name)
+            self.app.logger.increment('wave.backup')
+            runs.append(spawn(self._execute_wave_node, req, node,
+                              cluster_config.node_count, done, server))
+            if sum(len(a) for a in attempts.itervalues()) >= window:
+                return None
+        return timeout
+
+    def _execute_wave_node(self, req, node, node_count, done, avoid=None):
+        # node is changed by execution, it must stay clean for a retry
+        run_node = deepcopy(node)
+        config = ClusterConfig(OrderedDict([(run_node.name, run_node)]),
+                               run_node.replicate, node_count)
+        try:
+            resp = self._execute_job(req, config, None,
+                                     load_data_resp=False, defer=False,
+                                     avoid=avoid)
+        except HTTPException as error_resp:
+            resp = error_resp
+        except (Exception, Timeout):
+            self.app.logger.exception('ERROR in wave node %s' % node.name)
+            resp = HTTPServiceUnavailable(
+                body='Cannot execute node %s' % node.name)
+        done.put((node, resp, getcurrent()))
+
+    def _spool_job_input(self, req, cluster_config, data_resp):
+        """Prepare the job for running its failed nodes again, see
+        `_rerun_failed_nodes`.
+
+        Uploaded executable, image and input data are read into temporary
+        files before the job starts, so they can be sent to the object
+        servers once more.
+
+        :param req: client `swift.common.swob.Request`
+        :param cluster_config: :class:`ClusterConfig` of the job
+        :param data_resp: job input data source, can be None
+        :returns: tuple of the clean copies of the nodes that can run again
+                  and the list of (data source, temporary file) pairs,
+                  None if no node can run again or the input is too big
+        """
+        nodes = OrderedDict((name, deepcopy(node))
+                            for name, node in cluster_config.nodes.iteritems()
+                            if _is_independent(node))
+        if not nodes:
+            return None
+        sources = [src for src in (self.exe_resp, self.image_resp, data_resp)
+                   if src]
+        for src in sources:
+            if src.content_length is None:
+                return None
+        if sum(src.content_length for src in sources) > \
+                self.middleware.zerovm_rerun_spool:
+            return None
+        spools = []
+        for src in sources:
+            spool = TemporaryFile()
+            while True:
+                try:
+                    with ChunkReadTimeout(self.middleware.client_timeout):
+                        data = next(src.app_iter)
+                except StopIteration:
+                    break
+                except ChunkReadTimeout as err:
+                    self.app.logger.warn(
+                        'ERROR Client read timeout (%ss)', err.seconds)
+                    self.app.logger.increment('client_timeouts')
+                    raise HTTPRequestTimeout(request=req)
+                spool.write(data)
+            if spool.tell() < src.content_length:
+                raise HTTPClientDisconnect(request=req,
+                                           body='data source dead')
+            spools.append((src, spool))
+        _replay_spools(spools, self.middleware.network_chunk_size)
+        return nodes, spools
+
+    def _rerun_failed_nodes(self, req, conns, rerun, data_resp):
+        """Run the nodes whose object server has failed once more, on
+        other servers, and add their results to the job response.
+
+        Nodes that have failed on the same server are run together, the
+        spooled job input is sent to them from the start.
+
+        :param req: client `swift.common.swob.Request`
+        :param conns: connections of all the nodes of the job
+        :param rerun: value returned by `_spool_job_input`
+        :param data_resp: job input data source, can be None
+        :returns: `swift.common.swob.Response` of the whole job
+        """
+        nodes, spools = rerun
+        finished = []
+        # server address -> (server node dict, list of nodes)
+        failed = OrderedDict()
+        for conn in conns:
+            if conn.cnode.name in nodes and _server_failed(conn.resp):
+                server = failed.setdefault(
+                    (conn.node['ip'], conn.node['port']), (conn.node, []))
+                server[1].append(deepcopy(nodes[conn.cnode.name]))
+            else:
+                finished.append(conn)
+        final_response = self.create_final_response(finished, req)
+        for server, failed_nodes in failed.itervalues():
+            self.app.logger.update_stats('rerun.nodes', len(failed_nodes))
+            _replay_spools(spools, self.middleware.network_chunk_size)
+            config = ClusterConfig(
+                OrderedDict((node.name, node) for node in failed_nodes),
+                len(failed_nodes))
+            resp = self._execute_job(req, config, data_resp,
+                                     load_data_resp=False, defer=False,
+                                     avoid=server)
+            _append_response(final_response, resp)
+        return final_response
+
+    def _open_spill(self, path, req):
+        """Open a spill file on the object server where its producer ran.
+
+        :param path: :class:`zerocloud.common.SpillPath` of the file
+        :param req: client `swift.common.swob.Request`
+        :returns: `swift.common.swob.Response` that streams the file
+        """
+        node = self.spill_locations.get(path.producer)
+        if not node:
+            return HTTPServiceUnavailable(
+                body='Producer %s did not run' % path.producer)
+        job_id = req.headers.get('x-zerocloud-id')
+        headers = {'X-Zerovm-Spill': path.url,
+                   'X-Zerocloud-Id': job_id,
+                   'X-Zerovm-Signature': sign_request(
+                       self.middleware.zerovm_internal_key, job_id, path.url),
+                   'X-Trans-Id': req.headers.get('x-trans-id', '-')}
+        try:
+            with ConnectionTimeout(self.middleware.conn_timeout):
+                conn = http_connect(node['ip'], node['port'],
+                                    node['device'], 0, 'GET',
+                                    path.path, headers)
+            with Timeout(self.middleware.node_timeout):
+                resp = conn.getresponse()
+        except (Exception, Timeout):
+            self.app.exception_occurred(
+                node, 'Object', 'Trying to GET spill %s' % path.url)
+            return HTTPServiceUnavailable(
+                body='Cannot fetch spill %s' % path.url)
+        if not is_success(resp.status):
+            close_swift_conn(resp)
+            return Response(status='%d %s' % (resp.status, resp.reason),
+                            body='Error %d while fetching spill %s'
+                                 % (resp.status, path.url))
+        chunk_size = self.middleware.network_chunk_size
+        # data sources are reused by request path
+        spill_req = Request.blank('/')
+        spill_req.path_info = path.path
+        return Response(request=spill_req,
+                        app_iter=iter(lambda: resp.read(chunk_size), ''),
+                        headers={'Content-Length':
+                                 resp.getheader('content-length')})
+
     def create_final_response(self, conns, req):
         final_body = None
         final_response = Response(request=req)
@@ -1551,7 +2032,14 @@ class ClusterController(ObjectController):
 
         return req, req_iter, data_resp
 
-    def _create_sysmap_resp(self, node):
+    def _create_sysmap_resp(self, node, static_ports=None):
+        if static_ports:
+            # channel addresses are known only after we connect
+            # to the object servers, render them later
+            sysmap = static_ports.template(node)
+            return Response(app_iter=static_ports.iter_render(sysmap),
+                            headers={'Content-Length':
+                                     str(static_ports.get_size(sysmap))})
         sysmap = node.dumps()
         return Response(app_iter=iter([sysmap]),
                         headers={'Content-Length': str(len(sysmap))})
@@ -1559,20 +2047,361 @@ class ClusterController(ObjectController):
     def post_job(self, req):
         # self.logger.info("content-type:{}".format(req.headers['content-type']))
         # self.logger.info("Running upto line 1538 inside POST_JOB")
-        chunk_size = self.middleware.network_chunk_size
-        #self.logger.info("chunk Size_1541:{}".format(chunk_size))
         if 'content-type' not in req.headers:
             req.headers['content-type'] = "application/python"
         if 'content-type' not in req.headers:
             return HTTPBadRequest(request=req,
                                   body='Must specify Content-Type')
 
+        # partition of a job delegated by another proxy, that proxy has
+        # already taken the quotas of the job, signature of the partition
+        # covers the job description, it is checked after parsing
+        partition = req.headers.get('x-zerovm-partition')
+        quotas = self.middleware.account_quotas
+        memcache = cache_from_env(req.environ)
+        if quotas and not partition:
+            wait = quotas.take_job(self.account_name, memcache)
+            if wait is not None:
+                self.app.logger.increment('quota.rate')
+                return HTTPServiceUnavailable(
+                    body='Job rate limit of the account exceeded',
+                    request=req, content_type='text/plain',
+                    headers={'Retry-After': str(int(math.ceil(wait)))})
         #self.logger.info("Running upto line 1548 inside POST_JOB")
         cluster_config, data_resp = self._get_cluster_config_data_resp(req)
         #self.logger.info("Running upto line 1550 inside POST_JOB")
         if not self.cgi_env:
             self.cgi_env = self.create_cgi_env(req)
+        if partition:
+            try:
+                cluster_config = self._select_partition(req, cluster_config,
+                                                        partition)
+            except HTTPException:
+                # not signed by a proxy, charged as any other job
+                if quotas:
+                    quotas.take_job(self.account_name, memcache)
+                raise
+            return self._execute_job(req, cluster_config, data_resp,
+                                     defer=False)
+        stages = cluster_config.get_stages()
+        nodes = 0
+        if quotas and quotas.max_nodes:
+            nodes = self._max_running_nodes(req, stages, data_resp)
+            if nodes > quotas.max_nodes:
+                return HTTPBadRequest(
+                    request=req,
+                    body='Job needs %d nodes at once, account can run %d'
+                         % (nodes, quotas.max_nodes))
+            if not quotas.take_nodes(self.account_name, nodes, memcache):
+                self.app.logger.increment('quota.nodes')
+                retry_after = max(1, int(math.ceil(quotas.job_time)))
+                return HTTPServiceUnavailable(
+                    body='Node quota of the account exceeded',
+                    request=req, content_type='text/plain',
+                    headers={'Retry-After': str(retry_after)})
+        start = time.time()
+        # called when the nodes have finished, a deferred job takes them
+        # over, see `_execute_job`
+        on_finish = []
+        if nodes:
+            on_finish.append(lambda: quotas.release_nodes(
+                self.account_name, nodes, time.time() - start, memcache))
+        try:
+            if len(stages) > 1:
+                return self._execute_stages(req, stages, data_resp,
+                                            on_finish)
+            if self._can_delegate(req, cluster_config, data_resp):
+                return self._execute_delegated(req, cluster_config)
+            return self._execute_job(req, cluster_config, data_resp,
+                                     on_finish=on_finish)
+        finally:
+            for callback in on_finish:
+                callback()
 
+    def _max_running_nodes(self, req, stages, data_resp):
+        """
+        :returns number of nodes of the job that run at the same time,
+                 stages run one after another, wave jobs run at most
+                 `zerovm_wave_size` nodes, in each delegated partition
+        """
+        wave_size = self.middleware.zerovm_wave_size
+        nodes = 0
+        for stage in stages:
+            count = stage.total_count
+            if len(stages) == 1 and \
+                    self._can_delegate(req, stage, data_resp):
+                partition_size = self.middleware.zerovm_delegate_nodes
+                if wave_size and wave_size < partition_size:
+                    partitions = int(math.ceil(
+                        float(count) / partition_size))
+                    count = min(count, partitions * wave_size)
+            elif self._can_run_in_waves(req, stage, data_resp, True):
+                count = wave_size
+            nodes = max(nodes, count)
+        return nodes
+
+    def _execute_stages(self, req, stages, data_resp, on_finish=None):
+        """Run the job stage by stage, each stage starts when all nodes of
+        the previous stage have finished and stored their spill files.
+
+        Only the last stage may be deferred and may return immediate
+        output, bodies of the previous stages are discarded.
+
+        :param req: client `swift.common.swob.Request`
+        :param stages: list of :class:`ClusterConfig` objects, one per stage
+        :param data_resp: job input data source, used by the first stage
+        :param on_finish: callbacks passed to the last stage, see
+                          `_execute_job`
+        :returns: `swift.common.swob.Response` of the last stage
+        """
+        if self.exe_resp or self.image_resp:
+            # uploaded data can be sent to the object servers only once
+            return HTTPBadRequest(
+                request=req,
+                body='Cannot use uploaded executable or image '
+                     'in a job with shuffle stages')
+        if not self.middleware.zerovm_internal_key:
+            # spill files cannot be fetched without signed requests
+            return HTTPServiceUnavailable(
+                request=req,
+                body='Shuffle stages are not enabled on this proxy')
+        stage_headers = HeaderKeyDict()
+        load_data_resp = True
+        for stage in stages[:-1]:
+            resp = self._execute_job(req, stage, data_resp,
+                                     load_data_resp=load_data_resp,
+                                     defer=False)
+            data_resp = None
+            load_data_resp = False
+            if resp.status_int >= 300:
+                return resp
+            for _junk in resp.app_iter or []:
+                pass
+            for key, val in resp.headers.iteritems():
+                if key.lower().startswith('x-nexe-'):
+                    stage_headers[key] = val
+        resp = self._execute_job(req, stages[-1], data_resp,
+                                 load_data_resp=False, on_finish=on_finish)
+        for key, val in stage_headers.iteritems():
+            if resp.headers.get(key):
+                resp.headers[key] = '%s,%s' % (val, resp.headers[key])
+        return resp
+
+    def _can_delegate(self, req, cluster_config, data_resp):
+        delegate_nodes = self.middleware.zerovm_delegate_nodes
+        if not delegate_nodes or not self.middleware.zerovm_delegates \
+                or not self.middleware.zerovm_delegate_key \
+                or len(cluster_config.nodes) <= delegate_nodes:
+            return False
+        if 'x-zerovm-partition' in req.headers or not self.cluster_config \
+                or self.command.split('/')[0] in ZEROVM_COMMANDS:
+            # delegates parse the same job description
+            return False
+        if self.exe_resp or self.image_resp or data_resp \
+                or 'chain.input' in req.environ:
+            # these streams can be sent only once, to all nodes together
+            return False
+        if req.headers.get('x-zerovm-deferred', 'never').lower() != 'never':
+            return False
+        return all(_is_independent(node)
+                   for node in cluster_config.nodes.itervalues())
+
+    def _execute_delegated(self, req, cluster_config):
+        """Split a large job without networking into partitions of
+        `zerovm_delegate_nodes` nodes, and run each partition on one of the
+        `zerovm_delegates` proxies. Delegate sends the nodes of its
+        partition to the object servers and collects their results, this
+        proxy only merges the reports of the partitions.
+
+        Delegate gets the same job description, with `X-Zerovm-Partition`
+        header that selects the nodes of the partition, signed with
+        `zerovm_delegate_key`. Header carries the digest of the nodes and
+        of the objects their wildcards were resolved to, delegate checks
+        that it has resolved the same ones.
+
+        :param req: client `swift.common.swob.Request`
+        :param cluster_config: :class:`ClusterConfig` of the job
+        :returns: `swift.common.swob.Response` merged from all partitions
+        """
+        size = self.middleware.zerovm_delegate_nodes
+        delegates = self.middleware.zerovm_delegates
+        count = len(cluster_config.nodes)
+        first = randrange(len(delegates))
+        partitions = int(math.ceil(float(count) / size))
+        pile = GreenPile(partitions)
+        nodes = cluster_config.nodes.items()
+        for index, start in enumerate(xrange(0, count, size)):
+            shift = (first + index) % len(delegates)
+            stop = min(count, start + size)
+            pile.spawn(self._run_partition, req, start, stop,
+                       _partition_digest(nodes[start:stop]),
+                       delegates[shift:] + delegates[:shift])
+        self.app.logger.update_stats('delegate.partitions', partitions)
+        final_response = Response(request=req)
+        for resp in pile:
+            _append_response(final_response, resp)
+        final_response.headers['Etag'] = md5(str(time.time())).hexdigest()
+        return final_response
+
+    def _run_partition(self, req, start, stop, digest, delegates):
+        """Run nodes of the job from `start` to `stop` on a delegate proxy.
+
+        :param req: client `swift.common.swob.Request`
+        :param digest: digest of the nodes, see `_partition_digest`
+        :param delegates: (ip, port) of the delegates, in order they are
+                          tried, next one is tried only if the previous one
+                          could not be connected
+        :returns: `swift.common.swob.Response` of the partition, its body
+                  is spooled into a temporary file
+        """
+        chunk_size = self.middleware.network_chunk_size
+        body = self.cluster_config
+        expires = int(time.time() + PARTITION_EXPIRES)
+        signature = _partition_signature(self.middleware.zerovm_delegate_key,
+                                         start, stop, expires, digest, body)
+        headers = dict((key, val) for key, val in req.headers.iteritems()
+                       if key.lower() not in DELEGATE_HEADER_EXCLUSIONS)
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(body))
+        headers['X-Zerovm-Partition'] = '%d:%d:%d:%s:%s' % (
+            start, stop, expires, digest, signature)
+        path = '/%s/%s' % (self.middleware.version, quote(self.account_name))
+        conn = None
+        for host, port in delegates:
+            try:
+                with ConnectionTimeout(self.middleware.conn_timeout):
+                    conn = http_connect_raw(host, port, 'POST', path,
+                                            headers)
+                break
+            except (Exception, Timeout):
+                self.app.logger.exception(
+                    'ERROR Cannot connect to delegate %s:%s' % (host, port))
+        if not conn:
+            return HTTPServiceUnavailable(
+                body='No delegate for nodes %d-%d' % (start, stop - 1))
+        # delegate runs its nodes in waves, if they do not fit in one
+        waves = 1
+        if self.middleware.zerovm_wave_size:
+            waves = int(math.ceil(float(stop - start)
+                                  / self.middleware.zerovm_wave_size))
+        spool = TemporaryFile()
+        try:
+            with Timeout(self.middleware.node_timeout):
+                conn.send(body)
+            with Timeout(self.middleware.node_timeout * waves):
+                server_response = conn.getresponse()
+            while True:
+                with ChunkReadTimeout(self.middleware.node_timeout):
+                    chunk = server_response.read(chunk_size)
+                if not chunk:
+                    break
+                spool.write(chunk)
+        except (Exception, Timeout):
+            self.app.logger.exception(
+                'ERROR Delegate %s:%s failed to run nodes %d-%d'
+                % (host, port, start, stop - 1))
+            return HTTPRequestTimeout(
+                body='Timeout: running nodes %d-%d on delegate'
+                     % (start, stop - 1))
+        resp = Response(status='%d %s' % (server_response.status,
+                                          server_response.reason))
+        for key, val in server_response.getheaders():
+            if key.lower().startswith('x-nexe-'):
+                resp.headers[key] = val
+        if 'x-nexe-cdr-line' in resp.headers:
+            # drop total time of the delegate, it is a part of ours
+            resp.headers['x-nexe-cdr-line'] = \
+                resp.headers['x-nexe-cdr-line'].split(', ', 1)[-1]
+        resp.content_type = server_response.getheader('content-type')
+        size = spool.tell()
+        spool.seek(0)
+        resp.app_iter = iter(lambda: spool.read(chunk_size), '')
+        resp.content_length = size
+        return resp
+
+    def _select_partition(self, req, cluster_config, partition):
+        """Select the nodes of a job partition delegated by another proxy.
+
+        :param req: client `swift.common.swob.Request`
+        :param cluster_config: :class:`ClusterConfig` of the whole job
+        :param partition: value of `X-Zerovm-Partition` header,
+                          `<start>:<stop>:<expires>:<digest>:<signature>`
+        :returns: :class:`ClusterConfig` of the partition
+        :raises: HTTPBadRequest, HTTPForbidden, HTTPConflict
+        """
+        try:
+            start, stop, expires, digest, signature = partition.split(':')
+            start, stop, expires = int(start), int(stop), int(expires)
+        except ValueError:
+            raise HTTPBadRequest(request=req,
+                                 body='Invalid X-Zerovm-Partition')
+        key = self.middleware.zerovm_delegate_key
+        if not key or expires < time.time() or not streq_const_time(
+                signature, _partition_signature(key, start, stop, expires,
+                                                digest, self.cluster_config)):
+            raise HTTPForbidden(request=req,
+                                body='Partition is not signed or expired')
+        nodes = cluster_config.nodes.items()[start:stop]
+        if not nodes:
+            raise HTTPBadRequest(request=req,
+                                 body='Partition has no nodes')
+        if digest != _partition_digest(nodes):
+            # container listing has changed since the job was split
+            raise HTTPConflict(request=req,
+                               body='Partition nodes %d-%d have changed'
+                                    % (start, stop - 1))
+        return ClusterConfig(OrderedDict(nodes),
+                             sum(node.replicate for _name, node in nodes),
+                             cluster_config.node_count)
+
+    def _execute_job(self, req, cluster_config, data_resp,
+                     load_data_resp=True, defer=True, avoid=None,
+                     on_finish=None):
+        """Send all nodes of the cluster config to the object servers and
+        collect the results.
+
+        :param req: client `swift.common.swob.Request`
+        :param cluster_config: :class:`ClusterConfig` of the nodes to run
+        :param data_resp: job input data source, can be None
+        :param load_data_resp: if True and `data_resp` is None, job input is
+                               loaded from the chained job request
+        :param defer: if False, `x-zerovm-deferred` header is ignored
+        :param avoid: object server node dict, nodes are not run there
+        :param on_finish: list of callbacks that the caller runs when this
+                          returns, deferred job removes them from the list
+                          and runs them when its nodes have finished
+        :returns: `swift.common.swob.Response`
+        """
+        # name service and static ports of the job are stopped when it
+        # returns, on errors too
+        release = []
+        try:
+            return self._run_job(req, cluster_config, data_resp,
+                                 load_data_resp, defer, avoid, on_finish,
+                                 release)
+        finally:
+            for callback in release:
+                callback()
+
+    def _run_job(self, req, cluster_config, data_resp, load_data_resp,
+                 defer, avoid, on_finish, release):
+        """Body of :meth:`_execute_job`.
+
+        :param release: list of callbacks that :meth:`_execute_job` runs
+                        when this returns, deferred job removes them from
+                        the list and runs them when its nodes have finished
+        """
+        if self._can_run_in_waves(req, cluster_config, data_resp, defer):
+            return self._execute_waves(req, cluster_config)
+        chunk_size = self.middleware.network_chunk_size
+        rerun = None
+        # nodes that run on an `avoid` server are never run again
+        if self.middleware.zerovm_rerun_spool and not avoid:
+            if not data_resp and load_data_resp and any(
+                    n.data_in for n in cluster_config.nodes.itervalues()):
+                data_resp = self._load_input_from_chain(req, chunk_size)
+                load_data_resp = False
+            rerun = self._spool_job_input(req, cluster_config, data_resp)
         # List of `swift.common.swob.Request` objects
         data_sources = []
         if self.exe_resp:
@@ -1585,6 +2414,7 @@ class ClusterController(ObjectController):
             return HTTPServiceUnavailable(
                 body='Cannot find own address, check zerovm_ns_hostname')
         ns_server = None
+        static_ports = None
 
         # Start the `NameService`, if necessary.
         # If the network type is 'tcp' (ZeroVM+ZeroMQ networking) and there is
@@ -1592,7 +2422,31 @@ class ClusterController(ObjectController):
         # NOTE(larsbutler): If there's only one node, we don't need networking,
         # and thus, don't need to start the name service.
         if (self.middleware.network_type == 'tcp'
-            and cluster_config.total_count > 1):
+                and cluster_config.total_count > 1
+                and self.middleware.static_ports):
+            # Ports are pre-assigned by proxy, no name service needed.
+            static_ports = StaticPortMap(self.middleware.static_ports,
+                                         self.middleware.zerovm_static_ipc,
+                                         cache_from_env(req.environ))
+            release.append(static_ports.stop)
+        elif (self.middleware.network_type == 'tcp'
+                and cluster_config.total_count > 1
+                and self.middleware.zerovm_ns_shared):
+            # One name server serves all the jobs of this proxy worker.
+            # Job is identified by a token stored in the ids of its nodes,
+            # therefore we need to shift all the node ids.
+            ns_server = \
+                self.middleware.get_shared_name_service().register_job(
+                    cluster_config.total_count,
+                    cluster_config.get_max_node_id())
+            if not ns_server:
+                return HTTPServiceUnavailable(
+                    body='Name service slot not available',
+                    request=req)
+            release.append(ns_server.stop)
+            cluster_config.rebase_node_ids(ns_server.id_base)
+        elif (self.middleware.network_type == 'tcp'
+              and cluster_config.total_count > 1):
             ns_server = NameService(cluster_config.total_count)
             if self.middleware.zerovm_ns_thrdpool.free() <= 0:
                 return HTTPServiceUnavailable(
@@ -1602,11 +2456,12 @@ class ClusterController(ObjectController):
             if not ns_server.port:
                 # no free ports
                 return HTTPServiceUnavailable(body='Cannot bind name service')
+            release.append(ns_server.stop)
 
+        pool_weight = self._get_pool_weight(req)
         # exec_requests: Send these to the appropriate object servers
         exec_requests = []
         # NOTE(larsbutler): if not data_resp and load_data_resp: chain = True
-        load_data_resp = True
         #self.logger.info("Running upto line 1577 inside POST_JOB")
         # self.parser.node_list defines all of the zerovm instances --
         # including replicates -- that will be launched for this job (or for
@@ -1624,8 +2479,11 @@ class ClusterController(ObjectController):
                 'x-nexe-validation': 0,
                 'x-nexe-cdr-line': '0.0 0.0 0 0 0 0 0 0 0 0',
                 'x-nexe-policy': '',
-                'x-nexe-colocated': '0'
+                'x-nexe-colocated': '0',
+                'x-nexe-cpus': '-'
             })
+            # must be resolved before the remote objects of the node
+            remote_source = self._remote_fallback(node, req)
             path_info = req.path_info
             # Copy the request path, environ, and headers from the client
             # request into the new request.
@@ -1708,6 +2566,10 @@ class ClusterController(ObjectController):
             # different from request url, since we have the
             # acl/setuid execution feature available to other users.
             exec_request.headers['x-account-name'] = self.account_name
+            # Only the operator can change the weight of the account.
+            exec_request.headers.pop('x-zerovm-weight', None)
+            if pool_weight:
+                exec_request.headers['x-zerovm-weight'] = pool_weight
             # Proxy sends timestamp to each object server in advance
             # for each object that the objserver will create.
             # So if this job creates multiple objects, it will use this
@@ -1742,6 +2604,9 @@ class ClusterController(ObjectController):
                 # NOTE(larsbutler): In other words, we run all at once (or not
                 # at all, apparently?).
                 exec_request.headers['x-zerovm-pool'] = 'cluster'
+                # Object server holds the slot only until all the nodes
+                # have got their slots, see _close_exec_conns()
+                exec_request.headers['x-zerovm-gang'] = 'yes'
             if ns_server:
                 node.name_service = 'udp:%s:%d' % (addr, ns_server.port)
 
@@ -1778,14 +2643,14 @@ class ClusterController(ObjectController):
                         # rep3: 13 14 15 16 <-- third set
                         # and so on..
                         node.replicas[i].id = \
-                            node.id + (i + 1) * len(cluster_config.nodes)
+                            node.id + (i + 1) * cluster_config.node_count
             # each exec requests needs a copy of the cgi env stuff (vars)
             node.copy_cgi_env(request=exec_request, cgi_env=self.cgi_env)
 
             # we create a fake data source
             # a fake response containing the system.map just now created for
             # this object server:
-            resp = self._create_sysmap_resp(node)
+            resp = self._create_sysmap_resp(node, static_ports)
             # adds the response to two places:
             # 1) add it to "master" list of data sources ->why? so we don't
             # redundantly fetch data; we cache and reuse
@@ -1795,7 +2660,7 @@ class ClusterController(ObjectController):
                 # repeat the above for each replica:
                 repl_node.copy_cgi_env(request=exec_request,
                                        cgi_env=self.cgi_env)
-                resp = self._create_sysmap_resp(repl_node)
+                resp = self._create_sysmap_resp(repl_node, static_ports)
                 repl_node.add_data_source(data_sources, resp, 'sysmap')
             # for each node, we want to know the remote objects it needs to
             # reference
@@ -1849,6 +2714,8 @@ class ClusterController(ObjectController):
                                                 'dev': 'stdin'})
 
             exec_request.node = node
+            exec_request.remote_source = remote_source
+            exec_request.avoid = avoid
             exec_request.resp_headers = nexe_headers
             # If possible, try to submit the job to a daemon.
             # This is an internal optimization.
@@ -1903,8 +2770,7 @@ class ClusterController(ObjectController):
         if len(conns) < cluster_config.total_count:
             self.app.logger.exception(
                 'ERROR Cannot find suitable node to execute code on')
-            for conn in conns:
-                close_swift_conn(getattr(conn, 'resp'))
+            _close_exec_conns(conns)
             return HTTPServiceUnavailable(
                 body='Cannot find suitable node to execute code on')
 
@@ -1912,11 +2778,26 @@ class ClusterController(ObjectController):
             if hasattr(conn, 'error'):
                 if hasattr(conn, 'resp'):
                     close_swift_conn(conn.resp)
+                headers = conn.nexe_headers
+                retry_after = conn.resp.getheader('retry-after')
+                if retry_after:
+                    # object servers are too busy to start the job in time
+                    headers = HeaderKeyDict(headers)
+                    headers['Retry-After'] = retry_after
                 return Response(app_iter=[conn.error],
                                 status="%d %s" % (conn.resp.status,
                                                   conn.resp.reason),
-                                headers=conn.nexe_headers)
+                                headers=headers)
+
+        if static_ports and not static_ports.assign(
+                dict((conn.cnode.id, conn.node['ip']) for conn in conns)):
+            _close_exec_conns(conns)
+            return HTTPServiceUnavailable(
+                body='Cannot assign static ports')
 
+        for conn in conns:
+            # consumers of the next stages fetch spill files from here
+            self.spill_locations[conn.cnode.name] = conn.node
         _attach_connections_to_data_sources(conns, data_sources)
 
         # chunked encoding handling looks broken in Swift
@@ -1924,6 +2805,7 @@ class ClusterController(ObjectController):
         # chunked = req.headers.get('transfer-encoding')
         chunked = False
         #self.logger.info("Running upto line 1907 inside POST_JOB")
+        sent = False
         try:
             with ContextPool(cluster_config.total_count) as pool:
                 self._spawn_file_senders(conns, pool, req)
@@ -1957,6 +2839,7 @@ class ClusterController(ObjectController):
                         # wait for everything to finish
                         conn.queue.join()
                     conn.tar_stream = None
+            sent = True
         except ChunkReadTimeout, err:
             self.app.logger.warn(
                 'ERROR Client read timeout (%ss)', err.seconds)
@@ -1966,23 +2849,37 @@ class ClusterController(ObjectController):
             # this can include the client request; this is ALLLLLL data sources
             # Only above do we begin to read from all sources
             return HTTPRequestTimeout(request=req)
+        except GreenletExit:
+            self._abandon_run(req, pile, conns)
+            raise
         except (Exception, Timeout):
             print traceback.format_exc()
             self.app.logger.exception(
                 'ERROR Exception causing client disconnect')
             return HTTPClientDisconnect(request=req, body='exception')
+        finally:
+            if not sent:
+                # nodes that got all their data may be running already
+                self._cancel_sessions(req, conns)
 
         # we have successfully started execution and sent all data sources
         #self.logger.info("Running upto line 1956 inside POST_JOB")
 
+        # nodes of a networked job wait for each other,
+        # when one of them fails the others are cancelled
+        peers = None
+        if any(conn.cnode.connect or conn.cnode.bind for conn in conns):
+            peers = conns
         for conn in conns:
             # process all of the responses in parallel
-            pile.spawn(self._process_response, conn, req)
+            pile.spawn(self._process_response, conn, req, peers)
 
         # x-zerovm-deferred means, run the job async and close the client
         # connection asap -> results are saved into swift
         do_defer = req.headers.get('x-zerovm-deferred', 'never').lower()
-        if do_defer == 'always':
+        if not defer:
+            defer_timeout = None
+        elif do_defer == 'always':
             # 0 means timeout immediately
             defer_timeout = 0
         elif do_defer == 'auto':
@@ -1990,12 +2887,16 @@ class ClusterController(ObjectController):
         else:
             # None means no timeout
             defer_timeout = None
+        running_conns = conns
         conns = []
         try:
             with Timeout(seconds=defer_timeout):
                 for conn in pile:
                     if conn:
                         conns.append(conn)
+        except GreenletExit:
+            self._abandon_run(req, pile, running_conns)
+            raise
         except Timeout:
             # if timeout is 0, we immediately get an exception (the case where
             # x-zerovm-deferred is specified)
@@ -2012,7 +2913,11 @@ class ClusterController(ObjectController):
                 for conn in pile:
                     if conn:
                         conns.append(conn)
-                resp = self.create_final_response(conns, req)
+                if rerun:
+                    resp = self._rerun_failed_nodes(req, conns, rerun,
+                                                    data_resp)
+                else:
+                    resp = self.create_final_response(conns, req)
                 path = SwiftPath(deferred_url)
                 container_info = get_info(self.app, req.environ.copy(),
                                           path.account, path.container,
@@ -2111,25 +3016,40 @@ class ClusterController(ObjectController):
             deferred_path = SwiftPath.init(self.account_name, container, obj)
             resp = Response(request=req,
                             body=deferred_path.url)
+            # nodes are still running, they finish in the greenthread
+            deferred_finish = list(on_finish or []) + release
+            if on_finish:
+                del on_finish[:]
+            del release[:]
+
+            def store_and_finish(deferred_url):
+                try:
+                    store_deferred_response(deferred_url)
+                finally:
+                    for callback in deferred_finish:
+                        callback()
+
             # spawn it with any thread that can handle it
-            spawn_n(store_deferred_response, deferred_path.url)
-            # FIXME(larsbutler): We might want to stop the name server at the
-            # end of store_deferred_response, instead of here.
-            if ns_server:
-                ns_server.stop()
+            spawn_n(store_and_finish, deferred_path.url)
             # return immediately, our job is likely still running
             return resp
             # end of deferred/timeout case
-        if ns_server:
-            # If we are running with networking and have a NameService server,
-            # stop the server.
-            ns_server.stop()
+        # If we are running with networking, stop the name server and
+        # release the static ports before the failed nodes are run again.
+        while release:
+            release.pop()()
+        if rerun:
+            return self._rerun_failed_nodes(req, conns, rerun, data_resp)
         return self.create_final_response(conns, req)
 
     def process_server_response(self, conn, request, resp):
         # Process object server response (responses from requests which are
         # co-located with an object).
         conn.resp = resp
+        # object server reports its load after the session has finished
+        self._update_pool_load(conn.node,
+                               resp.headers.get('x-zerovm-pool-load'),
+                               resp.headers.get('x-zerovm-memory-free'))
         # self.logger.info("process server response 2091")
         if not is_success(resp.status_int):
             conn.error = resp.body
@@ -2218,7 +3138,16 @@ class ClusterController(ObjectController):
         resp.content_length = 0
         return conn
 
-    def _process_response(self, conn, request):
+    def _process_response(self, conn, request, peers=None):
+        """Read the final response of the object server that runs the
+        node.
+
+        :param conn: connection returned by `_make_exec_requests`
+        :param request: client `swift.common.swob.Request`
+        :param peers: connections of all the nodes of a networked job,
+                      they are cancelled if this node fails
+        :returns: `conn`
+        """
         conn.error = None
         chunk_size = self.middleware.network_chunk_size
         if conn.resp:
@@ -2233,8 +3162,9 @@ class ClusterController(ObjectController):
         else:
             # got "continue"
             # no response yet; we need to read it
+            timeout = self._node_timeout(conn)
             try:
-                with Timeout(self.middleware.node_timeout):
+                with Timeout(timeout):
                     server_response = conn.getresponse()
                     resp = Response(status='%d %s' %
                                            (server_response.status,
@@ -2250,7 +3180,141 @@ class ClusterController(ObjectController):
                 resp = HTTPRequestTimeout(
                     body='Timeout: trying to get final status of POST '
                          'to %s' % request.path_info)
-        return self.process_server_response(conn, request, resp)
+                self._cancel_sessions(request, [conn])
+                if timeout < self.middleware.node_timeout:
+                    # node was given up early, from the cost model
+                    self.middleware.cost_model.record_timeout(
+                        _exe_key(conn.cnode), timeout)
+                    self.app.logger.increment('cost.timeouts')
+        conn = self.process_server_response(conn, request, resp)
+        if peers and conn.error:
+            self._cancel_sessions(request, peers)
+        self._record_cost(conn)
+        return conn
+
+    def _node_timeout(self, conn):
+        """Time to wait for the final response of the node, from the
+        recent run times of its executable. Node that is sent more data
+        than the sampled sessions have read waits `node_timeout`.
+
+        :param conn: connection returned by `_make_exec_requests`
+        :returns: seconds
+        """
+        timeout = self.middleware.node_timeout
+        factor = self.middleware.zerovm_cost_timeout
+        if not factor or not self.middleware.cost_model:
+            return timeout
+        estimate = self.middleware.cost_model.estimate(_exe_key(conn.cnode))
+        if not estimate:
+            return timeout
+        if getattr(conn.cnode, 'size', 0) > estimate['rbytes'][1]:
+            # node gets more input than the sampled sessions have read
+            return timeout
+        wait = 0.0
+        if self.middleware.pool_loads:
+            wait = self.middleware.pool_loads.predicted_wait(conn.node)
+        return min(timeout, wait + factor * estimate['time'][1]
+                   + TIMEOUT_GRACE)
+
+    def _record_cost(self, conn):
+        """Add run time and I/O of the finished node to the cost model.
+
+        :param conn: connection returned by `_process_response`
+        """
+        if not self.middleware.cost_model or conn.error:
+            return
+        resp = conn.resp
+        # only sessions that have run to the end tell the cost
+        if not is_success(resp.status_int) \
+                or resp.headers.get('x-nexe-status') != 'ok.' \
+                or 'x-nexe-cdr-line' not in resp.headers:
+            return
+        cost_model = self.middleware.cost_model
+        if cost_model.record(_exe_key(conn.cnode),
+                             resp.headers['x-nexe-cdr-line']):
+            self.app.logger.increment('cost.samples')
+        if cost_model.save_due():
+            try:
+                cost_model.save()
+            except (IOError, OSError):
+                self.app.logger.exception('ERROR Cannot save cost model to %s'
+                                          % cost_model.path)
+
+    def _cancel_sessions(self, req, conns):
+        """Ask object servers to kill ZeroVM sessions of the nodes,
+        each node is cancelled only once.
+
+        :param req: client `swift.common.swob.Request`
+        :param conns: connections of the nodes to cancel
+        """
+        if not self.middleware.zerovm_cancel_jobs \
+                or not self.middleware.zerovm_internal_key:
+            return
+        # server address -> (server node dict, names of the nodes)
+        servers = OrderedDict()
+        for conn in conns:
+            key = (conn.node['ip'], conn.node['port'])
+            if (key, conn.cnode.name) in self.cancelled_nodes:
+                continue
+            self.cancelled_nodes.add((key, conn.cnode.name))
+            servers.setdefault(key, (conn.node, []))[1].append(
+                conn.cnode.name)
+        for node, names in servers.itervalues():
+            spawn_n(self._send_cancel, node, names, req)
+
+    def _abandon_run(self, req, pile, conns):
+        """Stop a run of nodes that is not needed anymore, the greenthread
+        of the run was killed by `_execute_waves`, because another run of
+        the same node has finished first.
+
+        Sessions of the nodes are cancelled, greenthreads of the run are
+        killed, they close their connections in `_try_exec_node`, and the
+        connections of the run are closed.
+
+        :param req: client `swift.common.swob.Request`, None if no data
+                    was sent to the nodes yet, and no session has started
+        :param pile: :class:`GreenPileEx` of the run
+        :param conns: connections of the nodes of the run
+        """
+        if req:
+            self._cancel_sessions(req, conns)
+        for gt in list(pile.pool.coroutines_running):
+            gt.kill()
+        _close_exec_conns(conns)
+
+    def _send_cancel(self, node, names, req):
+        job_id = req.headers.get('x-zerocloud-id')
+        body = json.dumps(names)
+        headers = {'X-Zerovm-Cancel': job_id,
+                   'X-Zerovm-Signature': sign_request(
+                       self.middleware.zerovm_internal_key, job_id, body),
+                   'X-Trans-Id': req.headers.get('x-trans-id', '-'),
+                   'Content-Type': 'application/json',
+                   'Content-Length': len(body)}
+        try:
+            with ConnectionTimeout(self.middleware.conn_timeout):
+                conn = http_connect(node['ip'], node['port'],
+                                    node['device'], 0, 'POST',
+                                    '/%s' % self.account_name, headers)
+            with Timeout(self.middleware.node_timeout):
+                conn.send(body)
+                resp = conn.getresponse()
+                resp_body = resp.read()
+        except (Exception, Timeout):
+            self.app.exception_occurred(
+                node, 'Object', 'Trying to cancel job %s' % job_id)
+            return
+        if not is_success(resp.status):
+            self.app.logger.warn('ERROR %d while cancelling job %s on %s:%s',
+                                 resp.status, job_id, node['ip'],
+                                 node['port'])
+            return
+        result = json.loads(resp_body)
+        self.app.logger.update_stats('cancel.sessions', result['sessions'])
+        self.app.logger.info('Cancelled %d sessions of job %s on %s:%s, '
+                             '%.3f seconds reclaimed'
+                             % (result['sessions'], job_id, node['ip'],
+                                node['port'], result['seconds']))
 
     def print_node_info(self, node, part_no):
         self.logger.info("id:{},ip:{},replication_ip:{},partition:{}".format(node['id'], node['ip'], node['replication_ip'], part_no))
@@ -2313,98 +3377,181 @@ class ClusterController(ObjectController):
 
             # self.logger.info(node.)
             #self.logger.info("connection timeout ========={}".format(self.middleware.conn_timeout))
-            try:
-                with ConnectionTimeout(self.middleware.conn_timeout):
-                    request_headers['Expect'] = '100-continue'
-                    request_headers['Content-Length'] = str(cnode.size)
-
-                    # NOTE(larsbutler): THIS line right here kicks off the
-                    # actual execution.
-                    conn = http_connect(node['ip'], node['port'],
-                                        node['device'], part, request.method,
-                                        request.path_info, request_headers)
-                    # If we get here, it means object started reading our
-                    # requests, read all headers until the body, processed the
-                    # headers, and has now issued a read on the body
-                    # but we haven't sent any data yet
-                    self.logger.info("OK => ip:{} partition:{}".format(node['ip'],part))
-                    self.print_node_info(node, part)
-                self.logger.info("2326 conn:{}".format(conn))
-                with Timeout(self.middleware.node_timeout):
-                    resp = conn.getexpect()
-                # node == the swift object server we are connected to
-                conn.node = node
-                # cnode == the zerovm node
-                conn.cnode = cnode
-                conn.nexe_headers = request.resp_headers
-                if resp.status == HTTP_CONTINUE:
-                    conn.resp = None
-                    self.logger.info("2314:HTTP_CONTINUE {}".format(resp))
-                    return conn
-                elif is_success(resp.status):
-                    conn.resp = resp
-                    self.logger.info("2319 on Exec")
-                    return conn
-                elif resp.status == HTTP_INSUFFICIENT_STORAGE:
-                    # increase the error count for this node
-                    # to optimize, the proxy server can use this count to limit
-                    # the number of requests send to this particular object
-                    # node.
-                    self.logger.info("2326 on Exec")
-                    self.app.error_limit(node,
-                                         'ERROR Insufficient Storage')
-                    conn.error = 'Insufficient Storage'
-                    # the final response is `resp`, which is error
-                    # could be disk failed, etc.
-                    conn.resp = resp
-                    resp.nuke_from_orbit()
-                elif is_client_error(resp.status):
-                    #self.logger.info("2335 on Exec")
-                    conn.error = resp.read()
-                    conn.resp = resp
-                    if resp.status == HTTP_NOT_FOUND:
-                        # it could be "not found" because either a) the object
-                        # doesn't exist or b) just this server doesn't have a
-                        # copy
-
-                        # container or object was either not found, or due to
-                        # eventual consistency, it can't be found here right
-                        # now
-                        # so, we try to continue and look for it elsewhere
-
-                        # the 404 error here doesn't include the url, so we
-                        # include it here (so the client so they know which url
-                        # has a problem)
-                        conn.error = 'Error %d %s while fetching %s' \
-                                     % (resp.status, resp.reason,
-                                        request.path_info)
-                    else:
-                        # don't keep trying; this is user error
-                        return conn
-                else:
-                    #self.logger.info("2358 on Exec")
-                    # unknown error
-                    # some 500 error that's not insufficient storage
-                    self.app.logger.info('Obj server failed with: %d %s'
-                                         % (resp.status, resp.reason))
-                    conn.error = resp.read()
-                    conn.resp = resp
-                    resp.nuke_from_orbit()
-                    # we still keep trying; maybe we'll have better luck on
-                    # another replicate (could be a problem with threadpool,
-                    # etc.)
-            except Exception as exp:
-                self.logger.info("Exception on line 2364{}".format(exp))
-                self.app.exception_occurred(node, 'Object',
-                                            'Expect: 100-continue on %s'
-                                            % request.path_info)
-                if getattr(conn, 'resp'):
-                    conn.resp.nuke_from_orbit()
-                conn = None
+            hedging = self.middleware.hedging
+            if hedging and hedging.delay() is not None \
+                    and not known_nodes and not cnode.location \
+                    and request.headers.get('x-zerovm-priority') == \
+                    'interactive':
+                conn, done = self._hedged_exec_node(node, obj_nodes, part,
+                                                    request, cnode,
+                                                    request_headers)
+            else:
+                conn, done = self._try_exec_node(node, part, request, cnode,
+                                                 request_headers)
+            if done:
+                return conn
         # self.logger.info("Line 2370: Actual Execution")
         if conn:
             return conn
 
+    def _try_exec_node(self, node, part, request, cnode, request_headers):
+        """Send the execution request headers to one object server.
+
+        See `_connect_exec_node` for the parameters.
+
+        :returns:
+            (conn, done) tuple, `done` is True if `conn` is the final
+            connection for the node, otherwise `conn` holds the error, or is
+            None, and other servers can be tried
+        """
+        conn = None
+        start = time.time()
+        try:
+            with ConnectionTimeout(self.middleware.conn_timeout):
+                request_headers['Expect'] = '100-continue'
+                request_headers['Content-Length'] = str(cnode.size)
+
+                # NOTE(larsbutler): THIS line right here kicks off the
+                # actual execution.
+                conn = http_connect(node['ip'], node['port'],
+                                    node['device'], part, request.method,
+                                    request.path_info, request_headers)
+                # If we get here, it means object started reading our
+                # requests, read all headers until the body, processed the
+                # headers, and has now issued a read on the body
+                # but we haven't sent any data yet
+                self.logger.info("OK => ip:{} partition:{}".format(node['ip'],part))
+                self.print_node_info(node, part)
+            self.logger.info("2326 conn:{}".format(conn))
+            with Timeout(self.middleware.node_timeout):
+                resp = conn.getexpect()
+            if self.middleware.hedging:
+                self.middleware.hedging.record(time.time() - start)
+            if resp.status != HTTP_CONTINUE:
+                # server refused the node, 100 Continue carries no load,
+                # load of accepted nodes comes with their final response,
+                # see `process_server_response`
+                self._update_pool_load(
+                    node,
+                    resp.getheader('x-zerovm-pool-load'),
+                    resp.getheader('x-zerovm-memory-free'))
+            # node == the swift object server we are connected to
+            conn.node = node
+            # cnode == the zerovm node
+            conn.cnode = cnode
+            conn.nexe_headers = request.resp_headers
+            if resp.status == HTTP_CONTINUE:
+                conn.resp = None
+                self.logger.info("2314:HTTP_CONTINUE {}".format(resp))
+                return conn, True
+            elif is_success(resp.status):
+                conn.resp = resp
+                self.logger.info("2319 on Exec")
+                return conn, True
+            elif resp.status == HTTP_INSUFFICIENT_STORAGE:
+                # increase the error count for this node
+                # to optimize, the proxy server can use this count to limit
+                # the number of requests send to this particular object
+                # node.
+                self.logger.info("2326 on Exec")
+                self.app.error_limit(node,
+                                     'ERROR Insufficient Storage')
+                conn.error = 'Insufficient Storage'
+                # the final response is `resp`, which is error
+                # could be disk failed, etc.
+                conn.resp = resp
+                resp.nuke_from_orbit()
+            elif is_client_error(resp.status):
+                #self.logger.info("2335 on Exec")
+                conn.error = resp.read()
+                conn.resp = resp
+                if resp.status == HTTP_NOT_FOUND:
+                    # it could be "not found" because either a) the object
+                    # doesn't exist or b) just this server doesn't have a
+                    # copy
+
+                    # container or object was either not found, or due to
+                    # eventual consistency, it can't be found here right
+                    # now
+                    # so, we try to continue and look for it elsewhere
+
+                    # the 404 error here doesn't include the url, so we
+                    # include it here (so the client so they know which url
+                    # has a problem)
+                    conn.error = 'Error %d %s while fetching %s' \
+                                 % (resp.status, resp.reason,
+                                    request.path_info)
+                else:
+                    # don't keep trying; this is user error
+                    return conn, True
+            else:
+                #self.logger.info("2358 on Exec")
+                # unknown error
+                # some 500 error that's not insufficient storage
+                self.app.logger.info('Obj server failed with: %d %s'
+                                     % (resp.status, resp.reason))
+                conn.error = resp.read()
+                conn.resp = resp
+                resp.nuke_from_orbit()
+                # we still keep trying; maybe we'll have better luck on
+                # another replicate (could be a problem with threadpool,
+                # etc.)
+        except GreenletExit:
+            # hedged request that has lost, see `_hedged_exec_node`
+            if conn:
+                conn.close()
+            raise
+        except Exception as exp:
+            self.logger.info("Exception on line 2364{}".format(exp))
+            self.app.exception_occurred(node, 'Object',
+                                        'Expect: 100-continue on %s'
+                                        % request.path_info)
+            if getattr(conn, 'resp', None):
+                conn.resp.nuke_from_orbit()
+            conn = None
+        return conn, False
+
+    def _hedged_exec_node(self, node, obj_nodes, part, request, cnode,
+                          request_headers):
+        """Send the execution request headers to `node`, and if it does not
+        answer in time, also to the next server from `obj_nodes`. First
+        server that accepts the request wins, connection to the other one
+        is closed.
+
+        See `_connect_exec_node` for the parameters.
+
+        :returns: (conn, done) tuple, see `_try_exec_node`
+        """
+        hedging = self.middleware.hedging
+        attempts = Queue()
+        first = spawn(self._try_exec_node, node, part, request, cnode,
+                      request_headers)
+        first.link(attempts.put)
+        try:
+            return attempts.get(timeout=hedging.delay()).wait()
+        except Empty:
+            pass
+        if not hedging.spend():
+            return first.wait()
+        try:
+            hedge_node = next(obj_nodes)
+        except StopIteration:
+            return first.wait()
+        self.app.logger.info('Hedging %s on %s:%s'
+                             % (cnode.name, hedge_node['ip'],
+                                hedge_node['port']))
+        second = spawn(self._try_exec_node, hedge_node, part, request, cnode,
+                       dict(request_headers))
+        second.link(attempts.put)
+        winner = attempts.get()
+        loser = second if winner is first else first
+        conn, done = winner.wait()
+        if not done:
+            return loser.wait()
+        loser.link(_close_hedged_conn)
+        loser.kill()
+        return conn, done
+
 
 
 
@@ -2415,19 +3562,22 @@ class ClusterController(ObjectController):
         if connection:
             # If connection is not None, only cache accounting data on the
             # input ``request`` object; nothing actually gets saved.
-            body = '%s %s %s (%s) [%s]\n' % (
+            body = '%s %s %s (%s) [%s] %s\n' % (
                 datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
                 txn_id,
                 connection.nexe_headers['x-nexe-system'],
                 connection.nexe_headers['x-nexe-cdr-line'],
-                connection.nexe_headers['x-nexe-status'])
+                connection.nexe_headers['x-nexe-status'],
+                connection.nexe_headers.get('x-nexe-cpus', '-'))
             request.cdr_log.append(body)
-            self.app.logger.info('zerovm-cdr %s %s %s (%s) [%s]'
+            self.app.logger.info('zerovm-cdr %s %s %s (%s) [%s] %s'
                                  % (self.account_name,
                                     txn_id,
                                     connection.nexe_headers['x-nexe-system'],
                                     connection.nexe_headers['x-nexe-cdr-line'],
-                                    connection.nexe_headers['x-nexe-status']))
+                                    connection.nexe_headers['x-nexe-status'],
+                                    connection.nexe_headers.get('x-nexe-cpus',
+                                                                '-')))
         else:
             # Here, something is actually saved
             body = ''.join(request.cdr_log)
@@ -2784,6 +3934,149 @@ def _config_from_template(params, template, url):
     return config
 
 
+def _close_exec_conns(conns):
+    """
+    Closes connections to object servers before any data was sent,
+    object servers release the slots reserved for the job right away
+
+    :param conns: connections returned by _make_exec_requests()
+    """
+    for conn in conns:
+        close_swift_conn(getattr(conn, 'resp'))
+        conn.close()
+
+
+def _close_hedged_conn(attempt):
+    """
+    Closes connection of the hedged request that has lost, if it has
+    finished before it could be killed, killed request closes its
+    connection in `_try_exec_node()`
+
+    :param attempt: greenthread that ran `_try_exec_node()`
+    """
+    try:
+        conn, _done = attempt.wait()
+    except (Exception, GreenletExit):
+        return
+    if conn:
+        _close_exec_conns([conn])
+
+
+def _node_group(name):
+    """
+    :returns name of the node without the number added by `count`
+    """
+    return re.sub(r'-\d+$', '', name)
+
+
+def _is_idempotent(node):
+    """
+    :returns True if node can be run twice, it does not write any objects
+             or spill files, only immediate output
+    """
+    for ch in node.channels:
+        if ch.access & ACCESS_WRITABLE and ch.path:
+            return False
+    return True
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def _same_server(node, other):
+    return (node['ip'], node['port']) == (other['ip'], other['port'])
+
+
+def _is_independent(node):
+    """
+    :returns True if node can run alone, it has no network channels,
+             replicas or co-located nodes
+    """
+    return not (node.connect or node.bind or node.location) \
+        and node.replicate <= 1
+
+
+def _server_failed(resp):
+    """
+    :returns True if object server has failed to run the node,
+             when the node itself has failed ZeroVM reports its status
+    """
+    return (resp.status_int == HTTP_REQUEST_TIMEOUT
+            or resp.status_int >= 500) \
+        and 'x-nexe-status' not in resp.headers
+
+
+def _replay_spools(spools, chunk_size):
+    """
+    Makes spooled data sources ready to be sent from the start
+
+    :param spools: list of (data source, temporary file) pairs
+    """
+    for src, spool in spools:
+        spool.seek(0)
+        src.app_iter = iter(lambda spool=spool: spool.read(chunk_size), '')
+        src.nodes = []
+
+
+def _append_response(final_response, resp):
+    """
+    Adds status, nexe headers and body of separately executed nodes
+    to the job response
+
+    :param final_response: response returned by `create_final_response`
+    :param resp: `swift.common.swob.Response` of the other nodes
+    """
+    if resp.status_int > final_response.status_int:
+        final_response.status = resp.status
+    for key, val in resp.headers.iteritems():
+        if not key.lower().startswith('x-nexe-'):
+            continue
+        if final_response.headers.get(key):
+            final_response.headers[key] += ',' + val
+        else:
+            final_response.headers[key] = val
+    if resp.content_length > 0:
+        app_iter = resp.app_iter or [resp.body]
+        if isinstance(final_response.app_iter, FinalBody):
+            final_response.app_iter.append(app_iter)
+            final_response.content_length += resp.content_length
+        else:
+            final_response.app_iter = FinalBody(app_iter)
+            final_response.content_length = resp.content_length
+            final_response.content_type = resp.content_type
+
+
+def _merge_responses(req, responses, spool, chunk_size):
+    """Merge responses of separately executed nodes into one,
+    same as `create_final_response` merges responses of one execution.
+
+    :param responses: list of `swift.common.swob.Response` objects
+    :param spool: file with bodies of all the responses, one after another
+    """
+    final_response = Response(request=req)
+    final_response.content_length = 0
+    for resp in responses:
+        if resp.status_int > final_response.status_int:
+            final_response.status = resp.status
+        for key, val in resp.headers.iteritems():
+            if not key.lower().startswith('x-nexe-'):
+                continue
+            if final_response.headers.get(key):
+                final_response.headers[key] += ',' + val
+            else:
+                final_response.headers[key] = val
+        if resp.content_length > 0:
+            if not final_response.content_length:
+                final_response.content_type = resp.content_type
+            final_response.content_length += resp.content_length
+    spool.seek(0)
+    final_response.app_iter = iter(lambda: spool.read(chunk_size), '')
+    final_response.headers['Etag'] = md5(str(time.time())).hexdigest()
+    return final_response
+
+
 def _attach_connections_to_data_sources(conns, data_sources):
     """
     :param conns:
@@ -2896,3 +4189,29 @@ def filter_factory(global_conf, **local_conf):
 
     return query_filter
 
+
+def _exe_key(node):
+    """Key of the executable of the node in the cost model."""
+    return getattr(node.exe, 'url', node.exe)
+
+
+def _partition_signature(key, start, stop, expires, digest, description):
+    """
+    :returns signature of a delegated job partition
+    """
+    return hmac.new(key, '%d:%d:%d:%s:%s' % (start, stop, expires, digest,
+                                             md5(description).hexdigest()),
+                    sha1).hexdigest()
+
+
+def _partition_digest(nodes):
+    """
+    :param nodes: list of (name, node) pairs of a job partition
+    :returns digest of the node names and the objects their channels
+             were resolved to
+    """
+    parts = []
+    for name, node in nodes:
+        parts.append(name)
+        parts.extend(ch.path.url for ch in node.channels if ch.path)
+    return md5('\n'.join(parts)).hexdigest()
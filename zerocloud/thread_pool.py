@@ -1,4 +1,17 @@
+from collections import deque
+from collections import OrderedDict
 from eventlet import GreenPool
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+from swift.common.memcached import MemcacheConnectionError
+import errno
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import re
+import signal
 import uuid
 import time
 
@@ -15,7 +28,17 @@ ID_DIGITS = 3
 TIME_DIGITS = 10
 
 COUNTER_LIMIT = 1 << (COUNTER_DIGITS * 4)
+# weight of the last session in the average session run time
+SERVICE_TIME_DECAY = 0.2
+# same for the long-term average run time of the adaptive pool
+LONG_SERVICE_TIME_DECAY = 0.01
+# adaptive pool size is multiplied by this on overload
+SIZE_DECREASE = 0.75
 UID_FORMAT = '%%0%dx%%s%%0%dx' % (TIME_DIGITS, COUNTER_DIGITS)
+# file of the cancelled nodes of a job, see JobSessions
+CANCEL_SUFFIX = 'cancelled'
+# fields of a CostModel sample: wall time, cpu time, bytes read, written
+COST_FIELDS = ('time', 'cpu', 'rbytes', 'wbytes')
 
 
 class Zuid(object):
@@ -31,9 +54,104 @@ class Zuid(object):
 
 class PoolInterface(object):
 
-    def can_spawn(self, job_id):
+    def __init__(self):
+        # reservation key -> expiration time, None if committed
+        self._reservations = {}
+        self._reservation_id = 0
+        # pool name and logger for metrics, set by the middleware
+        self.name = ''
+        self.logger = None
+        # moving average of session run time, in seconds
+        self.service_time = 0.0
+
+    def can_spawn(self, job_id, account=None):
+        raise NotImplementedError
+
+    def free_slots(self):
         raise NotImplementedError
 
+    def size(self):
+        raise NotImplementedError
+
+    def running(self):
+        raise NotImplementedError
+
+    def queued(self):
+        raise NotImplementedError
+
+    def estimated_wait(self):
+        """
+        :returns seconds a new session is expected to wait for a free slot,
+                 estimated from the recent session run times
+        """
+        if self.running() < self.size():
+            return 0.0
+        return (self.queued() + 1) * self.service_time / self.size()
+
+    def load(self):
+        """
+        :returns string with running and queued sessions, size of the pool
+                 and estimated wait for a slot in seconds
+        """
+        return '%d %d %d %.3f' % (self.running(), self.queued(), self.size(),
+                                  self.estimated_wait())
+
+    def has_free_slot(self, account=None):
+        return self.free_slots() > self.reserved()
+
+    def set_weight(self, account, weight):
+        pass
+
+    def reconfigure(self, *args):
+        """
+        Changes pool parameters in place, arguments are the same as for
+        the constructor. Running sessions are not affected, if pool shrinks
+        new sessions wait until enough of them finish.
+        """
+        raise NotImplementedError
+
+    def reserved(self):
+        now = time.time()
+        for key, expires in self._reservations.items():
+            if expires is not None and expires < now:
+                del self._reservations[key]
+        return len(self._reservations)
+
+    def reserve(self, job_id, lease, account=None):
+        """
+        Holds one slot for the job until it is spawned, no other job
+        can take the slot until the reservation is released or expires
+
+        :param job_id: id of the job
+        :param lease: seconds before uncommitted reservation expires
+        :param account: account that runs the job
+
+        :returns reservation key, None if there are no free slots
+        """
+        if not self.has_free_slot(account):
+            return None
+        self._max_job_id = max(self._max_job_id, job_id)
+        self._reservation_id += 1
+        self._reservations[self._reservation_id] = time.time() + lease
+        return self._reservation_id
+
+    def commit(self, key):
+        """
+        Makes reservation permanent, it must be released explicitly
+
+        :param key: reservation key returned by reserve()
+        """
+        if key in self._reservations:
+            self._reservations[key] = None
+
+    def release(self, key):
+        """
+        Frees the reserved slot, does nothing if reservation has expired
+
+        :param key: reservation key returned by reserve()
+        """
+        self._reservations.pop(key, None)
+
     def _spawn(self, function, *args, **kwargs):
         raise NotImplementedError
 
@@ -41,44 +159,1209 @@ class PoolInterface(object):
         if self.can_spawn(job_id):
             return self._spawn(function, *args, **kwargs)
 
+    def spawn_for(self, account, job_id, function, *args, **kwargs):
+        return self.spawn(job_id, function, *args, **kwargs)
+
     def force_spawn(self, function, *args, **kwargs):
         return self._spawn(function, *args, **kwargs)
 
+    def _timed(self, function, *args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            run_time = time.time() - start
+            if self.service_time:
+                self.service_time += SERVICE_TIME_DECAY * \
+                    (run_time - self.service_time)
+            else:
+                self.service_time = run_time
+
+    def _timing_since(self, metric, start):
+        if self.logger:
+            self.logger.timing_since('pool.%s.%s' % (self.name, metric),
+                                     start)
+
 
 class PriorityPool(PoolInterface):
 
     def __init__(self, low_watermark=1000, high_watermark=1000):
+        PoolInterface.__init__(self)
         self._low_watermark = int(low_watermark)
         self._high_watermark = int(high_watermark)
         self._pool = GreenPool(self._high_watermark)
         self._max_job_id = ''
 
-    def can_spawn(self, job_id):
+    def reconfigure(self, low_watermark=1000, high_watermark=1000):
+        self._low_watermark = int(low_watermark)
+        self._high_watermark = int(high_watermark)
+        _resize_green_pool(self._pool, self._high_watermark)
+
+    def can_spawn(self, job_id, account=None):
         if job_id <= self._max_job_id:
             return True
-        if self._pool.running() < self._low_watermark:
+        if self.has_free_slot(account):
             self._max_job_id = job_id
             return True
         return False
 
+    def free_slots(self):
+        return self._low_watermark - self._pool.running()
+
+    def size(self):
+        return self._high_watermark
+
+    def running(self):
+        return self._pool.running()
+
+    def queued(self):
+        return self._pool.waiting()
+
     def _spawn(self, function, *args, **kwargs):
-        return self._pool.spawn(function, *args, **kwargs)
+        return self._pool.spawn(self._timed, function, *args, **kwargs)
 
 
 class WaitPool(PoolInterface):
     def __init__(self, pool_size=1000, queue_size=1000):
+        PoolInterface.__init__(self)
         self._pool_size = int(pool_size)
         self._queue_size = int(queue_size)
         self._pool = GreenPool(self._pool_size)
         self._max_job_id = ''
 
-    def can_spawn(self, job_id):
+    def reconfigure(self, pool_size=1000, queue_size=1000):
+        self._pool_size = int(pool_size)
+        self._queue_size = int(queue_size)
+        _resize_green_pool(self._pool, self._pool_size)
+
+    def can_spawn(self, job_id, account=None):
         if job_id <= self._max_job_id:
             return True
-        if self._pool.free() > 0 or self._pool.waiting() < self._queue_size:
+        if self.has_free_slot(account):
             self._max_job_id = job_id
             return True
         return False
 
+    def free_slots(self):
+        # free slots of the pool and free places in its queue
+        return (self._pool.free() + self._queue_size -
+                self._pool.waiting())
+
+    def size(self):
+        return self._pool_size
+
+    def running(self):
+        return self._pool.running()
+
+    def queued(self):
+        return self._pool.waiting()
+
     def _spawn(self, function, *args, **kwargs):
-        return self._pool.spawn(function, *args, **kwargs)
+        start = time.time()
+        # waits here while the pool is full
+        thrd = self._pool.spawn(self._timed, function, *args, **kwargs)
+        self._timing_since('wait', start)
+        return thrd
+
+
+class AdaptivePool(WaitPool):
+    """
+    WaitPool that changes its size between `min_size` and `max_size`.
+    Size grows by one after each `size` sessions finished while the pool
+    was full, and is cut by a quarter when the host is overloaded:
+    load average or run queue per cpu is above `max_load`, share of cpu
+    time in iowait is above `max_iowait` or recent sessions run
+    `latency_tolerance` times longer than usual.
+    Pool starts with `max_size` slots.
+    """
+
+    def __init__(self, min_size=1, max_size=1000, queue_size=1000,
+                 max_load=1.0, max_iowait=0.3, latency_tolerance=2.0):
+        WaitPool.__init__(self, max_size, queue_size)
+        self._long_service_time = 0.0
+        self._increase = 0.0
+        self._next_decrease = 0
+        self.host_load = HostLoad()
+        self._set_limits(min_size, max_size, queue_size,
+                         max_load, max_iowait, latency_tolerance)
+
+    def reconfigure(self, min_size=1, max_size=1000, queue_size=1000,
+                    max_load=1.0, max_iowait=0.3, latency_tolerance=2.0):
+        self._set_limits(min_size, max_size, queue_size,
+                         max_load, max_iowait, latency_tolerance)
+        # current size must be in the new range
+        self._resize(self._pool_size)
+
+    def _set_limits(self, min_size, max_size, queue_size,
+                    max_load, max_iowait, latency_tolerance):
+        limits = (int(min_size), int(max_size), int(queue_size),
+                  float(max_load), float(max_iowait),
+                  float(latency_tolerance))
+        if not 0 < limits[0] <= limits[1]:
+            raise ValueError('Invalid pool size range: %s-%s'
+                             % (min_size, max_size))
+        (self._min_size, self._max_size, self._queue_size,
+         self._max_load, self._max_iowait, self._latency_tolerance) = limits
+
+    def _timed(self, function, *args, **kwargs):
+        try:
+            return WaitPool._timed(self, function, *args, **kwargs)
+        finally:
+            self._adjust()
+
+    def overloaded(self):
+        if self._long_service_time and self.service_time > \
+                self._latency_tolerance * self._long_service_time:
+            return True
+        load, iowait = self.host_load.sample()
+        return load > self._max_load or iowait > self._max_iowait
+
+    def _adjust(self):
+        if self._long_service_time:
+            self._long_service_time += LONG_SERVICE_TIME_DECAY * \
+                (self.service_time - self._long_service_time)
+        else:
+            self._long_service_time = self.service_time
+        if self.overloaded():
+            now = time.time()
+            if now >= self._next_decrease:
+                # sessions started with the old size need some time to end
+                self._next_decrease = now + self.service_time
+                self._increase = 0.0
+                self._resize(int(self._pool_size * SIZE_DECREASE))
+        elif self._pool.waiting() or \
+                self._pool.running() >= self._pool_size:
+            self._increase += 1.0 / self._pool_size
+            if self._increase >= 1.0:
+                self._increase = 0.0
+                self._resize(self._pool_size + 1)
+
+    def _resize(self, size):
+        size = min(self._max_size, max(self._min_size, size))
+        delta = size - self._pool_size
+        if not delta:
+            return
+        _resize_green_pool(self._pool, size)
+        self._pool_size = size
+        if self.logger:
+            self.logger.update_stats('pool.%s.size' % self.name, delta)
+
+
+class DeviceSlots(object):
+    """
+    Limits the number of sessions that use each device at once,
+    other sessions wait in a queue of the device
+    """
+
+    def __init__(self, limit, queue_size):
+        self.limit = int(limit)
+        self.queue_size = int(queue_size)
+        # device name -> Semaphore
+        self._semaphores = {}
+
+    def _semaphore(self, device):
+        sem = self._semaphores.get(device)
+        if not sem:
+            sem = self._semaphores[device] = Semaphore(self.limit)
+        return sem
+
+    def running(self, device):
+        sem = self._semaphores.get(device)
+        if not sem:
+            return 0
+        return self.limit - max(0, sem.counter)
+
+    def queued(self, device):
+        sem = self._semaphores.get(device)
+        if not sem:
+            return 0
+        return max(0, -sem.balance)
+
+    def can_acquire(self, device):
+        return self.running(device) < self.limit \
+            or self.queued(device) < self.queue_size
+
+    def acquire(self, device):
+        self._semaphore(device).acquire()
+
+    def release(self, device):
+        self._semaphore(device).release()
+
+    def load(self, device):
+        """
+        :returns string with running and queued sessions and the limit
+        """
+        return '%d %d %d' % (self.running(device), self.queued(device),
+                             self.limit)
+
+
+class HostLoad(object):
+    """
+    Load of the host read from /proc, sampled at most once per `interval`
+    """
+
+    def __init__(self, interval=1.0, proc='/proc'):
+        self.interval = interval
+        self.proc = proc
+        # load average or run queue, whatever is bigger, per cpu
+        self.load = 0.0
+        # share of cpu time spent in iowait since the previous sample
+        self.iowait = 0.0
+        self._next_sample = 0
+        self._cpu_times = None
+        try:
+            self._cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self._cpus = 1
+
+    def sample(self):
+        """
+        :returns (load, iowait) tuple
+        """
+        now = time.time()
+        if now < self._next_sample:
+            return self.load, self.iowait
+        self._next_sample = now + self.interval
+        try:
+            with open(os.path.join(self.proc, 'loadavg')) as f:
+                fields = f.read().split()
+            # runnable processes, this one included
+            runnable = int(fields[3].split('/')[0]) - 1
+            self.load = max(float(fields[0]), runnable) / self._cpus
+            with open(os.path.join(self.proc, 'stat')) as f:
+                cpu_times = [int(t) for t in f.readline().split()[1:]]
+            if self._cpu_times:
+                total = sum(cpu_times) - sum(self._cpu_times)
+                if total > 0:
+                    self.iowait = \
+                        float(cpu_times[4] - self._cpu_times[4]) / total
+            self._cpu_times = cpu_times
+        except (IOError, ValueError, IndexError):
+            # not a Linux host
+            pass
+        return self.load, self.iowait
+
+
+class MemoryBudget(object):
+    """
+    Memory committed by the sessions of this worker, checked against
+    the memory of the host read from /proc/meminfo, sampled at most once
+    per `interval`
+
+    Each session commits the memory declared in its manifest, a session
+    is admitted only if it fits into `limit` (total memory of the host,
+    if 0) together with the already committed sessions, and if the host
+    has that much memory available right now
+
+    Workers of the server do not see sessions of each other, each of
+    `workers` workers gets an equal share of `limit`
+    """
+
+    def __init__(self, limit=0, interval=1.0, proc='/proc', workers=1):
+        self.limit = int(limit)
+        self.workers = max(1, int(workers))
+        self.interval = interval
+        self.proc = proc
+        self.committed = 0
+        # bytes, None if unknown
+        self.total = None
+        self.available = None
+        self._next_sample = 0
+
+    def sample(self):
+        """
+        :returns (total, available) tuple, in bytes
+        """
+        now = time.time()
+        if now < self._next_sample:
+            return self.total, self.available
+        self._next_sample = now + self.interval
+        meminfo = {}
+        try:
+            with open(os.path.join(self.proc, 'meminfo')) as f:
+                for line in f:
+                    fields = line.split()
+                    meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        except (IOError, ValueError, IndexError):
+            # not a Linux host
+            return self.total, self.available
+        self.total = meminfo.get('MemTotal')
+        self.available = meminfo.get('MemAvailable')
+        if self.available is None and 'MemFree' in meminfo:
+            # kernels older than 3.14
+            self.available = meminfo['MemFree'] + \
+                meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+        return self.total, self.available
+
+    def free(self):
+        """
+        :returns bytes that a new session can commit,
+                 None if there is no limit
+        """
+        total, available = self.sample()
+        free = None
+        limit = self.limit or total
+        if limit:
+            free = max(0, limit // self.workers - self.committed)
+        if available is not None:
+            free = available if free is None else min(free, available)
+        return free
+
+    def commit(self, size):
+        """
+        :returns True if `size` bytes were committed,
+                 False if they do not fit
+        """
+        free = self.free()
+        if free is not None and size > free:
+            return False
+        self.committed += size
+        return True
+
+    def release(self, size):
+        self.committed = max(0, self.committed - size)
+
+
+class CpuSets(object):
+    """
+    Assigns `cores` cpus of one NUMA node to each session, a session gets
+    the cpus of the node that has most of them free. Topology is read
+    from /sys, a host without NUMA information is one node
+
+    If `path` is set, cpus are claimed host-wide, all the workers of the
+    server share the directory, each claimed cpu has a `cpu<N>` file with
+    the pid of the worker. Claims of the workers that have died are
+    dropped
+    """
+
+    def __init__(self, cores, sysfs='/sys', path=None):
+        self.cores = int(cores)
+        if self.cores < 1:
+            raise ValueError('Number of cores must be positive')
+        self.path = path
+        # node -> list of all its cpus
+        self._cpus = _read_numa_nodes(sysfs)
+        # cpus claimed by this worker
+        self._claimed = set()
+
+    def _file(self, cpu):
+        return os.path.join(self.path, 'cpu%d' % cpu)
+
+    def _claimed_cpus(self):
+        if not self.path:
+            return self._claimed
+        claimed = set()
+        for file_name in os.listdir(self.path):
+            if not re.match(r'^cpu\d+$', file_name):
+                continue
+            path = os.path.join(self.path, file_name)
+            try:
+                with open(path) as fp:
+                    pid = int(fp.read())
+                if not _pid_alive(pid):
+                    os.unlink(path)
+                    continue
+            except (IOError, OSError, ValueError):
+                # claim that is being written or was just released
+                pass
+            claimed.add(int(file_name[3:]))
+        return claimed
+
+    def _claim(self, cpu):
+        if self.path:
+            try:
+                fd = os.open(self._file(cpu),
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError:
+                return False
+            os.write(fd, str(os.getpid()))
+            os.close(fd)
+        self._claimed.add(cpu)
+        return True
+
+    def _unclaim(self, cpu):
+        self._claimed.discard(cpu)
+        if self.path:
+            try:
+                os.unlink(self._file(cpu))
+            except OSError:
+                pass
+
+    def _free_cpus(self):
+        claimed = self._claimed_cpus()
+        return dict((node, [cpu for cpu in cpus if cpu not in claimed])
+                    for node, cpus in self._cpus.iteritems())
+
+    def free(self, node=None):
+        free = self._free_cpus()
+        if node is None:
+            return sum(len(cpus) for cpus in free.itervalues())
+        return len(free.get(node, []))
+
+    def acquire(self):
+        """
+        :returns (node, cpus) tuple, None if no node has enough free cpus
+        """
+        free = self._free_cpus()
+        node = max(sorted(free), key=lambda n: len(free[n]))
+        cpus = []
+        for cpu in free[node]:
+            if len(cpus) == self.cores:
+                break
+            # other worker can claim the cpu first
+            if self._claim(cpu):
+                cpus.append(cpu)
+        if len(cpus) < self.cores:
+            for cpu in cpus:
+                self._unclaim(cpu)
+            return None
+        return node, cpus
+
+    def release(self, cpuset):
+        _node, cpus = cpuset
+        for cpu in cpus:
+            self._unclaim(cpu)
+
+
+class PoolLoadTable(object):
+    """
+    Loads of object servers as they report them in `X-Zerovm-Pool-Load`
+    header, used by proxy to try less loaded servers first. Reported wait
+    decays with time, it halves every `half_life` seconds
+
+    Servers that reported in `X-Zerovm-Memory-Free` header less free memory
+    than a session needs, `memory` bytes, are tried after the others, for
+    `half_life` seconds since the report
+    """
+
+    def __init__(self, half_life=10.0, memory=0):
+        self.half_life = float(half_life)
+        self.memory = int(memory)
+        # (ip, port) -> (wait, time of the report)
+        self._waits = {}
+        # (ip, port) -> (free memory, time of the report)
+        self._memory = {}
+
+    def update(self, node, load, memory_free=None):
+        """
+        :param node: object server node dict
+        :param load: value of `X-Zerovm-Pool-Load` header, can be None
+        :param memory_free: value of `X-Zerovm-Memory-Free` header,
+                            can be None
+        """
+        key = (node['ip'], node['port'])
+        if memory_free:
+            try:
+                self._memory[key] = (int(memory_free), time.time())
+            except ValueError:
+                pass
+        if not load:
+            return
+        try:
+            wait = float(load.split()[3])
+        except (ValueError, IndexError):
+            return
+        self._waits[key] = (wait, time.time())
+
+    def predicted_wait(self, node):
+        """
+        :returns seconds a new session is expected to wait on the server
+        """
+        wait, reported = self._waits.get((node['ip'], node['port']),
+                                         (0.0, 0))
+        if not wait:
+            return 0.0
+        age = time.time() - reported
+        return wait * 0.5 ** (age / self.half_life)
+
+    def memory_short(self, node):
+        """
+        :returns True if the server has recently reported less free memory
+                 than a session needs
+        """
+        free, reported = self._memory.get((node['ip'], node['port']),
+                                          (None, 0))
+        if free is None or time.time() - reported > self.half_life:
+            return False
+        return free < self.memory
+
+    def order(self, nodes, primaries):
+        """
+        Sorts servers by predicted wait, first `primaries` servers hold
+        the data and are still tried before the rest. Servers short of
+        memory go last in their group. Servers with the same wait keep
+        their order.
+
+        :returns list of nodes
+        """
+        def key(node):
+            return self.memory_short(node), self.predicted_wait(node)
+
+        nodes = list(nodes)
+        return sorted(nodes[:primaries], key=key) + \
+            sorted(nodes[primaries:], key=key)
+
+
+class ConnectHedging(object):
+    """
+    Tells proxy when to send exec request of a node to one more server:
+    when the first server has not answered in `percentile` of the recent
+    answer times. Only `ratio` of the requests can be hedged, with bursts
+    of at most `burst` hedged requests
+    """
+
+    def __init__(self, percentile=95, ratio=0.05, window=200,
+                 min_samples=20, burst=10):
+        self.percentile = float(percentile)
+        if not 0 < self.percentile <= 100:
+            raise ValueError('Percentile must be in (0, 100]')
+        self.ratio = float(ratio)
+        self.min_samples = int(min_samples)
+        self.burst = float(burst)
+        self._samples = deque(maxlen=int(window))
+        self._delay = None
+        self._tokens = 0.0
+
+    def record(self, seconds):
+        """
+        :param seconds: time it took the server to answer
+        """
+        self._samples.append(seconds)
+        self._delay = None
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def delay(self):
+        """
+        :returns seconds to wait before hedging, None if there are
+                 not enough samples yet
+        """
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._delay is None:
+            samples = sorted(self._samples)
+            index = int(math.ceil(self.percentile / 100 * len(samples))) - 1
+            self._delay = samples[max(0, index)]
+        return self._delay
+
+    def spend(self):
+        """
+        :returns True if the request can be hedged
+        """
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class CostModel(object):
+    """
+    Run time and I/O of the recent sessions of each executable, taken from
+    the accounting lines of the sessions. Keeps last `window` samples of
+    at most `max_keys` executables, the least recently used executable is
+    forgotten first. Estimates are given only for executables with at least
+    `min_samples` samples.
+
+    Samples are saved to `path` every `save_interval` seconds, and loaded
+    from it on start, if `path` is set
+    """
+
+    def __init__(self, window=100, min_samples=10, max_keys=1000,
+                 path=None, save_interval=60):
+        self.window = int(window)
+        self.min_samples = int(min_samples)
+        self.max_keys = int(max_keys)
+        self.path = path
+        self.save_interval = float(save_interval)
+        # key -> deque of samples, in COST_FIELDS order
+        self._samples = OrderedDict()
+        # key -> cached estimate
+        self._estimates = {}
+        self._saved = time.time()
+        self._dirty = False
+        if self.path:
+            self.load()
+
+    def record(self, key, cdr_line):
+        """
+        :param key: executable the session has run, ex. its path
+        :param cdr_line: `X-Nexe-Cdr-Line` of the session, as returned by
+                         object server
+        :returns True if the sample was recorded
+        """
+        sample = _parse_cdr_line(cdr_line)
+        if not sample:
+            return False
+        self._add(key, sample)
+        return True
+
+    def record_timeout(self, key, seconds):
+        """
+        Adds a censored sample of a session that was given up after
+        `seconds`, it would have run at least that long. I/O of the sample
+        is the 95th percentile of the other samples. Without such samples
+        estimate of an executable would never grow over the timeouts it
+        gives.
+
+        :returns True if the sample was recorded
+        """
+        estimate = self.estimate(key)
+        if not estimate:
+            return False
+        self._add(key, (float(seconds),) +
+                  tuple(estimate[field][1] for field in COST_FIELDS[1:]))
+        return True
+
+    def _add(self, key, sample):
+        samples = self._samples.pop(key, None)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            if len(self._samples) >= self.max_keys:
+                old_key, _junk = self._samples.popitem(last=False)
+                self._estimates.pop(old_key, None)
+        samples.append(sample)
+        self._samples[key] = samples
+        self._estimates.pop(key, None)
+        self._dirty = True
+
+    def save_due(self):
+        """
+        :returns True if samples should be saved now
+        """
+        return bool(self.path) and self._dirty and \
+            time.time() - self._saved >= self.save_interval
+
+    def estimate(self, key):
+        """
+        :returns dict of p50 and p95 of each of COST_FIELDS,
+                 ex. {'time': (1.2, 3.4), ...}, None if there are not enough
+                 samples of the executable
+        """
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        result = self._estimates.get(key)
+        if result is None:
+            result = {}
+            for i, field in enumerate(COST_FIELDS):
+                values = sorted(s[i] for s in samples)
+                result[field] = (_percentile(values, 50),
+                                 _percentile(values, 95))
+            self._estimates[key] = result
+        return result
+
+    def save(self):
+        """
+        Writes all samples to `path`, errors are raised
+        """
+        self._saved = time.time()
+        data = dict((key, list(samples))
+                    for key, samples in self._samples.iteritems())
+        tmp_path = '%s.%s' % (self.path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump(data, fp)
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self._dirty = False
+
+    def load(self):
+        """
+        Reads the samples saved in `path`, missing or broken file is
+        ignored
+        """
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+        for key, samples in data.iteritems():
+            if len(self._samples) >= self.max_keys:
+                break
+            try:
+                samples = [tuple(float(v) for v in s)
+                           for s in samples
+                           if len(s) == len(COST_FIELDS)]
+            except (TypeError, ValueError):
+                continue
+            self._samples[key] = deque(samples, maxlen=self.window)
+        self._estimates = {}
+
+
+class JobSessions(object):
+    """
+    ZeroVM processes of the running jobs, kept in `path` directory shared
+    by all the workers of the server, so any worker can cancel the
+    sessions of a job.
+
+    Each process has a `<job id>.<pid>` file with its deadline and node
+    name. Names of the cancelled nodes are kept in `<job id>.cancelled`
+    file for `ttl` seconds, their sessions that were still queued are
+    not started
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+
+    def _file(self, job_id, suffix):
+        if not re.match(r'^[\w-]+$', job_id or ''):
+            raise ValueError('Invalid job id')
+        return os.path.join(self.path, '%s.%s' % (job_id, suffix))
+
+    def add(self, job_id, name, pid, deadline):
+        """
+        :param name: node name, can be None
+        :param deadline: time when the session times out
+        """
+        with open(self._file(job_id, pid), 'w') as fp:
+            fp.write('%.3f\n%s' % (deadline, name or ''))
+
+    def remove(self, job_id, pid):
+        """
+        :returns False if the session was cancelled
+        """
+        try:
+            os.unlink(self._file(job_id, pid))
+        except OSError:
+            return False
+        return True
+
+    def is_cancelled(self, job_id, name):
+        try:
+            with open(self._file(job_id, CANCEL_SUFFIX)) as fp:
+                return name in fp.read().split('\n')
+        except IOError:
+            return False
+
+    def cancel(self, job_id, names):
+        """
+        Kills the sessions of the nodes, sessions of the other nodes
+        of the job are not affected
+
+        :param names: list of node names
+        :returns (sessions, seconds) tuple: number of killed sessions and
+                 sum of the time they had left until their deadlines
+        """
+        with open(self._file(job_id, CANCEL_SUFFIX), 'a') as fp:
+            fp.write(''.join('%s\n' % name for name in names))
+        now = time.time()
+        sessions = 0
+        seconds = 0.0
+        prefix = '%s.' % job_id
+        for file_name in os.listdir(self.path):
+            if not file_name.startswith(prefix):
+                continue
+            pid = file_name[len(prefix):]
+            if not pid.isdigit():
+                continue
+            path = os.path.join(self.path, file_name)
+            try:
+                with open(path) as fp:
+                    deadline, name = fp.read().split('\n', 1)
+                if name not in names:
+                    continue
+                left = max(0.0, float(deadline) - now)
+                # unlinked file tells the session it was cancelled
+                os.unlink(path)
+                os.kill(int(pid), signal.SIGKILL)
+            except (IOError, OSError, ValueError):
+                continue
+            sessions += 1
+            seconds += left
+        self._expire(now)
+        return sessions, seconds
+
+    def _expire(self, now):
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith('.' + CANCEL_SUFFIX):
+                continue
+            path = os.path.join(self.path, file_name)
+            try:
+                if os.path.getmtime(path) < now - self.ttl:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+class AccountQuotas(object):
+    """
+    Limits the jobs of each account: at most `rate` jobs per second, with
+    bursts of `burst` jobs, and at most `max_nodes` nodes running at once.
+    Counters are kept in memcache and shared by all the proxies, proxy
+    worker keeps its own counters when memcache is not available.
+
+    Token bucket of an account is kept as the time when the bucket is full
+    again, in milliseconds, so memcache `incr` can update it atomically
+    """
+
+    def __init__(self, rate=0, burst=10, max_nodes=0, ttl=3600):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.max_nodes = int(max_nodes)
+        self.ttl = int(ttl)
+        # in-process counters, key -> value
+        self._counters = {}
+        # moving average of job run time, in seconds
+        self.job_time = 0.0
+
+    def _incr(self, memcache, key, delta):
+        if memcache:
+            try:
+                return memcache.incr(key, delta=delta, time=self.ttl)
+            except MemcacheConnectionError:
+                pass
+        self._counters[key] = max(0, self._counters.get(key, 0) + delta)
+        return self._counters[key]
+
+    def _set(self, memcache, key, value):
+        if memcache:
+            try:
+                memcache.set(key, str(value), serialize=False, time=self.ttl)
+                return
+            except MemcacheConnectionError:
+                pass
+        self._counters[key] = value
+
+    def take_job(self, account, memcache=None):
+        """
+        :param memcache: `swift.common.memcached.MemcacheRing`, can be None
+        :returns None if the account can start a job now, otherwise
+                 seconds until it can
+        """
+        if self.rate <= 0:
+            return None
+        key = 'zvmrate/%s' % account
+        interval = int(round(1000 / self.rate))
+        now = int(time.time() * 1000)
+        full = self._incr(memcache, key, interval)
+        if full < now + interval:
+            # bucket was full, now it is one job short
+            self._set(memcache, key, now + interval)
+            return None
+        if full - now > self.burst * interval:
+            self._incr(memcache, key, -interval)
+            return (full - now - self.burst * interval) / 1000.0
+        return None
+
+    def take_nodes(self, account, nodes, memcache=None):
+        """
+        :returns False if the account would run more than `max_nodes`
+        """
+        if self.max_nodes <= 0:
+            return True
+        key = 'zvmnodes/%s' % account
+        if self._incr(memcache, key, nodes) > self.max_nodes:
+            self._incr(memcache, key, -nodes)
+            return False
+        return True
+
+    def release_nodes(self, account, nodes, run_time, memcache=None):
+        """
+        :param run_time: seconds the job was running
+        """
+        if self.max_nodes <= 0:
+            return
+        self._incr(memcache, 'zvmnodes/%s' % account, -nodes)
+        if self.job_time:
+            self.job_time += SERVICE_TIME_DECAY * (run_time - self.job_time)
+        else:
+            self.job_time = run_time
+
+
+class FairPool(PoolInterface):
+    """
+    Runs at most `pool_size` sessions, other sessions wait in per-account
+    queues and are started in weighted fair queuing order: when two accounts
+    have queued sessions, account with weight 2 gets twice as many slots
+    as account with weight 1. Each account can take only its weighted share
+    of the `queue_size` places in the queue, some places are always left
+    for accounts that have nothing queued.
+
+    Weights are passed as `account:weight` arguments, accounts not listed
+    have weight 1, ex. `FairPool(10, 20, AUTH_web:4, AUTH_batch:0.5)`
+    """
+
+    def __init__(self, pool_size=1000, queue_size=1000, *weights):
+        PoolInterface.__init__(self)
+        self._pool_size = int(pool_size)
+        self._queue_size = int(queue_size)
+        self._pool = GreenPool(self._pool_size + self._queue_size)
+        self._max_job_id = ''
+        self._weights = _parse_weights(weights)
+        # weights set at runtime, override the configured ones
+        self._account_weights = {}
+        self._running = 0
+        # heap of [finish tag, sequence, account, event]
+        self._queue = []
+        self._sequence = 0
+        # account -> number of queued sessions
+        self._queued = {}
+        # account -> finish tag of the last queued session
+        self._finish = {}
+        self._virtual_time = 0.0
+
+    def reconfigure(self, pool_size=1000, queue_size=1000, *weights):
+        self._weights = _parse_weights(weights)
+        self._pool_size = int(pool_size)
+        self._queue_size = int(queue_size)
+        _resize_green_pool(self._pool, self._pool_size + self._queue_size)
+        # pool has grown, start the queued sessions
+        while self._queue and self._running < self._pool_size:
+            self._running += 1
+            self._next_turn()
+
+    def can_spawn(self, job_id, account=None):
+        if job_id <= self._max_job_id:
+            return True
+        if self.has_free_slot(account):
+            self._max_job_id = job_id
+            return True
+        return False
+
+    def free_slots(self):
+        return (self._pool_size - self._running +
+                self._queue_size - len(self._queue))
+
+    def size(self):
+        return self._pool_size
+
+    def running(self):
+        return self._running
+
+    def queued(self):
+        return len(self._queue)
+
+    def has_free_slot(self, account=None):
+        reserved = self.reserved()
+        if self.free_slots() <= reserved:
+            return False
+        if self._running + reserved < self._pool_size:
+            return True
+        return self._queued.get(account or '', 0) < self._share(account)
+
+    def set_weight(self, account, weight):
+        self._account_weights[account or ''] = _parse_weight(weight)
+
+    def weight(self, account):
+        account = account or ''
+        return self._account_weights.get(account,
+                                         self._weights.get(account, 1.0))
+
+    def queue_depth(self, account=None):
+        """
+        :param account: account name, None for all the accounts
+
+        :returns number of queued sessions
+        """
+        if account is None:
+            return len(self._queue)
+        return self._queued.get(account, 0)
+
+    def _share(self, account):
+        # one share with weight 1 is kept for accounts
+        # that have nothing queued yet
+        weight = self.weight(account)
+        total = weight + 1.0 + sum(self.weight(a) for a in self._queued
+                                   if a != (account or ''))
+        return max(1, int(self._queue_size * weight / total))
+
+    def spawn(self, job_id, function, *args, **kwargs):
+        return self.spawn_for(None, job_id, function, *args, **kwargs)
+
+    def spawn_for(self, account, job_id, function, *args, **kwargs):
+        if self.can_spawn(job_id, account):
+            return self._spawn_queued(account or '', function,
+                                      *args, **kwargs)
+
+    def _spawn(self, function, *args, **kwargs):
+        return self._spawn_queued('', function, *args, **kwargs)
+
+    def _spawn_queued(self, account, function, *args, **kwargs):
+        entry = None
+        if self._running < self._pool_size and not self._queue:
+            self._running += 1
+        else:
+            tag = max(self._virtual_time, self._finish.get(account, 0.0)) + \
+                1.0 / self.weight(account)
+            self._finish[account] = tag
+            self._sequence += 1
+            entry = [tag, self._sequence, account, Event()]
+            heapq.heappush(self._queue, entry)
+            self._update_queued(account, 1)
+        return self._pool.spawn(self._run, entry, function, *args, **kwargs)
+
+    def _run(self, entry, function, *args, **kwargs):
+        if entry:
+            self._wait_turn(entry)
+        try:
+            return self._timed(function, *args, **kwargs)
+        finally:
+            self._next_turn()
+
+    def _wait_turn(self, entry):
+        start = time.time()
+        turn = entry[3]
+        try:
+            turn.wait()
+        except BaseException:
+            if turn.ready():
+                # got the slot already, pass it on
+                self._next_turn()
+            else:
+                entry[3] = None
+                self._update_queued(entry[2], -1)
+            raise
+        self._timing_since('wait', start)
+
+    def _next_turn(self):
+        if self._running > self._pool_size:
+            # pool has shrunk, slot is not reused
+            self._running -= 1
+            return
+        while self._queue:
+            tag, _sequence, account, turn = heapq.heappop(self._queue)
+            if turn is None:
+                # waiting session was killed
+                continue
+            self._virtual_time = tag
+            self._update_queued(account, -1)
+            # slot is handed over to the queued session
+            turn.send()
+            return
+        self._running -= 1
+
+    def _update_queued(self, account, delta):
+        queued = self._queued.get(account, 0) + delta
+        if queued > 0:
+            self._queued[account] = queued
+        else:
+            self._queued.pop(account, None)
+            self._finish.pop(account, None)
+        if self.logger:
+            self.logger.update_stats(
+                'pool.%s.%s.queued' % (self.name, account or 'none'), delta)
+
+
+def parse_pools(value):
+    """
+    Parses thread pool configuration,
+    ex. `default = WaitPool(10,3); cluster = PriorityPool(10,100)`
+
+    :param value: configuration string
+
+    :returns list of (name, pool class, arguments) tuples
+    :raises ValueError if configuration cannot be parsed
+    """
+    result = []
+    for pool in [i.strip() for i in value.split(';') if i.strip()]:
+        name, args = [i.strip() for i in pool.split('=')
+                      if i.strip()]
+        func, args = [i.strip(')') for i in args.split('(')
+                      if i.strip(')')]
+        args = [i.strip() for i in args.split(',')
+                if i.strip()]
+        pool_class = globals().get(func)
+        if not isinstance(pool_class, type) \
+                or not issubclass(pool_class, PoolInterface) \
+                or pool_class is PoolInterface:
+            raise ValueError('Unknown pool class: %s' % func)
+        result.append((name, pool_class, args))
+    return result
+
+
+def _read_numa_nodes(sysfs):
+    """
+    :returns dict of NUMA node number -> list of its cpus
+    """
+    nodes = {}
+    node_dir = os.path.join(sysfs, 'devices', 'system', 'node')
+    try:
+        for name in os.listdir(node_dir):
+            if not re.match(r'^node\d+$', name):
+                continue
+            with open(os.path.join(node_dir, name, 'cpulist')) as f:
+                cpus = _parse_cpu_list(f.read())
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    except (IOError, OSError, ValueError):
+        nodes = {}
+    if not nodes:
+        try:
+            cpu_count = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpu_count = 1
+        nodes[0] = range(cpu_count)
+    return nodes
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def _parse_cpu_list(value):
+    """
+    Parses cpu list in /sys format, ex. `0-3,8-11`
+
+    :returns sorted list of cpu numbers
+    """
+    cpus = set()
+    for part in value.strip().split(','):
+        if not part:
+            continue
+        first, _junk, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def _resize_green_pool(pool, size):
+    delta = size - pool.size
+    if delta > 0:
+        # GreenPool.resize() does not wake up the waiting greenthreads
+        pool.size = size
+        for _i in range(delta):
+            pool.sem.release()
+    else:
+        pool.resize(size)
+
+
+def _parse_weights(weights):
+    result = {}
+    for item in weights:
+        account, weight = item.rsplit(':', 1)
+        result[account.strip()] = _parse_weight(weight)
+    return result
+
+
+def _parse_weight(weight):
+    weight = float(weight)
+    if weight <= 0:
+        raise ValueError('Weight must be positive: %s' % weight)
+    return weight
+
+
+def _percentile(values, percentile):
+    index = int(math.ceil(percentile / 100.0 * len(values))) - 1
+    return values[max(0, index)]
+
+
+def _parse_cdr_line(line):
+    """
+    :param line: `<ttotal>, <sys> <user> <reads> <rbytes> <writes> <wbytes>
+                 <nreads> <nrbytes> <nwrites> <nwbytes>`
+    :returns sample in COST_FIELDS order, None if the line cannot be parsed
+    """
+    try:
+        total, acc = line.split(',', 1)
+        acc = [float(v) for v in acc.split()]
+        return (float(total), acc[0] + acc[1],
+                acc[3] + acc[7], acc[5] + acc[9])
+    except (AttributeError, ValueError, IndexError):
+        return None